@@ -5,6 +5,7 @@ import json
 from typing import List
 from fastapi import APIRouter, HTTPException, Depends, Form, Request, Header
 from starlette.requests import Request as StarletteRequest
+from starlette.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 from pathlib import Path
@@ -205,6 +206,165 @@ async def revoke_access(
     return {"status": "success"}
 
 
+def _reencode_document(job, document_id: int, target_format: str) -> int:
+    """Перекодирование кеша страниц документа (выполняется в пуле обслуживания)"""
+    import os
+    from app.core.config import settings
+    from app.models.database import SessionLocal
+    from app.services.converter import DocumentConverter
+    
+    db = SessionLocal()
+    try:
+        doc = db.query(Document).filter(Document.id == document_id).first()
+        if not doc:
+            raise Exception(f"Document {document_id} not found")
+        old_format = doc.image_format
+        if old_format == target_format:
+            return doc.id
+    
+        cache_dir = os.path.join(settings.CACHE_DIR, doc.file_hash)
+        DocumentConverter.reencode_cache(
+            cache_dir, doc.total_pages, old_format, target_format,
+            progress_callback=job.report_progress,
+            dpi=DocumentConverter.render_dpi(doc.file_type)
+        )
+        # Переключаем документ только после того, как новые файлы записаны
+        doc.image_format = target_format
+        db.commit()
+        DocumentConverter.remove_stale_format_files(cache_dir, target_format)
+        return doc.id
+    finally:
+        db.close()
+
+
+@router.post("/documents/reencode")
+async def reencode_documents(
+    request: Request,
+    image_format: str = Form(...),
+    document_id: int = Form(None),
+    db: Session = Depends(get_db)
+):
+    """Перекодирование кеша страниц в другой формат хранения (требует авторизации)
+    
+    Работа выполняется в фоне, прогресс - через /api/documents/jobs/{job_id}.
+    """
+    get_admin_from_request(request, db)  # Проверка авторизации
+    from app.services.image_formats import PageImageFormat
+    from app.services.jobs import ConversionJob, maintenance_jobs
+    
+    if image_format not in PageImageFormat.FORMATS and image_format != PageImageFormat.AUTO:
+        raise HTTPException(status_code=400, detail="Неподдерживаемый формат")
+    
+    # Документы, которые еще конвертируются, перекодирует сама конвертация
+    query = db.query(Document).filter(
+        Document.image_format != image_format,
+        Document.status == Document.READY
+    )
+    if document_id is not None:
+        query = query.filter(Document.id == document_id)
+    
+    jobs = []
+    for doc in query.all():
+        job, _ = maintenance_jobs.submit(
+            doc.file_hash, _reencode_document, doc.id, image_format, job_type=ConversionJob.REENCODE
+        )
+        jobs.append({
+            "document_id": doc.id,
+            "job_id": job.id,
+            "status_url": f"/api/documents/jobs/{job.id}"
+        })
+    
+    return {"image_format": image_format, "jobs": jobs}
+
+
+def _refresh_document(job, document_id: int) -> int:
+    """Перерендер устаревших страниц документа (выполняется в пуле обслуживания)"""
+    import os
+    from app.core.config import settings
+    from app.models.database import SessionLocal
+    from app.services.converter import DocumentConverter
+    
+    db = SessionLocal()
+    try:
+        doc = db.query(Document).filter(Document.id == document_id).first()
+        if not doc:
+            raise Exception(f"Document {document_id} not found")
+        DocumentConverter.refresh_stale_pages(
+            doc.file_path,
+            doc.file_type,
+            os.path.join(settings.CACHE_DIR, doc.file_hash),
+            doc.total_pages,
+            doc.image_format,
+            progress_callback=job.report_progress
+        )
+        return doc.id
+    finally:
+        db.close()
+
+
+@router.post("/documents/refresh")
+async def refresh_documents(
+    request: Request,
+    document_id: int = Form(None),
+    db: Session = Depends(get_db)
+):
+    """Перерендер страниц, растеризованных с прежними DPI/форматом/версией конвертера (требует авторизации)
+    
+    Задачи ставятся только для документов с устаревшими страницами,
+    прогресс - через /api/documents/jobs/{job_id}.
+    """
+    get_admin_from_request(request, db)  # Проверка авторизации
+    import os
+    from app.core.config import settings
+    from app.services.converter import DocumentConverter
+    from app.services.jobs import ConversionJob, maintenance_jobs
+    
+    query = db.query(Document).filter(Document.status == Document.READY)
+    if document_id is not None:
+        query = query.filter(Document.id == document_id)
+    
+    jobs = []
+    for doc in query.all():
+        # Проверка страниц читает манифест и растры - в пуле потоков
+        stale = await run_in_threadpool(
+            DocumentConverter.stale_pages,
+            os.path.join(settings.CACHE_DIR, doc.file_hash),
+            doc.total_pages,
+            DocumentConverter.render_dpi(doc.file_type),
+            doc.image_format
+        )
+        if not stale:
+            continue
+        job, _ = maintenance_jobs.submit(doc.file_hash, _refresh_document, doc.id, job_type=ConversionJob.REFRESH)
+        jobs.append({
+            "document_id": doc.id,
+            "stale_pages": len(stale),
+            "job_id": job.id,
+            "status_url": f"/api/documents/jobs/{job.id}"
+        })
+    
+    return {"jobs": jobs}
+
+
+@router.get("/stats")
+async def get_service_stats(request: Request, db: Session = Depends(get_db)):
+    """Счетчики кешей и рендера этого процесса (требует авторизации)
+    
+    Каждый воркер uvicorn считает отдельно - pid показывает, какой ответил.
+    """
+    get_admin_from_request(request, db)  # Проверка авторизации
+    import os
+    from app.services.render_pool import page_render_flights, page_render_pool
+    from app.services.response_cache import page_response_cache
+    
+    return {
+        "pid": os.getpid(),
+        "page_response_cache": page_response_cache.stats(),
+        "render_pool": page_render_pool.stats(),
+        "render_flights": page_render_flights.stats()
+    }
+
+
 @router.put("/watermark/global")
 async def update_global_watermark(
     request: Request,
@@ -237,6 +397,10 @@ async def update_global_watermark(
         import os
         import shutil
         from app.core.config import settings
+        from app.services.response_cache import page_response_cache
+        from app.utils.helpers import remove_cache_locks
+        
+        page_response_cache.clear()
         
         cache_dir = settings.CACHE_DIR
         if os.path.exists(cache_dir):
@@ -250,6 +414,10 @@ async def update_global_watermark(
                                 os.remove(file_path)
                             except:
                                 pass
+                    # Тайлы всех сессий нарезаны из страниц с прежними водяными знаками
+                    shutil.rmtree(os.path.join(doc_cache_path, "tiles"), ignore_errors=True)
+                    shutil.rmtree(os.path.join(doc_cache_path, "thumbnails"), ignore_errors=True)
+                    remove_cache_locks(doc_cache_path)
         
         return {
             "status": "success",
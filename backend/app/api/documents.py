@@ -3,26 +3,359 @@ API для работы с документами
 """
 import os
 import json
-import hashlib
+import asyncio
 import secrets
+import zipfile
 import logging
 from pathlib import Path
-from typing import List
-from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, Form, Request
-from fastapi.responses import JSONResponse, FileResponse
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlparse
+from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, Form, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
+from pdf2image.exceptions import PDFPageCountError, PDFSyntaxError
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from typing import List
-from app.models.database import get_db, Document, User, DocumentAccess, ViewingSession
+from app.models.database import get_db, SessionLocal, Document, User, DocumentAccess, ViewingSession
 from app.models.schemas import DocumentCreate, DocumentResponse, WatermarkSettings
+from app.services.conversion_journal import ConversionJournal
 from app.services.converter import DocumentConverter
+from app.services.jobs import ConversionJob, conversion_jobs, find_job, maintenance_jobs
+from app.services.image_formats import PageImageFormat
+from app.services.page_manifest import PageManifest
+from app.services.page_variants import PageVariants
+from app.services.render_pool import RenderQueueFullError, page_render_flights, page_render_pool
+from app.services.response_cache import page_response_cache
+from app.services.thumbnails import ThumbnailSprites
+from app.services.tiles import TilePyramid
+from app.services.uploads import UploadOffsetError, UploadStore, UploadTooLargeError
 from app.services.watermark import WatermarkService
+from app.utils.helpers import cache_lock_path, file_lock
 from app.core.config import settings
+from app.api.viewer import get_ready_pages, is_mobile_device
 from datetime import datetime, timedelta
+from email.utils import formatdate, parsedate_to_datetime
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+ALLOWED_EXTENSIONS = ['.pdf', '.ppt', '.pptx']
+# Как часто поток пакетного импорта опрашивает задачи конвертации (секунды)
+IMPORT_POLL_INTERVAL = 0.5
+# Через сколько секунд повторить запрос страницы, которая еще конвертируется
+PAGE_NOT_READY_RETRY_AFTER = 2
+# Спрайт миниатюр неизменен для своей версии (версия - в URL)
+THUMBNAIL_SPRITE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+# Ошибки самого файла: повторная попытка конвертации ничего не изменит
+PERMANENT_CONVERSION_ERRORS = (ValueError, PDFPageCountError, PDFSyntaxError)
+
+
+def _job_response(job: ConversionJob, status_code: int = 202) -> JSONResponse:
+    """Ответ с состоянием фоновой задачи"""
+    content = job.to_dict()
+    content["status_url"] = f"/api/documents/jobs/{job.id}"
+    return JSONResponse(status_code=status_code, content=content)
+
+
+def _save_document_row(
+    file_hash: str,
+    file_path: str,
+    file_type: str,
+    total_pages: int,
+    name: str,
+    watermark_config: dict,
+    image_format: str,
+    status: str
+) -> int:
+    """Создание записи документа (или обновление записи после неудачной конвертации)"""
+    db = SessionLocal()
+    try:
+        doc = db.query(Document).filter(Document.file_hash == file_hash).first()
+        if doc:
+            doc.file_path = file_path
+            doc.total_pages = total_pages
+            doc.image_format = image_format
+            doc.status = status
+        else:
+            doc = Document(
+                name=name,
+                file_path=file_path,
+                file_hash=file_hash,
+                file_type=file_type,
+                total_pages=total_pages,
+                access_token=secrets.token_urlsafe(32),
+                watermark_settings=json.dumps(watermark_config) if watermark_config else None,
+                image_format=image_format,
+                status=status,
+                created_by="api"
+            )
+            db.add(doc)
+        
+        db.commit()
+        db.refresh(doc)
+        return doc.id
+    finally:
+        db.close()
+
+
+def _set_document_status(document_id: int, status: str, total_pages: Optional[int] = None):
+    db = SessionLocal()
+    try:
+        doc = db.query(Document).filter(Document.id == document_id).first()
+        if doc:
+            doc.status = status
+            if total_pages is not None:
+                doc.total_pages = total_pages
+            db.commit()
+    finally:
+        db.close()
+
+
+def _convert_document(
+    job: ConversionJob,
+    file_path: str,
+    file_type: str,
+    output_dir: str,
+    name: str,
+    watermark_config: dict
+) -> int:
+    """Конвертация документа в пуле воркеров и регистрация его в БД
+    
+    Запись документа создается, как только известно количество страниц
+    (со статусом converting), и job.document_id заполняется сразу: viewer
+    показывает готовые страницы, пока остальные конвертируются.
+    Уже растеризованные страницы (после перезапуска) не рендерятся заново,
+    страницы, которые не удалось растеризовать, попадают в job.failed_pages.
+    Загруженный файл не удаляется и при ошибке - повторная загрузка
+    продолжит с того же места. После растеризации собираются спрайты
+    миниатюр для навигации.
+    """
+    image_format = settings.PAGE_IMAGE_FORMAT
+    ConversionJournal.start_attempt(job.file_hash)
+    
+    def report_progress(pages_converted: int, total_pages: Optional[int] = None):
+        job.report_progress(pages_converted, total_pages)
+        if job.document_id is None and total_pages:
+            job.document_id = _save_document_row(
+                job.file_hash, file_path, file_type, total_pages, name,
+                watermark_config, image_format, Document.CONVERTING
+            )
+    
+    try:
+        if settings.LAZY_RENDERING:
+            total_pages = DocumentConverter.prepare_lazy(
+                file_path,
+                file_type,
+                output_dir,
+                progress_callback=report_progress,
+                image_format=image_format
+            )
+        else:
+            images = DocumentConverter.convert_to_images(
+                file_path,
+                file_type,
+                output_dir,
+                progress_callback=report_progress,
+                image_format=image_format
+            )
+            total_pages = job.total_pages or len(images)
+    except Exception as e:
+        if job.document_id is not None:
+            _set_document_status(job.document_id, Document.FAILED)
+        # Сбой офиса или растеризации (таймаут, переполненная очередь, упавший
+        # процесс) - запись остается, и после перезапуска конвертация продолжится;
+        # бесконечные повторы ограничивает счетчик attempts
+        if isinstance(e, PERMANENT_CONVERSION_ERRORS):
+            ConversionJournal.remove(job.file_hash)
+        raise
+    
+    job.failed_pages = PageManifest.failed_pages(output_dir)
+    if job.failed_pages:
+        logger.warning(f"Document {job.file_hash}: failed pages {job.failed_pages}")
+        print(f"[WARN] Document {job.file_hash}: failed pages {job.failed_pages}")
+    ConversionJournal.remove(job.file_hash)
+    
+    if not settings.LAZY_RENDERING:
+        try:
+            _prebuild_shared_thumbnails(job.file_hash, output_dir, total_pages, image_format)
+        except Exception as e:
+            # Без спрайтов документ открывается; они соберутся при первом запросе
+            print(f"[WARN] Thumbnail sprites for {job.file_hash} failed: {e}")
+    
+    if job.document_id is None:
+        return _save_document_row(
+            job.file_hash, file_path, file_type, total_pages, name,
+            watermark_config, image_format, Document.READY
+        )
+    _set_document_status(job.document_id, Document.READY, total_pages)
+    return job.document_id
+
+
+def _prebuild_shared_thumbnails(file_hash: str, output_dir: str, total_pages: int, image_format: str):
+    """Спрайты миниатюр с общими для всех сессий водяными знаками
+    
+    Если на сервере рисуются данные зрителя, спрайты каждой сессии
+    собираются при первом запросе индекса.
+    """
+    db = SessionLocal()
+    try:
+        watermark_settings, static_watermark_path, cache_scope = _watermark_render_context(db, None)
+    finally:
+        db.close()
+    if cache_scope is None:
+        return
+    ThumbnailSprites.ensure(
+        output_dir,
+        total_pages,
+        image_format,
+        cache_scope,
+        WatermarkService.settings_version(watermark_settings, static_watermark_path),
+        _thumbnail_watermark(watermark_settings, static_watermark_path, (None, None, None, file_hash))
+    )
+
+
+def _existing_document_response(doc: Document) -> DocumentResponse:
+    watermark_settings = None
+    if doc.watermark_settings:
+        try:
+            watermark_settings = json.loads(doc.watermark_settings)
+        except:
+            pass
+    return DocumentResponse(
+        id=doc.id,
+        name=doc.name,
+        file_type=doc.file_type,
+        total_pages=doc.total_pages,
+        access_token=doc.access_token,
+        created_at=doc.created_at,
+        watermark_settings=watermark_settings,
+        status=doc.status
+    )
+
+
+def _register_upload(
+    tmp_path: str,
+    file_hash: str,
+    filename: str,
+    name: Optional[str],
+    watermark_settings: Optional[str],
+    db: Session
+) -> Union[Document, ConversionJob]:
+    """Регистрация принятого файла: дубликат, присоединение к задаче или новая конвертация
+    
+    Возвращает существующий документ или задачу конвертации. Временный файл
+    переносится в UPLOAD_DIR только для новой конвертации, в остальных
+    случаях он удаляется.
+    """
+    # Проверка на дубликат (документ с неудачной конвертацией конвертируется заново)
+    existing_doc = db.query(Document).filter(Document.file_hash == file_hash).first()
+    if existing_doc and existing_doc.status != Document.FAILED:
+        UploadStore.discard_file(tmp_path)
+        return existing_doc
+    
+    # Тот же файл уже конвертируется - присоединяемся к существующей задаче
+    active_job = conversion_jobs.find_active(file_hash)
+    if active_job:
+        UploadStore.discard_file(tmp_path)
+        return active_job
+    
+    # Сохранение файла
+    safe_filename = "".join(c for c in filename if c.isalnum() or c in ".-_")
+    file_path = os.path.join(settings.UPLOAD_DIR, f"{file_hash}_{safe_filename}")
+    UploadStore.commit(tmp_path, file_path)
+    
+    file_type = Path(filename).suffix.lower()[1:]  # убираем точку
+    output_dir = os.path.join(settings.CACHE_DIR, file_hash)
+    
+    # Создаем директорию для кеша, если её нет
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # Парсинг настроек водяных знаков
+    watermark_config = None
+    if watermark_settings:
+        try:
+            watermark_config = json.loads(watermark_settings)
+        except Exception as e:
+            logger.warning(f"Failed to parse watermark settings: {e}")
+            print(f"[WARN] Failed to parse watermark settings: {e}")
+            pass
+    
+    if not watermark_config:
+        watermark_config = WatermarkSettings().dict()
+    
+    # Конвертация в изображения выполняется в отдельном пуле воркеров;
+    # запись в журнале позволит продолжить ее после перезапуска сервиса
+    ConversionJournal.record(file_hash, file_path, file_type, output_dir, name or safe_filename, watermark_config)
+    job, _ = conversion_jobs.submit(
+        file_hash,
+        _convert_document,
+        file_path,
+        file_type,
+        output_dir,
+        name or safe_filename,
+        watermark_config
+    )
+    return job
+
+
+def resume_interrupted_conversions():
+    """Повторная постановка в очередь конвертаций, прерванных перезапуском сервиса
+    
+    Вызывается при старте приложения. Конвертация, которая уже
+    CONVERSION_MAX_ATTEMPTS раз не дошла до конца, больше не запускается.
+    """
+    for entry in ConversionJournal.pending():
+        file_hash = entry["file_hash"]
+        attempts = entry.get("attempts", 0)
+        if attempts >= settings.CONVERSION_MAX_ATTEMPTS or not os.path.exists(entry["file_path"]):
+            logger.error(f"Giving up on interrupted conversion {file_hash} after {attempts} attempts")
+            print(f"[ERROR] Giving up on interrupted conversion {file_hash} after {attempts} attempts")
+            ConversionJournal.remove(file_hash)
+            db = SessionLocal()
+            try:
+                doc = db.query(Document).filter(Document.file_hash == file_hash).first()
+                if doc and doc.status == Document.CONVERTING:
+                    doc.status = Document.FAILED
+                    db.commit()
+            finally:
+                db.close()
+            continue
+        
+        print(f"[CONVERTER] Resuming interrupted conversion of {entry['name']} ({file_hash}), attempt {attempts + 1}")
+        conversion_jobs.submit(
+            file_hash,
+            _convert_document,
+            entry["file_path"],
+            entry["file_type"],
+            entry["output_dir"],
+            entry["name"],
+            entry["watermark_config"]
+        )
+
+
+def _accept_upload(
+    tmp_path: str,
+    file_hash: str,
+    filename: str,
+    name: Optional[str],
+    watermark_settings: Optional[str],
+    db: Session
+):
+    """Ответ на загрузку: существующий документ или 202 с задачей конвертации"""
+    result = _register_upload(tmp_path, file_hash, filename, name, watermark_settings, db)
+    if isinstance(result, Document):
+        return _existing_document_response(result)
+    return _job_response(result)
+
+
+def _check_upload_filename(filename: Optional[str]):
+    if not filename:
+        raise HTTPException(status_code=400, detail="Имя файла не указано")
+    if Path(filename).suffix.lower() not in ALLOWED_EXTENSIONS:
+        raise HTTPException(status_code=400, detail="Поддерживаются только PDF, PPT, PPTX файлы")
+
 
 @router.post("/upload", response_model=DocumentResponse)
 async def upload_document(
@@ -31,121 +364,314 @@ async def upload_document(
     watermark_settings: str = Form(None),
     db: Session = Depends(get_db)
 ):
-    """Загрузка документа"""
+    """Загрузка документа
+    
+    Файл пишется на диск порциями, MD5 считается по ходу чтения. Если документ
+    уже загружен, возвращается он сам. Иначе конвертация ставится в очередь
+    и сразу возвращается 202 с id задачи (см. GET /jobs/{job_id}).
+    Для больших файлов и нестабильной связи - докачиваемая загрузка /uploads.
+    """
     try:
         # Проверка типа файла
-        if not file.filename:
-            raise HTTPException(status_code=400, detail="Имя файла не указано")
-        
-        file_ext = Path(file.filename).suffix.lower()
-        if file_ext not in ['.pdf', '.ppt', '.pptx']:
-            raise HTTPException(status_code=400, detail="Поддерживаются только PDF, PPT, PPTX файлы")
+        _check_upload_filename(file.filename)
         
-        # Чтение файла
-        contents = await file.read()
-        
-        if len(contents) > settings.MAX_FILE_SIZE:
+        try:
+            tmp_path, file_hash, _ = await UploadStore.save_upload_file(file)
+        except UploadTooLargeError:
             raise HTTPException(status_code=400, detail="Файл слишком большой")
         
-        # Генерация хеша
-        file_hash = hashlib.md5(contents).hexdigest()
-        
-        # Проверка на дубликат
-        existing_doc = db.query(Document).filter(Document.file_hash == file_hash).first()
-        if existing_doc:
-            watermark_settings = None
-            if existing_doc.watermark_settings:
+        # Перенос файла и запись в базу - в пуле потоков, не в event loop
+        return await run_in_threadpool(
+            _accept_upload, tmp_path, file_hash, file.filename, name, watermark_settings, db
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+        error_trace = traceback.format_exc()
+        logger.error(f"Upload error: {error_trace}")
+        print(f"[ERROR] Upload error: {error_trace}")
+        raise HTTPException(status_code=500, detail=f"Ошибка загрузки: {str(e)}")
+
+
+async def _save_import_files(files: List[UploadFile]) -> List[dict]:
+    """Прием файлов пакетного импорта во временные файлы (ZIP распаковывается)
+
+    Каждый элемент - {"filename", "tmp_path", "file_hash"} или {"filename", "error"}.
+    """
+    items = []
+    try:
+        for file in files:
+            filename = os.path.basename(file.filename or "")
+            suffix = Path(filename).suffix.lower()
+            if suffix == ".zip":
                 try:
-                    watermark_settings = json.loads(existing_doc.watermark_settings)
-                except:
-                    pass
-            return DocumentResponse(
-                id=existing_doc.id,
-                name=existing_doc.name,
-                file_type=existing_doc.file_type,
-                total_pages=existing_doc.total_pages,
-                access_token=existing_doc.access_token,
-                created_at=existing_doc.created_at,
-                watermark_settings=watermark_settings
-            )
-        
-        # Сохранение файла
-        safe_filename = "".join(c for c in file.filename if c.isalnum() or c in ".-_")
-        file_path = os.path.join(settings.UPLOAD_DIR, f"{file_hash}_{safe_filename}")
-        
-        # Создаем директорию, если её нет
-        os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
-        
-        with open(file_path, 'wb') as f:
-            f.write(contents)
-        
-        # Конвертация в изображения
-        file_type = file_ext[1:]  # убираем точку
-        output_dir = os.path.join(settings.CACHE_DIR, file_hash)
-        
-        # Создаем директорию для кеша, если её нет
-        os.makedirs(output_dir, exist_ok=True)
+                    archive_path, _, _ = await UploadStore.save_upload_file(
+                        file, max_size=settings.IMPORT_MAX_ARCHIVE_SIZE
+                    )
+                except UploadTooLargeError:
+                    items.append({"filename": filename, "error": "archive too large"})
+                    continue
+                try:
+                    items.extend(await run_in_threadpool(
+                        UploadStore.extract_archive, archive_path, ALLOWED_EXTENSIONS
+                    ))
+                except zipfile.BadZipFile:
+                    items.append({"filename": filename, "error": "invalid zip archive"})
+                except UploadTooLargeError:
+                    items.append({"filename": filename, "error": "archive exceeds import limits"})
+                finally:
+                    UploadStore.discard_file(archive_path)
+            elif suffix in ALLOWED_EXTENSIONS:
+                try:
+                    tmp_path, file_hash, _ = await UploadStore.save_upload_file(file)
+                except UploadTooLargeError:
+                    items.append({"filename": filename, "error": "file too large"})
+                    continue
+                items.append({"filename": filename, "tmp_path": tmp_path, "file_hash": file_hash})
+            else:
+                items.append({"filename": filename, "error": "unsupported file type"})
+    except BaseException:
+        for item in items:
+            if "tmp_path" in item:
+                UploadStore.discard_file(item["tmp_path"])
+        raise
+    return items
+
+
+def _import_document_event(document_id: Optional[int]) -> Optional[dict]:
+    """Сведения о документе для событий импорта"""
+    if document_id is None:
+        return None
+    db = SessionLocal()
+    try:
+        doc = db.query(Document).filter(Document.id == document_id).first()
+        return jsonable_encoder(_existing_document_response(doc)) if doc else None
+    finally:
+        db.close()
+
+
+@router.post("/import")
+async def import_documents(
+    files: List[UploadFile] = File(...),
+    watermark_settings: str = Form(None),
+    db: Session = Depends(get_db)
+):
+    """Пакетный импорт: несколько PDF/PPT/PPTX и/или ZIP-архивы с ними
+    
+    Все файлы принимаются потоково и дедуплицируются по MD5 (с уже
+    загруженными документами, с идущими задачами и между собой), затем все
+    новые ставятся в очередь конвертации сразу - документы конвертируются
+    параллельно (CONVERSION_WORKERS), а их страницы - в общем пуле растеризации.
+    
+    Ответ - поток NDJSON, по строке на событие:
+    queued / duplicate / rejected сразу для каждого файла, затем progress
+    по мере конвертации, done или failed по каждому файлу и в конце summary.
+    Обрыв соединения конвертацию не отменяет: состояние задач доступно
+    через GET /jobs/{job_id}.
+    """
+    if len(files) > settings.IMPORT_MAX_FILES:
+        raise HTTPException(status_code=400, detail="Слишком много файлов")
+    
+    items = await _save_import_files(files)
+    if len(items) > settings.IMPORT_MAX_FILES:
+        for item in items:
+            if "tmp_path" in item:
+                UploadStore.discard_file(item["tmp_path"])
+        raise HTTPException(status_code=400, detail="Слишком много файлов")
+    
+    events = []
+    jobs = {}
+    for index, item in enumerate(items):
+        event = {"index": index, "filename": item["filename"]}
+        if "error" in item:
+            events.append({**event, "event": "rejected", "error": item["error"]})
+            continue
         
+        joined = conversion_jobs.find_active(item["file_hash"]) is not None
+        name = Path(item["filename"]).stem or None
         try:
-            images = DocumentConverter.convert_to_images(file_path, file_type, output_dir)
-            total_pages = len(images)
+            result = await run_in_threadpool(
+                _register_upload, item["tmp_path"], item["file_hash"], item["filename"], name, watermark_settings, db
+            )
         except Exception as e:
-            import traceback
-            error_trace = traceback.format_exc()
-            logger.error(f"Conversion error: {error_trace}")
-            print(f"[ERROR] Conversion error: {error_trace}")
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            raise HTTPException(status_code=500, detail=f"Ошибка конвертации: {str(e)}")
-        
-        # Парсинг настроек водяных знаков
-        watermark_config = None
-        if watermark_settings:
-            try:
-                watermark_config = json.loads(watermark_settings)
-            except Exception as e:
-                logger.warning(f"Failed to parse watermark settings: {e}")
-                print(f"[WARN] Failed to parse watermark settings: {e}")
-                pass
+            UploadStore.discard_file(item["tmp_path"])
+            logger.error(f"Import error for {item['filename']}: {e}")
+            print(f"[ERROR] Import error for {item['filename']}: {e}")
+            events.append({**event, "event": "rejected", "error": str(e)})
+            continue
         
-        if not watermark_config:
-            watermark_config = WatermarkSettings().dict()
+        if isinstance(result, Document):
+            events.append({
+                **event,
+                "event": "duplicate",
+                "document": jsonable_encoder(_existing_document_response(result))
+            })
+        else:
+            # Повтор файла в том же импорте тоже присоединяется к задаче
+            events.append({**event, "event": "queued", "job_id": result.id, "joined": joined})
+            jobs[index] = result
+    
+    print(f"[IMPORT] {len(items)} files: {len(jobs)} queued, {len(items) - len(jobs)} duplicate or rejected")
+    
+    async def stream_events():
+        for event in events:
+            yield json.dumps(event, ensure_ascii=False) + "\n"
         
-        # Создание документа в БД
-        access_token = secrets.token_urlsafe(32)
+        counts = {"done": 0, "failed": 0}
+        counts["duplicate"] = sum(1 for event in events if event["event"] == "duplicate")
+        counts["rejected"] = sum(1 for event in events if event["event"] == "rejected")
+        last_state = {}
+        while jobs:
+            await asyncio.sleep(IMPORT_POLL_INTERVAL)
+            for index, job in list(jobs.items()):
+                event = {"index": index, "filename": items[index]["filename"], "job_id": job.id}
+                if job.is_active:
+                    state = (job.status, job.pages_converted, job.total_pages)
+                    if last_state.get(index) != state:
+                        last_state[index] = state
+                        yield json.dumps({
+                            **event,
+                            "event": "progress",
+                            "status": job.status,
+                            "pages_converted": job.pages_converted,
+                            "total_pages": job.total_pages
+                        }, ensure_ascii=False) + "\n"
+                    continue
+                
+                del jobs[index]
+                if job.status == ConversionJob.DONE:
+                    counts["done"] += 1
+                    document = await run_in_threadpool(_import_document_event, job.document_id)
+                    yield json.dumps({**event, "event": "done", "document": document}, ensure_ascii=False) + "\n"
+                else:
+                    counts["failed"] += 1
+                    yield json.dumps({**event, "event": "failed", "error": job.error}, ensure_ascii=False) + "\n"
         
-        doc = Document(
-            name=name or safe_filename,
-            file_path=file_path,
-            file_hash=file_hash,
-            file_type=file_type,
-            total_pages=total_pages,
-            access_token=access_token,
-            watermark_settings=json.dumps(watermark_config) if watermark_config else None,
-            created_by="api"
+        yield json.dumps({"event": "summary", "total": len(items), **counts}, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(
+        stream_events(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get("/jobs/{job_id}")
+async def get_conversion_job(job_id: str):
+    """Состояние фоновой задачи (конвертации, прогрева или обслуживания кеша)"""
+    job = find_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return _job_response(job, status_code=200)
+
+
+def _upload_state(upload: dict) -> dict:
+    return {
+        "upload_id": upload["upload_id"],
+        "offset": upload["offset"],
+        "total_size": upload["total_size"],
+        "upload_url": f"/api/documents/uploads/{upload['upload_id']}"
+    }
+
+
+@router.post("/uploads", status_code=201)
+async def create_upload(
+    filename: str = Form(...),
+    size: int = Form(...),
+    name: str = Form(None),
+    watermark_settings: str = Form(None)
+):
+    """Начало докачиваемой загрузки
+    
+    Дальше клиент отправляет порции PATCH /uploads/{upload_id} с заголовком
+    Upload-Offset, после обрыва узнает смещение через GET /uploads/{upload_id},
+    а в конце вызывает POST /uploads/{upload_id}/complete.
+    """
+    _check_upload_filename(filename)
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="Неверный размер файла")
+    try:
+        upload = UploadStore.create(filename, size, name, watermark_settings)
+    except UploadTooLargeError:
+        raise HTTPException(status_code=400, detail="Файл слишком большой")
+    return _upload_state(upload)
+
+
+@router.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    """Сколько байт загрузки уже принято"""
+    upload = UploadStore.get(upload_id)
+    if not upload:
+        raise HTTPException(status_code=404, detail="Загрузка не найдена")
+    return JSONResponse(
+        content=_upload_state(upload),
+        headers={"Upload-Offset": str(upload["offset"]), "Cache-Control": "no-store"}
+    )
+
+
+@router.patch("/uploads/{upload_id}")
+async def append_upload(upload_id: str, request: Request):
+    """Очередная порция загрузки (тело запроса - байты файла с позиции Upload-Offset)"""
+    try:
+        offset = int(request.headers.get("Upload-Offset", ""))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Нужен заголовок Upload-Offset")
+    
+    try:
+        # После перезапуска сервиса MD5 принятой части пересчитывается до новых данных
+        await run_in_threadpool(UploadStore.restore_hash, upload_id)
+        offset = await UploadStore.append(upload_id, offset, request.stream())
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Загрузка не найдена")
+    except UploadOffsetError as e:
+        return JSONResponse(
+            status_code=409,
+            content={"detail": "Неверное смещение", "offset": e.offset},
+            headers={"Upload-Offset": str(e.offset)}
         )
-        
-        db.add(doc)
-        db.commit()
-        db.refresh(doc)
-        
-        return DocumentResponse(
-            id=doc.id,
-            name=doc.name,
-            file_type=doc.file_type,
-            total_pages=doc.total_pages,
-            access_token=doc.access_token,
-            created_at=doc.created_at,
-            watermark_settings=watermark_config
+    except UploadTooLargeError:
+        raise HTTPException(status_code=400, detail="Данных больше, чем заявленный размер файла")
+    
+    upload = UploadStore.get(upload_id)
+    return JSONResponse(content=_upload_state(upload), headers={"Upload-Offset": str(offset)})
+
+
+@router.post("/uploads/{upload_id}/complete", response_model=DocumentResponse)
+async def complete_upload(upload_id: str, db: Session = Depends(get_db)):
+    """Завершение докачиваемой загрузки: как POST /upload (документ или 202 с задачей)"""
+    try:
+        part_path, file_hash, upload = await run_in_threadpool(UploadStore.finish, upload_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Загрузка не найдена")
+    except UploadOffsetError as e:
+        return JSONResponse(
+            status_code=409,
+            content={"detail": "Файл загружен не полностью", "offset": e.offset},
+            headers={"Upload-Offset": str(e.offset)}
         )
-    except HTTPException:
+    
+    try:
+        response = await run_in_threadpool(
+            _accept_upload, part_path, file_hash, upload["filename"], upload["name"], upload["watermark_settings"], db
+        )
+    except Exception:
+        # Файл не принят: описание остается, пока есть что повторно завершать
+        if not os.path.exists(part_path):
+            UploadStore.forget(upload_id)
         raise
-    except Exception as e:
-        import traceback
-        error_trace = traceback.format_exc()
-        logger.error(f"Upload error: {error_trace}")
-        print(f"[ERROR] Upload error: {error_trace}")
-        raise HTTPException(status_code=500, detail=f"Ошибка загрузки: {str(e)}")
+    # Описание удаляется только после регистрации файла
+    UploadStore.forget(upload_id)
+    return response
+
+
+@router.delete("/uploads/{upload_id}")
+async def abort_upload(upload_id: str):
+    """Отмена докачиваемой загрузки"""
+    if not UploadStore.get(upload_id):
+        raise HTTPException(status_code=404, detail="Загрузка не найдена")
+    UploadStore.abort(upload_id)
+    return {"status": "success"}
 
 
 @router.get("/", response_model=List[DocumentResponse])
@@ -164,7 +690,8 @@ async def list_documents(db: Session = Depends(get_db)):
             total_pages=doc.total_pages,
             access_token=doc.access_token,
             created_at=doc.created_at,
-            watermark_settings=watermark_settings
+            watermark_settings=watermark_settings,
+            status=doc.status
         ))
     return result
 
@@ -193,6 +720,7 @@ async def delete_document(document_id: int, db: Session = Depends(get_db)):
             pass
     
     # Удаляем кеш изображений
+    page_response_cache.invalidate(lambda key: key[0] == doc.file_hash)
     cache_dir = os.path.join(settings.CACHE_DIR, doc.file_hash)
     if os.path.exists(cache_dir):
         try:
@@ -225,53 +753,107 @@ async def get_document(document_id: int, db: Session = Depends(get_db)):
         total_pages=doc.total_pages,
         access_token=doc.access_token,
         created_at=doc.created_at,
-        watermark_settings=watermark_settings
+        watermark_settings=watermark_settings,
+        status=doc.status
     )
 
 
-@router.get("/{document_id}/page/{page_number}")
-async def get_page_image(
-    document_id: int,
-    page_number: int,
-    viewer_token: str,
+def _select_page_variant(
     request: Request,
-    db: Session = Depends(get_db)
-):
-    """Получение изображения страницы с водяными знаками"""
-    # Проверка Referer (защита от прямого доступа к изображениям)
-    from urllib.parse import urlparse
-    from app.core.config import settings
+    width: Optional[int],
+    dpr: Optional[float],
+    variant: Optional[str]
+) -> Tuple[str, List[str]]:
+    """Выбор варианта разрешения страницы
     
-    def check_referer_for_images(req: Request) -> bool:
-        """Проверка Referer для изображений"""
-        if not settings.REQUIRE_REFERER_CHECK:
-            return True
-        if not settings.ALLOWED_EMBED_DOMAINS:
+    Возвращает (вариант, список заголовков запроса, от которых зависел выбор).
+    """
+    if variant:
+        if variant not in PageVariants.names():
+            raise HTTPException(status_code=400, detail="Неизвестный вариант страницы")
+        return variant, []
+    
+    vary_headers = []
+    if width is None:
+        hint = request.headers.get("sec-ch-viewport-width") or request.headers.get("viewport-width")
+        if hint:
+            vary_headers += ["Sec-CH-Viewport-Width", "Viewport-Width"]
+            try:
+                width = int(float(hint))
+            except ValueError:
+                width = None
+    if dpr is None:
+        hint = request.headers.get("sec-ch-dpr") or request.headers.get("dpr")
+        if hint:
+            vary_headers += ["Sec-CH-DPR", "DPR"]
+            try:
+                dpr = float(hint)
+            except ValueError:
+                dpr = None
+    
+    is_mobile = False
+    if not width:
+        vary_headers.append("User-Agent")
+        is_mobile = is_mobile_device(request.headers.get("user-agent"))
+    
+    return PageVariants.select(width, dpr, is_mobile), vary_headers
+
+
+def _check_referer_for_images(req: Request) -> bool:
+    """Проверка Referer для изображений"""
+    if not settings.REQUIRE_REFERER_CHECK:
+        return True
+    if not settings.ALLOWED_EMBED_DOMAINS:
+        return True
+    referer = req.headers.get("referer")
+    if not referer:
+        return False
+    try:
+        referer_parsed = urlparse(referer)
+        referer_domain = referer_parsed.netloc.lower().split(':')[0]  # Убираем порт для сравнения
+        request_host = req.url.hostname.lower() if req.url.hostname else ""
+        
+        # Если Referer указывает на тот же сервер, разрешаем (внутренний запрос из iframe)
+        if referer_domain == request_host:
             return True
-        referer = req.headers.get("referer")
-        if not referer:
-            return False
-        try:
-            referer_parsed = urlparse(referer)
-            referer_domain = referer_parsed.netloc.lower().split(':')[0]  # Убираем порт для сравнения
-            request_host = req.url.hostname.lower() if req.url.hostname else ""
-            
-            # Если Referer указывает на тот же сервер, разрешаем (внутренний запрос из iframe)
-            if referer_domain == request_host:
+        
+        # Проверяем разрешенные домены
+        for allowed_domain in settings.ALLOWED_EMBED_DOMAINS:
+            allowed_parsed = urlparse(allowed_domain if allowed_domain.startswith('http') else f'https://{allowed_domain}')
+            allowed_domain_clean = allowed_parsed.netloc.lower().replace('www.', '').split(':')[0]
+            referer_domain_clean = referer_domain.replace('www.', '')
+            if referer_domain_clean == allowed_domain_clean:
                 return True
-            
-            # Проверяем разрешенные домены
-            for allowed_domain in settings.ALLOWED_EMBED_DOMAINS:
-                allowed_parsed = urlparse(allowed_domain if allowed_domain.startswith('http') else f'https://{allowed_domain}')
-                allowed_domain_clean = allowed_parsed.netloc.lower().replace('www.', '').split(':')[0]
-                referer_domain_clean = referer_domain.replace('www.', '')
-                if referer_domain_clean == allowed_domain_clean:
-                    return True
-            return False
-        except Exception:
-            return False
+        return False
+    except Exception:
+        return False
+
+
+def _authorize_page_request(
+    request: Request,
+    document_id: int,
+    page_number: int,
+    viewer_token: str,
+    db: Session
+) -> Tuple[Document, ViewingSession]:
+    """Проверки доступа к странице документа: Referer, документ, страница, сессия"""
+    doc, session = _authorize_document_request(request, document_id, viewer_token, db)
     
-    if not check_referer_for_images(request):
+    if page_number < 1 or page_number > doc.total_pages:
+        raise HTTPException(status_code=404, detail="Страница не найдена")
+    
+    return doc, session
+
+
+def _authorize_document_request(
+    request: Request,
+    document_id: int,
+    viewer_token: str,
+    db: Session
+) -> Tuple[Document, ViewingSession]:
+    """Проверки доступа к изображениям документа: Referer, документ, сессия"""
+    # Проверка Referer (защита от прямого доступа к изображениям)
+    if not _check_referer_for_images(request):
         raise HTTPException(
             status_code=403, 
             detail="Доступ разрешен только с разрешенных доменов"
@@ -282,9 +864,6 @@ async def get_page_image(
     if not doc:
         raise HTTPException(status_code=404, detail="Документ не найден")
     
-    if page_number < 1 or page_number > doc.total_pages:
-        raise HTTPException(status_code=404, detail="Страница не найдена")
-    
     # Проверка viewer_token и получение информации о пользователе
     session = db.query(ViewingSession).filter(ViewingSession.session_token == viewer_token).first()
     if not session:
@@ -296,133 +875,991 @@ async def get_page_image(
     if session.document_id != document_id:
         raise HTTPException(status_code=403, detail="Неверный документ для сессии")
     
-    # Получаем информацию о пользователе из сессии (может быть None)
-    user_email = session.user.email if session.user else None
-    user_id = str(session.user.id) if session.user else None
+    return doc, session
+
+
+async def _run_render(func: Callable, *args):
+    """Тяжелая работа над страницей в пуле рендера; при полной очереди - 503 с Retry-After"""
+    try:
+        return await page_render_pool.run(func, *args)
+    except RenderQueueFullError as e:
+        raise HTTPException(
+            status_code=503,
+            detail="Сервер занят рендером страниц, повторите запрос позже",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+
+def _read_image_size(path: str) -> Tuple[int, int]:
+    from PIL import Image
     
-    # Путь к базовому изображению
-    base_image_path = os.path.join(
-        settings.CACHE_DIR,
-        doc.file_hash,
-        f"page_{page_number}.png"
+    with Image.open(path) as img:
+        return img.size
+
+
+def _read_cached_file(path: str) -> Optional[bytes]:
+    """Содержимое файла кеша или None, если его нет"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+async def _ensure_base_page(doc: Document, page_number: int) -> str:
+    """Путь к базовому растру страницы; в ленивом режиме страница рендерится по требованию"""
+    output_dir = os.path.join(settings.CACHE_DIR, doc.file_hash)
+    base_image_path = await run_in_threadpool(
+        DocumentConverter.rendered_page_path,
+        output_dir,
+        page_number,
+        doc.image_format,
+        DocumentConverter.render_dpi(doc.file_type)
     )
     
-    if not os.path.exists(base_image_path):
-        raise HTTPException(status_code=404, detail="Изображение страницы не найдено")
+    if not base_image_path and doc.status == Document.CONVERTING:
+        ready_pages = await run_in_threadpool(get_ready_pages, doc)
+        if page_number not in ready_pages:
+            # Страницу вот-вот запишет конвертация - не рендерим ее второй раз
+            raise HTTPException(
+                status_code=503,
+                detail="Страница еще конвертируется",
+                headers={
+                    "Retry-After": str(PAGE_NOT_READY_RETRY_AFTER),
+                    "X-Pages-Ready": str(len(ready_pages))
+                }
+            )
+    
+    if not base_image_path:
+        # Страница еще не растеризована (ленивый режим) или растеризована
+        # с прежними параметрами - рендерим по требованию
+        base_image_path = await _run_render(
+            DocumentConverter.ensure_page,
+            doc.file_path,
+            doc.file_type,
+            output_dir,
+            page_number,
+            doc.image_format
+        )
+        if not base_image_path:
+            if await run_in_threadpool(DocumentConverter.render_given_up, output_dir, page_number):
+                raise HTTPException(status_code=422, detail="Страницу не удалось растеризовать")
+            raise HTTPException(status_code=404, detail="Изображение страницы не найдено")
+    
+    return base_image_path
+
+
+def _page_format(doc: Document, page_number: int) -> str:
+    """Формат хранения конкретной страницы (в режиме "auto" - из манифеста)"""
+    return PageManifest.page_format(
+        os.path.join(settings.CACHE_DIR, doc.file_hash), page_number, doc.image_format
+    )
+
+
+def _watermarked_page_path(
+    doc: Document,
+    cache_scope: str,
+    page_number: int,
+    page_variant: str,
+    page_format: Optional[str] = None
+) -> str:
+    """Путь к кешу страницы с водяными знаками
     
-    # Путь к изображению с водяными знаками
-    watermarked_path = os.path.join(
+    cache_scope - viewer_token сессии или общий для всех сессий ключ
+    (см. _watermark_render_context). page_format - уже известный формат
+    страницы, иначе он читается из манифеста.
+    """
+    variant_suffix = "" if page_variant == PageVariants.RETINA else f"_{page_variant}"
+    ext = PageImageFormat.extension(page_format or _page_format(doc, page_number))
+    return os.path.join(
         settings.CACHE_DIR,
         doc.file_hash,
-        f"watermarked_{viewer_token}_page_{page_number}.png"
+        f"watermarked_{cache_scope}_page_{page_number}{variant_suffix}.{ext}"
     )
+
+
+def _load_watermark_settings(db: Session) -> Tuple[WatermarkSettings, Optional[str]]:
+    """Глобальные настройки водяных знаков и путь к статическому водяному знаку"""
+    from app.models.database import GlobalWatermarkSettings, StaticWatermark
     
-    # Если изображение с водяными знаками уже существует, возвращаем его
-    if os.path.exists(watermarked_path):
-        # Читаем файл полностью в память для гарантии правильного Content-Length
-        # Это решает проблему ERR_CONTENT_LENGTH_MISMATCH
-        with open(watermarked_path, 'rb') as f:
-            img_bytes = f.read()
-        
-        from fastapi import Response
-        return Response(
-            content=img_bytes,
-            media_type="image/png",
-            headers={
-                "Content-Length": str(len(img_bytes)),
-                "Cache-Control": "public, max-age=3600",
-                "Accept-Ranges": "bytes"
-            }
+    # Загружаем глобальные настройки водяных знаков
+    watermark_settings = WatermarkSettings()
+    global_settings = db.query(GlobalWatermarkSettings).first()
+    if global_settings and global_settings.settings_json:
+        try:
+            settings_dict = json.loads(global_settings.settings_json)
+            watermark_settings = WatermarkSettings(**settings_dict)
+        except:
+            pass
+    
+    # Получаем путь к статическому водяному знаку, если он указан
+    static_watermark_path = None
+    if watermark_settings.static_watermark_enabled and watermark_settings.static_watermark_id:
+        static_wm = db.query(StaticWatermark).filter(
+            StaticWatermark.id == watermark_settings.static_watermark_id,
+            StaticWatermark.is_active == True
+        ).first()
+        if static_wm and os.path.exists(static_wm.file_path):
+            static_watermark_path = static_wm.file_path
+    
+    return watermark_settings, static_watermark_path
+
+
+def _watermark_render_context(
+    db: Session,
+    session: Optional[ViewingSession]
+) -> Tuple[WatermarkSettings, Optional[str], Optional[str]]:
+    """Настройки серверного рендера, путь к статическому знаку и область кеша
+    
+    Если включена реалтайм анимация, динамический водяной знак рисует клиент
+    (Canvas), а на сервере остается только статический - одинаковый для всех
+    зрителей. Тогда страница рендерится один раз на (документ, страницу,
+    версию настроек) и общий файл отдается всем сессиям; отдельный рендер
+    для сессии нужен, только когда на сервере рисуются данные пользователя.
+    Без сессии (фоновые задачи) область кеша для таких знаков - None.
+    """
+    watermark_settings, static_watermark_path = _load_watermark_settings(db)
+    
+    # Настройки меняются только для серверного рендера
+    watermark_settings = watermark_settings.copy()
+    
+    # Если включена реалтайм анимация динамического водяного знака, не накладываем его на сервере
+    # (он будет отрисовываться на клиенте через Canvas)
+    if getattr(watermark_settings, 'random_positions_enabled', False):
+        watermark_settings.dynamic_watermark_enabled = False
+    
+    if WatermarkService.is_viewer_specific(watermark_settings):
+        cache_scope = session.session_token if session else None
+    else:
+        cache_scope = f"shared_{WatermarkService.settings_version(watermark_settings, static_watermark_path)}"
+    return watermark_settings, static_watermark_path, cache_scope
+
+
+def _session_watermark_inputs(
+    session: ViewingSession,
+    cache_scope: str
+) -> Tuple[Optional[str], Optional[str], Optional[str], str]:
+    """Данные зрителя для водяного знака: (email, user_id, IP, seed позиций)"""
+    # Общий рендер не должен содержать ничего из сессии, в которой он создан
+    viewer_specific = cache_scope == session.session_token
+    
+    # Получаем информацию из сессии (user может быть None в упрощенной версии)
+    return (
+        session.user.email if viewer_specific and session.user else None,
+        str(session.user_id) if viewer_specific and session.user_id else None,
+        (session.ip_address or "127.0.0.1") if viewer_specific else None,
+        str(session.user_id) if session.user_id else session.session_token
+    )
+
+
+def _thumbnail_watermark(
+    watermark_settings: WatermarkSettings,
+    static_watermark_path: Optional[str],
+    watermark_inputs: Tuple[Optional[str], Optional[str], Optional[str], str]
+) -> Callable[[Any, int, float], Any]:
+    """Наложение водяных знаков на миниатюру для ThumbnailSprites.ensure
+    
+    watermark_inputs - результат _session_watermark_inputs; миниатюра
+    выглядит так же, как страница, которую увидит эта сессия.
+    """
+    user_email, user_id, ip_address, random_seed = watermark_inputs
+    
+    def watermark(thumbnail, page_number: int, scale: float):
+        return WatermarkService.apply_watermarks(
+            thumbnail,
+            _scaled_watermark_settings(watermark_settings, scale, random_seed),
+            user_email=user_email,
+            user_id=user_id,
+            ip_address=ip_address,
+            page_number=page_number,
+            static_watermark_path=static_watermark_path
         )
     
-    # Иначе создаем изображение с водяными знаками
-    try:
-        from PIL import Image
-        import json
-        from app.models.database import GlobalWatermarkSettings
-        
-        base_image = Image.open(base_image_path)
-        
-        # Загружаем глобальные настройки водяных знаков
-        watermark_settings = WatermarkSettings()
-        global_settings = db.query(GlobalWatermarkSettings).first()
-        if global_settings and global_settings.settings_json:
-            try:
-                settings_dict = json.loads(global_settings.settings_json)
-                watermark_settings = WatermarkSettings(**settings_dict)
-            except:
-                pass
-        
-        # Получаем путь к статическому водяному знаку, если он указан
-        static_watermark_path = None
-        if watermark_settings.static_watermark_enabled and watermark_settings.static_watermark_id:
-            from app.models.database import StaticWatermark
-            static_wm = db.query(StaticWatermark).filter(
-                StaticWatermark.id == watermark_settings.static_watermark_id,
-                StaticWatermark.is_active == True
-            ).first()
-            if static_wm and os.path.exists(static_wm.file_path):
-                static_watermark_path = static_wm.file_path
+    return watermark
+
+
+def _scaled_watermark_settings(
+    watermark_settings: WatermarkSettings,
+    variant_scale: float,
+    random_seed: str
+) -> WatermarkSettings:
+    """Настройки наложения на копию страницы другого размера (вариант, миниатюру, уровень тайлов)"""
+    # Настройки меняются только для этого рендера
+    watermark_settings = watermark_settings.copy()
+    
+    # Текст водяного знака на варианте должен выглядеть так же, как на исходном растре
+    if variant_scale != 1:
+        watermark_settings.font_size = max(8, round(watermark_settings.font_size * variant_scale))
+    
+    # Устанавливаем seed для детерминированного рандома (чтобы позиции были одинаковыми для одного пользователя)
+    if not getattr(watermark_settings, 'random_seed', None):
+        watermark_settings.random_seed = random_seed
+    return watermark_settings
+
+
+def _render_watermarked_page(
+    output_dir: str,
+    page_number: int,
+    page_variant: str,
+    image_format: str,
+    watermark_settings: WatermarkSettings,
+    static_watermark_path: Optional[str],
+    user_email: Optional[str],
+    user_id: Optional[str],
+    ip_address: str,
+    random_seed: str,
+    watermarked_path: str
+) -> bytes:
+    """Наложение водяных знаков на вариант страницы; результат кешируется на диске
+    
+    watermark_settings - уже подготовленные настройки серверного рендера
+    (см. _watermark_render_context). Одну страницу могут одновременно
+    рендерить несколько воркеров uvicorn: рендерит тот, кто первым взял
+    блокировку на файле рядом с кешем, остальные дожидаются ее и читают
+    его результат.
+    """
+    from PIL import Image
+    
+    with file_lock(cache_lock_path(output_dir, os.path.basename(watermarked_path))):
+        # Пока ждали блокировку, страницу мог отрендерить другой воркер
+        img_bytes = _read_cached_file(watermarked_path)
+        if img_bytes is not None:
+            return img_bytes
         
-        # Получаем информацию из сессии (user может быть None в упрощенной версии)
-        user_email = session.user.email if session.user else None
-        ip_address = session.ip_address or "127.0.0.1"
+        base_image_path = PageVariants.variant_path(
+            output_dir, page_number, PageVariants.RETINA, image_format
+        )
+        variant_path = PageVariants.ensure_variant(output_dir, page_number, page_variant, image_format)
+        with Image.open(variant_path or base_image_path) as base_image:
+            with Image.open(base_image_path) as full_image:
+                # Во сколько раз вариант меньше исходного растра (для размера шрифта)
+                variant_scale = base_image.width / full_image.width
+            
+            watermark_settings = _scaled_watermark_settings(watermark_settings, variant_scale, random_seed)
+            
+            # Применяем водяные знаки (только статический, если динамический отключен для анимации)
+            watermarked_image = WatermarkService.apply_watermarks(
+                base_image,
+                watermark_settings,
+                user_email=user_email,
+                user_id=user_id,
+                ip_address=ip_address,
+                page_number=page_number,
+                static_watermark_path=static_watermark_path
+            )
         
-        # Если включена реалтайм анимация динамического водяного знака, не накладываем его на сервере
-        # (он будет отрисовываться на клиенте через Canvas)
-        apply_dynamic_on_server = True
-        if hasattr(watermark_settings, 'random_positions_enabled') and watermark_settings.random_positions_enabled:
-            # Если включена анимация, динамический водяной знак не накладываем на сервере
-            apply_dynamic_on_server = False
+        # Кодируем в памяти сначала, чтобы получить точный размер
+        img_bytes = PageImageFormat.encode(watermarked_image, image_format)
         
-        # Временно отключаем динамический водяной знак для применения на сервере, если включена анимация
-        original_dynamic_enabled = watermark_settings.dynamic_watermark_enabled
-        if not apply_dynamic_on_server:
-            watermark_settings.dynamic_watermark_enabled = False
+        # Сохраняем на диск для кеширования (общий файл могут читать другие сессии -
+        # пишем атомарно, чтобы никто не прочитал недописанный файл)
+        try:
+            PageImageFormat.write_atomic(img_bytes, watermarked_path)
+        except Exception as e:
+            print(f"[WARN] Failed to save watermarked image to cache: {e}")
         
-        # Устанавливаем seed для детерминированного рандома (чтобы позиции были одинаковыми для одного пользователя)
-        if not hasattr(watermark_settings, 'random_seed') or not watermark_settings.random_seed:
-            watermark_settings.random_seed = str(session.user_id) if session.user_id else session.session_token
+        return img_bytes
+
+
+async def _get_watermarked_page(
+    db: Session,
+    doc: Document,
+    session: ViewingSession,
+    page_number: int,
+    page_variant: str,
+    context: Optional[Tuple[WatermarkSettings, Optional[str], str]] = None,
+    memory_checked: bool = False
+) -> Tuple[bytes, dict]:
+    """Страница с водяными знаками для сессии и ее метаданные
+    
+    Метаданные - {"format", "etag", "last_modified"} (см. _page_validators),
+    они хранятся в кеше в памяти вместе со страницей. Порядок поиска: кеш
+    в памяти процесса, файл на диске, свежий рендер. Чтение файла и запросы
+    к базе идут в пуле потоков, рендер - в пуле рендера, так что event loop
+    не блокируется. context - результат _watermark_render_context, если он
+    уже получен; memory_checked - кеш в памяти уже проверен вызывающим.
+    """
+    context = context or await run_in_threadpool(_watermark_render_context, db, session)
+    watermark_settings, static_watermark_path, cache_scope = context
+    memory_key = (doc.file_hash, page_number, page_variant, cache_scope)
+    if not memory_checked:
+        cached = page_response_cache.get(memory_key)
+        if cached:
+            return cached
+    
+    await _ensure_base_page(doc, page_number)
+    # Формат страницы в режиме "auto" читается из манифеста на диске
+    page_format = await run_in_threadpool(_page_format, doc, page_number)
+    watermarked_path = _watermarked_page_path(doc, cache_scope, page_number, page_variant, page_format)
+    
+    # Если изображение с водяными знаками уже существует, возвращаем его
+    # (файл читается полностью в память для гарантии правильного Content-Length -
+    # это решает проблему ERR_CONTENT_LENGTH_MISMATCH)
+    img_bytes = await run_in_threadpool(_read_cached_file, watermarked_path)
+    if img_bytes is not None:
+        meta = await run_in_threadpool(_page_cache_meta, doc, page_number, page_variant, context)
+        page_response_cache.put(memory_key, img_bytes, meta)
+        return img_bytes, meta
+    
+    # Иначе создаем изображение с водяными знаками
+    async def render() -> Tuple[bytes, dict]:
+        user_email, user_id, ip_address, random_seed = await run_in_threadpool(
+            _session_watermark_inputs, session, cache_scope
+        )
+        try:
+            img_bytes = await _run_render(
+                _render_watermarked_page,
+                os.path.join(settings.CACHE_DIR, doc.file_hash),
+                page_number,
+                page_variant,
+                page_format,
+                watermark_settings,
+                static_watermark_path,
+                user_email,
+                user_id,
+                ip_address,
+                random_seed,
+                watermarked_path
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Ошибка обработки изображения: {str(e)}")
         
-        # Применяем водяные знаки (только статический, если динамический отключен для анимации)
-        watermarked_image = WatermarkService.apply_watermarks(
-            base_image,
-            watermark_settings,
+        meta = await run_in_threadpool(_page_cache_meta, doc, page_number, page_variant, context)
+        page_response_cache.put(memory_key, img_bytes, meta)
+        return img_bytes, meta
+    
+    # Одновременные запросы одной страницы (предзагрузка следующей страницы,
+    # двойной клик "далее") ждут один рендер вместо того, чтобы повторять его
+    return await page_render_flights.run(memory_key, render)
+
+
+def _render_deep_tile_level(
+    file_path: str,
+    file_type: str,
+    output_dir: str,
+    page_number: int,
+    page_size: Tuple[int, int],
+    tiles_dir: str,
+    level: int,
+    image_format: str,
+    watermark_settings: WatermarkSettings,
+    static_watermark_path: Optional[str],
+    watermark_inputs: Tuple[Optional[str], Optional[str], Optional[str], str]
+) -> bool:
+    """Уровень тайлов крупнее растра страницы: растеризация из PDF с большим DPI
+    
+    page_size - размер базового растра страницы. Водяные знаки накладываются
+    на весь уровень в его масштабе, так что на тайлах они совпадают со
+    страницей.
+    """
+    from app.services.rasterizers import Rasterizers
+    
+    user_email, user_id, ip_address, random_seed = watermark_inputs
+    pdf_path = DocumentConverter.get_source_pdf_path(file_path, file_type)
+    if not os.path.exists(pdf_path):
+        return False
+    
+    def render(level_width: int, level_height: int):
+        zoom = level_width / page_size[0]
+        entry = PageManifest.get_page(output_dir, page_number) or {}
+        page_dpi = entry.get("dpi") or DocumentConverter.render_dpi(file_type)
+        images = Rasterizers.get(entry.get("rasterizer")).render(
+            pdf_path,
+            page_number,
+            page_number,
+            round(page_dpi * zoom),
+            timeout=settings.PAGE_RENDER_TIMEOUT
+        )
+        if not images:
+            raise HTTPException(status_code=404, detail="Тайл не найден")
+        for extra in images[1:]:
+            extra.close()
+        level_image = images[0] if images[0].mode == 'RGB' else images[0].convert('RGB')
+        return WatermarkService.apply_watermarks(
+            level_image,
+            _scaled_watermark_settings(watermark_settings, zoom, random_seed),
             user_email=user_email,
-            user_id=str(session.user_id) if session.user_id else None,
+            user_id=user_id,
             ip_address=ip_address,
             page_number=page_number,
             static_watermark_path=static_watermark_path
         )
+    
+    return TilePyramid.ensure_deep_level(tiles_dir, level, page_size[0], page_size[1], render, image_format)
+
+
+def _render_watermarked_pages_batch(
+    output_dir: str,
+    pages: List[Tuple[int, str, str]],
+    page_variant: str,
+    watermark_settings: WatermarkSettings,
+    static_watermark_path: Optional[str],
+    user_email: Optional[str],
+    user_id: Optional[str],
+    ip_address: Optional[str],
+    random_seed: str,
+    on_progress: Optional[Callable[[int], None]] = None
+) -> int:
+    """Наложение водяных знаков сразу на много страниц; результаты кешируются на диске
+    
+    pages - (номер, формат страницы, путь результата). Страницы группируются
+    по размеру варианта, ширине исходного растра (от нее зависит размер
+    шрифта) и режиму, декодируются в стопку NumPy не больше WATERMARK_BATCH_MB,
+    обрабатываются WatermarkService.apply_watermarks_batch и кодируются
+    параллельно. Каждая страница получается такой же, как у
+    _render_watermarked_page. Возвращает число записанных страниц.
+    """
+    import numpy as np
+    from PIL import Image
+    
+    groups: Dict[tuple, List[Tuple[int, str, str, str]]] = {}
+    for page_number, page_format, watermarked_path in pages:
+        base_image_path = PageVariants.variant_path(output_dir, page_number, PageVariants.RETINA, page_format)
+        source_path = PageVariants.ensure_variant(output_dir, page_number, page_variant, page_format) or base_image_path
+        try:
+            # Открытие читает только заголовки, пиксели декодируются позже, пачкой
+            with Image.open(base_image_path) as full_image, Image.open(source_path) as image:
+                key = (image.size, full_image.width, 'L' if image.mode in ('L', '1') else 'RGB')
+        except OSError as e:
+            print(f"[WARN] Watermark batch: page {page_number} skipped: {e}")
+            continue
+        groups.setdefault(key, []).append((page_number, page_format, watermarked_path, source_path))
+    
+    written = 0
+    for (image_size, full_width, mode), group in groups.items():
+        # Те же настройки, что у _render_watermarked_page для страницы такого размера
+        group_settings = _scaled_watermark_settings(watermark_settings, image_size[0] / full_width, random_seed)
         
-        # Восстанавливаем настройку
-        watermark_settings.dynamic_watermark_enabled = original_dynamic_enabled
-        
-        # Сохраняем в BytesIO сначала, чтобы получить точный размер
-        import io
-        img_io = io.BytesIO()
-        watermarked_image.save(img_io, 'PNG', quality=95, optimize=True)
-        img_bytes = img_io.getvalue()
-        img_size = len(img_bytes)
+        plan = WatermarkService.get_plan(group_settings, image_size, static_watermark_path)
+        is_gray = mode == 'L' and WatermarkService.keeps_grayscale(group_settings, plan)
+        page_shape = (image_size[1], image_size[0]) + (() if is_gray else (3,))
+        per_batch = max(1, settings.WATERMARK_BATCH_MB * 1024 * 1024 // int(np.prod(page_shape)))
         
-        # Сохраняем на диск для кеширования
+        for start in range(0, len(group), per_batch):
+            chunk = group[start:start + per_batch]
+            stack = np.empty((len(chunk),) + page_shape, dtype=np.uint8)
+            for index, (_, _, _, source_path) in enumerate(chunk):
+                with Image.open(source_path) as image:
+                    stack[index] = np.asarray(image.convert('L' if is_gray else 'RGB'))
+            
+            WatermarkService.apply_watermarks_batch(
+                stack,
+                group_settings,
+                [page_number for page_number, _, _, _ in chunk],
+                user_email=user_email,
+                user_id=user_id,
+                ip_address=ip_address,
+                static_watermark_path=static_watermark_path
+            )
+            encoded = PageImageFormat.encode_many(
+                [(Image.fromarray(stack[index]), page_format) for index, (_, page_format, _, _) in enumerate(chunk)],
+                settings.WATERMARK_ENCODE_WORKERS
+            )
+            del stack
+            
+            for (page_number, _, watermarked_path, _), img_bytes in zip(chunk, encoded):
+                try:
+                    PageImageFormat.write_atomic(img_bytes, watermarked_path)
+                    written += 1
+                except Exception as e:
+                    print(f"[WARN] Failed to save watermarked page {page_number} to cache: {e}")
+            if on_progress:
+                on_progress(len(chunk))
+    
+    return written
+
+
+def _prewarm_watermarked_pages(
+    job: ConversionJob,
+    document_id: int,
+    session_token: str,
+    page_variant: str
+) -> int:
+    """Задача пула: все еще не закешированные страницы документа с водяными знаками сессии
+    
+    Страницы рендерятся пакетами (_render_watermarked_pages_batch); в ленивом
+    режиме недостающие растры сначала растеризуются.
+    """
+    db = SessionLocal()
+    try:
+        doc = db.query(Document).filter(Document.id == document_id).first()
+        session = db.query(ViewingSession).filter(ViewingSession.session_token == session_token).first()
+        if not doc or not session:
+            raise Exception("Документ или сессия не найдены")
+        watermark_settings, static_watermark_path, cache_scope = _watermark_render_context(db, session)
+        user_email, user_id, ip_address, random_seed = _session_watermark_inputs(session, cache_scope)
+    finally:
+        db.close()
+    
+    output_dir = os.path.join(settings.CACHE_DIR, doc.file_hash)
+    base_dpi = DocumentConverter.render_dpi(doc.file_type)
+    pending = []
+    for page_number in range(1, (doc.total_pages or 0) + 1):
+        if not DocumentConverter.rendered_page_path(output_dir, page_number, doc.image_format, base_dpi):
+            if not DocumentConverter.ensure_page(
+                doc.file_path, doc.file_type, output_dir, page_number, doc.image_format
+            ):
+                continue
+        watermarked_path = _watermarked_page_path(doc, cache_scope, page_number, page_variant)
+        if not os.path.exists(watermarked_path):
+            pending.append((page_number, _page_format(doc, page_number), watermarked_path))
+    
+    job.report_progress(0, len(pending))
+    
+    def on_progress(count: int):
+        job.report_progress(job.pages_converted + count)
+    
+    written = _render_watermarked_pages_batch(
+        output_dir,
+        pending,
+        page_variant,
+        watermark_settings,
+        static_watermark_path,
+        user_email,
+        user_id,
+        ip_address,
+        random_seed,
+        on_progress
+    )
+    print(f"[WATERMARK] Prewarmed {written}/{len(pending)} pages of document {document_id} ({page_variant}, {cache_scope})")
+    return document_id
+
+
+@router.post("/{document_id}/prewarm")
+async def prewarm_watermarked_pages(
+    document_id: int,
+    viewer_token: str,
+    request: Request,
+    width: Optional[int] = None,
+    dpr: Optional[float] = None,
+    variant: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """Прогрев кеша страниц с водяными знаками для сессии
+    
+    Все страницы документа обрабатываются в фоне пакетами вместо отдельного
+    рендера на каждый запрос страницы. Вариант разрешения выбирается так же,
+    как у страницы. Возвращает задачу (ее состояние - /api/documents/jobs/{id});
+    повторный запрос, пока задача идет, присоединяется к ней.
+    """
+    doc, session = _authorize_document_request(request, document_id, viewer_token, db)
+    if doc.status != Document.READY:
+        raise HTTPException(status_code=409, detail="Документ еще не готов")
+    
+    page_variant, _ = _select_page_variant(request, width, dpr, variant)
+    _, _, cache_scope = _watermark_render_context(db, session)
+    job, _ = maintenance_jobs.submit(
+        doc.file_hash,
+        _prewarm_watermarked_pages,
+        doc.id,
+        session.session_token,
+        page_variant,
+        job_type=ConversionJob.PREWARM,
+        task_key=f"{cache_scope}:{page_variant}"
+    )
+    return _job_response(job)
+
+
+def _page_validators(
+    doc: Document,
+    page_number: int,
+    page_variant: str,
+    context: Tuple[WatermarkSettings, Optional[str], str]
+) -> Tuple[Optional[str], Optional[float]]:
+    """Валидаторы страницы с водяными знаками: (сильный ETag, время изменения)
+    
+    ETag - хеш ключа рендера: документ, страница, вариант, формат, отпечаток
+    растра страницы (sha256 из манифеста), версия настроек и логотипа,
+    область кеша (у персональных знаков это сессия, а значит и данные
+    зрителя). Вычисляется без чтения и рендера страницы; None - растра
+    еще нет или он устарел. Время изменения - mtime файла кеша (None -
+    страница еще не рендерилась).
+    """
+    import hashlib
+    
+    output_dir = os.path.join(settings.CACHE_DIR, doc.file_hash)
+    watermark_settings, static_watermark_path, cache_scope = context
+    
+    etag = None
+    base_image_path = DocumentConverter.rendered_page_path(
+        output_dir, page_number, doc.image_format, DocumentConverter.render_dpi(doc.file_type)
+    )
+    if base_image_path:
+        entry = PageManifest.get_page(output_dir, page_number)
+        fingerprint = entry.get("sha256") if entry else None
+        if not fingerprint:
+            # Страница без записи в манифесте (кеш до появления манифеста) - по файлу
+            try:
+                stat = os.stat(base_image_path)
+                fingerprint = f"{stat.st_mtime_ns}:{stat.st_size}"
+            except OSError:
+                fingerprint = None
+        if fingerprint:
+            render_key = json.dumps([
+                doc.file_hash,
+                page_number,
+                page_variant,
+                _page_format(doc, page_number),
+                fingerprint,
+                WatermarkService.settings_version(watermark_settings, static_watermark_path),
+                cache_scope,
+            ])
+            etag = f'"{hashlib.sha256(render_key.encode()).hexdigest()[:32]}"'
+    
+    try:
+        last_modified = os.stat(_watermarked_page_path(doc, cache_scope, page_number, page_variant)).st_mtime
+    except OSError:
+        last_modified = None
+    return etag, last_modified
+
+
+def _page_cache_meta(
+    doc: Document,
+    page_number: int,
+    page_variant: str,
+    context: Tuple[WatermarkSettings, Optional[str], str]
+) -> dict:
+    """Метаданные страницы для кеша в памяти: формат и валидаторы ответа"""
+    etag, last_modified = _page_validators(doc, page_number, page_variant, context)
+    return {
+        "format": _page_format(doc, page_number),
+        "etag": etag,
+        "last_modified": last_modified
+    }
+
+
+def _is_not_modified(request: Request, etag: Optional[str], last_modified: Optional[float]) -> bool:
+    """Проверка If-None-Match / If-Modified-Since (при If-None-Match дата не учитывается)"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if etag is None:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+    
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
         try:
-            with open(watermarked_path, 'wb') as f:
-                f.write(img_bytes)
-        except Exception as e:
-            print(f"[WARN] Failed to save watermarked image to cache: {e}")
-        
-        # Возвращаем Response с байтами из памяти - это гарантирует правильный Content-Length
-        from fastapi import Response
-        return Response(
-            content=img_bytes,
-            media_type="image/png",
-            headers={
-                "Content-Length": str(img_size),
-                "Cache-Control": "public, max-age=3600",
-                "Accept-Ranges": "bytes"
-            }
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(last_modified) <= since
+    return False
+
+
+def _if_range_matches(request: Request, etag: Optional[str], last_modified: Optional[float]) -> bool:
+    """If-Range: диапазон отдается, только если у клиента та же версия ответа"""
+    if_range = request.headers.get("if-range")
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        # Слабые ETag для If-Range не подходят
+        return etag is not None and if_range == etag
+    if last_modified is None:
+        return False
+    try:
+        return int(last_modified) == int(parsedate_to_datetime(if_range).timestamp())
+    except (TypeError, ValueError):
+        return False
+
+
+def _parse_byte_range(range_header: str, total: int) -> Optional[Tuple[int, int]]:
+    """Диапазон из заголовка Range: (первый, последний байт включительно)
+    
+    None - заголовок не разобран или диапазонов несколько (тогда отдается
+    весь ответ); диапазон за пределами ответа - 416.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, separator, last = spec.strip().partition("-")
+    if not separator:
+        return None
+    try:
+        if first == "":
+            # Последние N байт (bytes=-N)
+            length = int(last)
+            start, end = max(0, total - length), total - 1
+            satisfiable = length > 0
+        else:
+            start = int(first)
+            end = int(last) if last else max(start, total - 1)
+            if end < start:
+                return None
+            end = min(end, total - 1)
+            satisfiable = start < total
+    except ValueError:
+        return None
+    
+    if not satisfiable or total == 0:
+        raise HTTPException(
+            status_code=416,
+            detail="Запрошенный диапазон недоступен",
+            headers={"Content-Range": f"bytes */{total}"}
         )
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Ошибка обработки изображения: {str(e)}")
+    return start, end
+
+
+@router.get("/{document_id}/page/{page_number}")
+async def get_page_image(
+    document_id: int,
+    page_number: int,
+    viewer_token: str,
+    request: Request,
+    width: Optional[int] = None,
+    dpr: Optional[float] = None,
+    variant: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """Получение изображения страницы с водяными знаками
+    
+    Разрешение выбирается по variant, либо по width (CSS пиксели) и dpr,
+    либо по client hints (Sec-CH-Viewport-Width / Sec-CH-DPR), либо по User-Agent.
+    Ответ несет ETag и Last-Modified; на совпавший If-None-Match или
+    If-Modified-Since отдается 304 без чтения и рендера страницы. Для
+    страницы из кеша в памяти валидаторы берутся из него же, без обращения
+    к файлам. Поддерживается Range (один диапазон) и If-Range.
+    """
+    doc, session = await run_in_threadpool(
+        _authorize_page_request, request, document_id, page_number, viewer_token, db
+    )
+    page_variant, vary_headers = _select_page_variant(request, width, dpr, variant)
+    context = await run_in_threadpool(_watermark_render_context, db, session)
+    cached = page_response_cache.get((doc.file_hash, page_number, page_variant, context[2]))
+    if cached:
+        etag, last_modified = cached[1]["etag"], cached[1]["last_modified"]
+    else:
+        etag, last_modified = await run_in_threadpool(_page_validators, doc, page_number, page_variant, context)
+    
+    response_headers = {
+        "Cache-Control": "public, max-age=3600",
+        "Accept-Ranges": "bytes"
+    }
+    if vary_headers:
+        response_headers["Vary"] = ", ".join(vary_headers)
+    if doc.status == Document.CONVERTING:
+        ready_pages = await run_in_threadpool(get_ready_pages, doc)
+        response_headers["X-Pages-Ready"] = str(len(ready_pages))
+    
+    if etag and _is_not_modified(request, etag, last_modified):
+        response_headers["ETag"] = etag
+        if last_modified is not None:
+            response_headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+        return Response(status_code=304, headers=response_headers)
+    
+    img_bytes, meta = cached or await _get_watermarked_page(
+        db, doc, session, page_number, page_variant, context, memory_checked=True
+    )
+    page_format = meta["format"]
+    # Страница могла быть только что растеризована или отрендерена
+    etag, last_modified = meta["etag"], meta["last_modified"]
+    if etag:
+        response_headers["ETag"] = etag
+    if last_modified is not None:
+        response_headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+    
+    status_code = 200
+    content = img_bytes
+    range_header = request.headers.get("range")
+    if range_header and _if_range_matches(request, etag, last_modified):
+        byte_range = _parse_byte_range(range_header, len(img_bytes))
+        if byte_range:
+            start, end = byte_range
+            status_code = 206
+            content = img_bytes[start:end + 1]
+            response_headers["Content-Range"] = f"bytes {start}-{end}/{len(img_bytes)}"
+    response_headers["Content-Length"] = str(len(content))
+    
+    # Возвращаем Response с байтами из памяти - это гарантирует правильный Content-Length
+    return Response(
+        content=content,
+        status_code=status_code,
+        media_type=PageImageFormat.media_type(page_format),
+        headers=response_headers
+    )
+
+
+@router.get("/{document_id}/page/{page_number}/tiles.json")
+async def get_page_tiles_descriptor(
+    document_id: int,
+    page_number: int,
+    viewer_token: str,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """Описание пирамиды тайлов страницы (DZI в JSON-формате)"""
+    doc, session = await run_in_threadpool(
+        _authorize_page_request, request, document_id, page_number, viewer_token, db
+    )
+    base_image_path = await _ensure_base_page(doc, page_number)
+    page_width, page_height = await run_in_threadpool(_read_image_size, base_image_path)
+    page_format = await run_in_threadpool(_page_format, doc, page_number)
+    # Без исходного PDF (слайды, сконвертированные без LibreOffice) крупнее растра не растеризовать
+    zoomable = await run_in_threadpool(
+        os.path.exists, DocumentConverter.get_source_pdf_path(doc.file_path, doc.file_type)
+    )
+    
+    return JSONResponse(
+        content=TilePyramid.descriptor(page_width, page_height, page_format, zoomable),
+        headers={"Cache-Control": "public, max-age=3600"}
+    )
+
+
+@router.get("/{document_id}/page/{page_number}/tile/{level}/{x}/{y}")
+async def get_page_tile(
+    document_id: int,
+    page_number: int,
+    level: int,
+    x: int,
+    y: int,
+    viewer_token: str,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """Тайл страницы с водяными знаками
+    
+    Тайлы нарезаются из полноразмерной страницы с водяными знаками этой сессии,
+    поэтому к ним применяются те же правила наложения, что и к целой странице.
+    Уровни крупнее растра страницы растеризуются из PDF с большим DPI
+    (см. TilePyramid.deep_levels) и получают водяные знаки в своем масштабе.
+    """
+    doc, session = await run_in_threadpool(
+        _authorize_page_request, request, document_id, page_number, viewer_token, db
+    )
+    base_image_path = await _ensure_base_page(doc, page_number)
+    page_format = await run_in_threadpool(_page_format, doc, page_number)
+    
+    # Тайлы делятся между сессиями так же, как страница, из которой они нарезаны
+    context = await run_in_threadpool(_watermark_render_context, db, session)
+    tiles_dir = TilePyramid.tiles_dir(
+        os.path.join(settings.CACHE_DIR, doc.file_hash), context[2], page_number
+    )
+    tile_path = TilePyramid.tile_path(tiles_dir, level, x, y, page_format)
+    
+    tile_bytes = await run_in_threadpool(_read_cached_file, tile_path)
+    if tile_bytes is None:
+        page_size = await run_in_threadpool(_read_image_size, base_image_path)
+        if level > TilePyramid.max_level(*page_size):
+            watermark_inputs = await run_in_threadpool(_session_watermark_inputs, session, context[2])
+            generated = await _run_render(
+                _render_deep_tile_level,
+                doc.file_path,
+                doc.file_type,
+                os.path.join(settings.CACHE_DIR, doc.file_hash),
+                page_number,
+                page_size,
+                tiles_dir,
+                level,
+                page_format,
+                context[0],
+                context[1],
+                watermark_inputs
+            )
+        else:
+            page_bytes, _ = await _get_watermarked_page(
+                db, doc, session, page_number, PageVariants.RETINA, context
+            )
+            generated = await _run_render(
+                TilePyramid.ensure_level, page_bytes, tiles_dir, level, page_format
+            )
+        tile_bytes = await run_in_threadpool(_read_cached_file, tile_path) if generated else None
+        if tile_bytes is None:
+            raise HTTPException(status_code=404, detail="Тайл не найден")
+    
+    return Response(
+        content=tile_bytes,
+        media_type=PageImageFormat.media_type(page_format),
+        headers={
+            "Content-Length": str(len(tile_bytes)),
+            "Cache-Control": "public, max-age=3600"
+        }
+    )
+
+
+@router.get("/{document_id}/thumbnails.json")
+async def get_thumbnail_index(
+    document_id: int,
+    viewer_token: str,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """Индекс спрайтов миниатюр документа
+    
+    Координаты миниатюры каждой растеризованной страницы в спрайтах и версии
+    спрайтов: сами спрайты запрашиваются по /thumbnails/{version}/{sheet}.
+    На миниатюры накладываются те же водяные знаки, что на страницы этой
+    сессии. Пока документ конвертируется, в индекс попадают только готовые
+    страницы.
+    """
+    doc, session = await run_in_threadpool(_authorize_document_request, request, document_id, viewer_token, db)
+    watermark_settings, static_watermark_path, cache_scope = await run_in_threadpool(
+        _watermark_render_context, db, session
+    )
+    output_dir = os.path.join(settings.CACHE_DIR, doc.file_hash)
+    index, groups, versions, source = await run_in_threadpool(
+        ThumbnailSprites.plan,
+        output_dir,
+        doc.total_pages,
+        doc.image_format,
+        cache_scope,
+        WatermarkService.settings_version(watermark_settings, static_watermark_path)
+    )
+    
+    if index is None:
+        watermark_inputs = await run_in_threadpool(_session_watermark_inputs, session, cache_scope)
+        watermark = _thumbnail_watermark(watermark_settings, static_watermark_path, watermark_inputs)
+        # Каждый спрайт - отдельная задача пула, чтобы не занимать его на весь документ
+        sheets = {}
+        for sheet_number, group in sorted(groups.items()):
+            sheets[sheet_number] = await _run_render(
+                ThumbnailSprites.build_sheet,
+                output_dir,
+                cache_scope,
+                sheet_number,
+                versions[sheet_number],
+                group,
+                watermark
+            )
+        index = await run_in_threadpool(ThumbnailSprites.write_index, output_dir, cache_scope, source, sheets)
+    
+    return JSONResponse(
+        content={**index, "total_pages": doc.total_pages, "status": doc.status},
+        headers={"Cache-Control": "private, no-cache"}
+    )
+
+
+@router.get("/{document_id}/thumbnails/{version}/{sheet}")
+async def get_thumbnail_sprite(
+    document_id: int,
+    version: str,
+    sheet: int,
+    viewer_token: str,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """Спрайт миниатюр; версия спрайтов из индекса делает ответ неизменным"""
+    doc, session = await run_in_threadpool(_authorize_document_request, request, document_id, viewer_token, db)
+    if not version.isalnum() or sheet < 0:
+        raise HTTPException(status_code=404, detail="Спрайт не найден")
+    
+    # Спрайт из той же области кеша, что и индекс, по которому его запросили
+    _, _, cache_scope = await run_in_threadpool(_watermark_render_context, db, session)
+    sprite_path = ThumbnailSprites.sheet_path(
+        os.path.join(settings.CACHE_DIR, doc.file_hash), cache_scope, version, sheet
+    )
+    sprite_bytes = await run_in_threadpool(_read_cached_file, sprite_path)
+    if sprite_bytes is None:
+        # Спрайты пересобраны под новой версией - клиент перечитает индекс
+        raise HTTPException(status_code=404, detail="Спрайт не найден")
+    
+    return Response(
+        content=sprite_bytes,
+        media_type=PageImageFormat.media_type(settings.THUMBNAIL_SPRITE_FORMAT),
+        headers={
+            "Content-Length": str(len(sprite_bytes)),
+            "Cache-Control": THUMBNAIL_SPRITE_CACHE_CONTROL
+        }
+    )
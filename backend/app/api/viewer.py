@@ -6,8 +6,9 @@ from datetime import datetime, timedelta
 from fastapi import APIRouter, HTTPException, Depends, Request, Body
 from fastapi.responses import HTMLResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from pathlib import Path
 from urllib.parse import urlparse
 from sqlalchemy.orm import Session
@@ -31,6 +32,61 @@ def is_mobile_device(user_agent: Optional[str]) -> bool:
     return any(keyword in user_agent_lower for keyword in mobile_keywords)
 
 
+def get_page_base_width(doc: Document) -> Optional[int]:
+    """Ширина исходного растра первой страницы (None, если еще не отрендерена)"""
+    from PIL import Image
+    import os
+    from app.services.converter import DocumentConverter
+    
+    page_path = DocumentConverter.rendered_page_path(
+        os.path.join(settings.CACHE_DIR, doc.file_hash), 1, doc.image_format
+    )
+    if not page_path:
+        return None
+    try:
+        with Image.open(page_path) as img:
+            return img.width
+    except Exception:
+        return None
+
+
+def get_ready_pages(doc: Document) -> List[int]:
+    """Страницы, которые уже можно показывать
+    
+    Пока документ конвертируется - только записанные в манифест страницы,
+    после конвертации - все (в ленивом режиме они рендерятся по требованию).
+    """
+    import os
+    from app.services.page_manifest import PageManifest
+    
+    if doc.status != Document.CONVERTING:
+        return list(range(1, doc.total_pages + 1))
+    return [
+        page_number
+        for page_number in PageManifest.rendered_pages(os.path.join(settings.CACHE_DIR, doc.file_hash))
+        if page_number <= doc.total_pages
+    ]
+
+
+def remove_session_caches(file_hash: str, session_token: str):
+    """Удаление кеша, собранного для одной сессии: страниц с ее водяными знаками, тайлов и миниатюр"""
+    import glob
+    import os
+    import shutil
+    from app.utils.helpers import remove_cache_locks
+    
+    doc_cache_path = os.path.join(settings.CACHE_DIR, file_hash)
+    pattern = f"watermarked_{glob.escape(session_token)}_page_*"
+    for file_path in glob.glob(os.path.join(doc_cache_path, pattern)):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+    shutil.rmtree(os.path.join(doc_cache_path, "tiles", session_token), ignore_errors=True)
+    shutil.rmtree(os.path.join(doc_cache_path, "thumbnails", session_token), ignore_errors=True)
+    remove_cache_locks(doc_cache_path, pattern)
+
+
 def get_client_ip(request: Request) -> str:
     """Получает реальный IP адрес клиента из заголовков"""
     ip_headers = [
@@ -262,12 +318,18 @@ async def create_viewer_token(
     # Это предотвращает переполнение базы данных
     try:
         old_date = datetime.utcnow() - timedelta(days=7)
+        old_sessions = db.query(ViewingSession.session_token, Document.file_hash).join(
+            Document, ViewingSession.document_id == Document.id
+        ).filter(ViewingSession.created_at < old_date).all()
         deleted_count = db.query(ViewingSession).filter(
             ViewingSession.created_at < old_date
         ).delete()
         if deleted_count > 0:
             db.commit()
             print(f"[CLEANUP] Deleted {deleted_count} old viewing sessions")
+            # Страницы и тайлы с водяными знаками этих сессий больше никто не запросит
+            for session_token, file_hash in old_sessions:
+                remove_session_caches(file_hash, session_token)
     except Exception as e:
         print(f"[WARN] Failed to cleanup old sessions: {e}")
         db.rollback()
@@ -408,6 +470,8 @@ async def viewer_page(token: str, request: Request, db: Session = Depends(get_db
             # Это предотвращает mixed content ошибки в Safari на iOS
             response.headers["Content-Security-Policy"] = "upgrade-insecure-requests; default-src https:"
             response.headers["Strict-Transport-Security"] = "max-age=31536000; includeSubDomains"
+            # Просим браузер присылать client hints для выбора разрешения страниц
+            response.headers["Accept-CH"] = "Sec-CH-DPR, Sec-CH-Viewport-Width, DPR, Viewport-Width"
             # Принудительно указываем, что это HTTPS соединение
             if is_mobile:
                 response.headers["X-Content-Type-Options"] = "nosniff"
@@ -506,7 +570,12 @@ async def get_viewer_info(token: str, request: Request, db: Session = Depends(ge
         "user_id": str(session.user_id) if session.user_id else None,
         "ip_address": session.ip_address or "127.0.0.1",
         "expires_at": session.expires_at.isoformat(),
-        "watermark_settings": watermark_settings
+        "watermark_settings": watermark_settings,
+        "page_variants": settings.PAGE_VARIANT_WIDTHS,
+        "page_base_width": await run_in_threadpool(get_page_base_width, doc),
+        "status": doc.status,
+        "ready_pages": await run_in_threadpool(get_ready_pages, doc),
+        "watermark_prewarm": settings.WATERMARK_PREWARM_ON_OPEN
     }
     print(f"[VIEWER INFO] Returning data. Document ID: {doc.id}, Total pages: {doc.total_pages}")
     return result
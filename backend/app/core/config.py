@@ -2,7 +2,7 @@
 Конфигурация приложения
 """
 from pydantic_settings import BaseSettings
-from typing import List, Union
+from typing import Dict, List, Union
 from pydantic import field_validator
 import os
 
@@ -41,6 +41,14 @@ class Settings(BaseSettings):
             return [domain.strip() for domain in v.split(',') if domain.strip()]
         return v
     
+    @field_validator('PAGE_IMAGE_FORMAT', mode='before')
+    @classmethod
+    def parse_page_image_format(cls, v):
+        v = str(v).strip().lower()
+        if v not in ('png', 'png8', 'webp', 'webp_lossy', 'jpeg', 'auto'):
+            raise ValueError(f"Unsupported PAGE_IMAGE_FORMAT: {v}")
+        return v
+    
     @field_validator('REQUIRE_REFERER_CHECK', mode='before')
     @classmethod
     def parse_bool(cls, v):
@@ -50,10 +58,25 @@ class Settings(BaseSettings):
     
     # Файлы
     MAX_FILE_SIZE: int = 50 * 1024 * 1024  # 50MB
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024  # Порция потоковой записи загрузки на диск
+    UPLOAD_SESSION_TTL_HOURS: int = 24  # Сколько хранить брошенную докачиваемую загрузку
+    IMPORT_MAX_FILES: int = 200  # Максимум файлов в одном пакетном импорте (в том числе в ZIP)
+    IMPORT_MAX_ARCHIVE_SIZE: int = 500 * 1024 * 1024  # Максимальный размер ZIP при пакетном импорте
+    IMPORT_MAX_UNPACKED_SIZE: int = 1024 * 1024 * 1024  # Максимальный суммарный размер документов в ZIP после распаковки
     UPLOAD_DIR: str = "uploads"
     CACHE_DIR: str = "cache"
     DATA_DIR: str = "data"
     STATIC_WATERMARK_DIR: str = "static_watermarks"
+    # Кеш готовых страниц с водяными знаками в памяти процесса (перед дисковым кешем)
+    PAGE_RESPONSE_CACHE_MB: int = 256  # Бюджет на процесс (0 - выключен)
+    PAGE_RESPONSE_CACHE_TTL: int = 300  # Сколько секунд запись действительна без проверки диска
+    # Пакетное наложение водяных знаков на весь документ (прогрев кеша для сессии)
+    WATERMARK_BATCH_MB: int = 256  # Объем стопки страниц, обрабатываемой за один проход
+    WATERMARK_ENCODE_WORKERS: int = 0  # Потоков кодирования результата (0 - по числу ядер)
+    WATERMARK_PREWARM_ON_OPEN: bool = False  # Viewer запрашивает прогрев всех страниц при открытии
+    # Рендер страниц по запросам viewer'а - в отдельном пуле потоков вне event loop
+    RENDER_WORKERS: int = 0  # Потоков рендера (0 - по числу ядер)
+    RENDER_QUEUE_SIZE: int = 32  # Сколько рендеров может ждать поток; остальным - 503 с Retry-After
     
     # Водяные знаки
     DEFAULT_WATERMARK_OPACITY: float = 0.25
@@ -65,6 +88,49 @@ class Settings(BaseSettings):
     # Конвертация
     PDF_DPI: int = 200
     PPT_DPI: int = 200
+    # Бюджет растра страницы: DPI плакатов и длинных страниц уменьшается так, чтобы
+    # растр не превышал PAGE_MAX_PIXELS пикселей и PAGE_MAX_EDGE по длинной стороне (0 - без ограничения)
+    PAGE_MAX_PIXELS: int = 8_000_000
+    PAGE_MAX_EDGE: int = 8192
+    # Уменьшенные варианты страниц (ширина в пикселях), исходный растр - вариант "retina"
+    PAGE_VARIANT_WIDTHS: Dict[str, int] = {"thumbnail": 320, "mobile": 960, "desktop": 1600}
+    TILE_SIZE: int = 256  # Размер тайла пирамиды для масштабирования
+    # Уровни пирамиды крупнее растра страницы растеризуются из PDF по запросу:
+    # не крупнее TILE_MAX_ZOOM растров страницы и не больше TILE_MAX_PIXELS пикселей на уровень
+    TILE_MAX_ZOOM: int = 4
+    TILE_MAX_PIXELS: int = 32_000_000
+    # Спрайты миниатюр для навигации: ширина миниатюры, столбцов и страниц в одном спрайте, формат
+    THUMBNAIL_WIDTH: int = 160
+    THUMBNAIL_SPRITE_COLUMNS: int = 10
+    THUMBNAIL_SPRITE_PAGES: int = 200
+    THUMBNAIL_SPRITE_FORMAT: str = "jpeg"
+    # Формат хранения растров страниц: png, png8, webp, webp_lossy, jpeg или auto (выбор по странице)
+    PAGE_IMAGE_FORMAT: str = "png"
+    PAGE_IMAGE_QUALITY: int = 85  # Качество для форматов с потерями (webp_lossy, jpeg)
+    PAGE_PNG8_MIN_PSNR: float = 42.0  # В режиме auto палитра png8 для графики (>256 цветов) - только не хуже этого (дБ)
+    PDF_CHUNK_SIZE: int = 10  # Сколько страниц растеризовать за один проход (ограничивает память)
+    RASTER_WORKERS: int = 0  # Процессов растеризации (0 - по числу доступных ядер)
+    CONVERSION_WORKERS: int = 4  # Сколько документов конвертируется одновременно (растры - в общем пуле RASTER_WORKERS)
+    MAINTENANCE_WORKERS: int = 2  # Потоков для прогрева кеша, перекодирования и перерендера устаревших страниц
+    CONVERSION_MAX_ATTEMPTS: int = 3  # Сколько раз продолжать конвертацию, прерванную перезапуском
+    PAGE_RENDER_TIMEOUT: int = 120  # Таймаут растеризации одной страницы (секунды)
+    PAGE_RENDER_MAX_ATTEMPTS: int = 3  # После стольких неудач подряд страница не рендерится по запросу...
+    PAGE_RENDER_RETRY_HOURS: int = 24  # ...пока с последней неудачи не пройдет столько часов
+    # Бэкенд растеризации: pdftoppm, pdftoppm_raw, pdftoppm_noaa, pdftocairo, pymupdf
+    # или auto (выбранный benchmark_rasterizers.py для типа документа)
+    RASTERIZER_BACKEND: str = "pdftoppm"
+    RASTERIZER_MIN_PSNR: float = 35.0  # Порог качества (дБ к pdftoppm) при выборе бэкенда бенчмарком
+    # Ленивый режим: при загрузке читается только количество страниц,
+    # страницы растеризуются при первом запросе
+    LAZY_RENDERING: bool = False
+    
+    # Пул LibreOffice для PPT/PPTX
+    OFFICE_POOL_SIZE: int = 2  # Сколько конвертаций LibreOffice выполняется одновременно
+    OFFICE_POOL_QUEUE_SIZE: int = 16  # Сколько конвертаций может ждать свободный воркер
+    OFFICE_CONVERSION_TIMEOUT: int = 120  # Таймаут одной конвертации (секунды)
+    OFFICE_WORKER_MAX_CONVERSIONS: int = 50  # Профиль воркера создается заново после N конвертаций
+    OFFICE_WORKER_MAX_MEMORY_MB: int = 1024  # Конвертация прерывается при превышении памяти
+    OFFICE_PROFILE_DIR: str = "/tmp/scs-office-profiles"  # Отдельный профиль на каждого воркера
     
     class Config:
         env_file = ".env"
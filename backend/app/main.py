@@ -12,6 +12,7 @@ from starlette.exceptions import HTTPException as StarletteHTTPException
 from app.core.config import settings
 from app.api import router
 from app.api import viewer as viewer_module
+from app.api.documents import resume_interrupted_conversions
 from app.models.database import init_db
 
 logger = logging.getLogger(__name__)
@@ -87,6 +88,26 @@ class FrameOptionsMiddleware(BaseHTTPMiddleware):
 
 app.add_middleware(FrameOptionsMiddleware)
 
+# Middleware для раннего отказа в слишком больших загрузках
+class UploadSizeLimitMiddleware(BaseHTTPMiddleware):
+    """Отклоняет загрузку по Content-Length до чтения тела запроса"""
+    # Запас на заголовки multipart и текстовые поля формы
+    MULTIPART_OVERHEAD = 64 * 1024
+    
+    async def dispatch(self, request: Request, call_next):
+        if request.method == "POST":
+            limit = None
+            if request.url.path.endswith("/documents/upload"):
+                limit = settings.MAX_FILE_SIZE
+            elif request.url.path.endswith("/documents/import"):
+                limit = settings.IMPORT_MAX_ARCHIVE_SIZE
+            content_length = request.headers.get("Content-Length", "")
+            if limit and content_length.isdigit() and int(content_length) > limit + self.MULTIPART_OVERHEAD:
+                return JSONResponse(status_code=400, content={"detail": "Файл слишком большой"})
+        return await call_next(request)
+
+app.add_middleware(UploadSizeLimitMiddleware)
+
 # Exception handler для логирования всех ошибок
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
@@ -118,6 +139,12 @@ app.include_router(viewer_module.router, prefix="/api/viewer", tags=["viewer"])
 app.include_router(viewer_module.router, prefix="/viewer", tags=["viewer-public"])
 
 
+@app.on_event("startup")
+async def resume_conversions():
+    """Продолжение конвертаций, прерванных перезапуском"""
+    resume_interrupted_conversions()
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
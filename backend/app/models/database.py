@@ -35,6 +35,11 @@ class Document(Base):
     """Модель документа"""
     __tablename__ = "documents"
     
+    # Состояния документа: страницы конвертируются / все готовы / конвертация не удалась
+    CONVERTING = "converting"
+    READY = "ready"
+    FAILED = "failed"
+    
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
     file_path = Column(String, nullable=False)
@@ -43,6 +48,8 @@ class Document(Base):
     total_pages = Column(Integer, nullable=False)
     access_token = Column(String, unique=True, index=True, nullable=False)
     watermark_settings = Column(Text, nullable=True)  # JSON строка
+    image_format = Column(String, nullable=False, default="png")  # Формат растров страниц в кеше
+    status = Column(String, nullable=False, default="ready")  # converting, ready, failed
     created_at = Column(DateTime, default=datetime.utcnow)
     created_by = Column(String, nullable=True)
     
@@ -119,9 +126,37 @@ class AdminUser(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
 
 
+# Колонки, добавленные после первого релиза: (таблица, колонка, DDL для ALTER TABLE)
+_ADDED_COLUMNS = [
+    ("documents", "image_format", "VARCHAR NOT NULL DEFAULT 'png'"),
+    ("documents", "status", "VARCHAR NOT NULL DEFAULT 'ready'"),
+]
+
+
+def _migrate_schema():
+    """Добавление новых колонок в уже существующие таблицы
+    
+    create_all не меняет существующие таблицы, поэтому недостающие колонки
+    добавляются через ALTER TABLE.
+    """
+    from sqlalchemy import inspect, text
+    
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table, column, ddl in _ADDED_COLUMNS:
+            if table not in existing_tables:
+                continue
+            columns = {c["name"] for c in inspector.get_columns(table)}
+            if column not in columns:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+                print(f"[DB] Added column {table}.{column}")
+
+
 def init_db():
     """Инициализация базы данных"""
     Base.metadata.create_all(bind=engine)
+    _migrate_schema()
     
     # Создаем дефолтного админа если его нет
     from app.core.security import get_password_hash
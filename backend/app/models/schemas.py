@@ -57,6 +57,7 @@ class DocumentResponse(BaseModel):
     access_token: str
     created_at: datetime
     watermark_settings: Optional[dict] = None
+    status: str = "ready"  # converting - страницы еще конвертируются
     
     class Config:
         from_attributes = True
@@ -0,0 +1,96 @@
+"""
+Журнал незавершенных конвертаций
+"""
+import os
+import json
+import time
+from typing import List, Optional
+from app.core.config import settings
+
+
+class ConversionJournal:
+    """Незавершенные конвертации в UPLOAD_DIR/.conversions/<file_hash>.json
+
+    Запись появляется при постановке конвертации в очередь и удаляется,
+    когда конвертация завершилась успешно или с ошибкой в самом файле.
+    Если конвертация упала на сбое (таймаут офиса, упавший процесс), процесс
+    упал или контейнер перезапустили, запись остается, и при старте
+    конвертация ставится в очередь снова; уже растеризованные страницы
+    при этом не рендерятся повторно. attempts ограничивает число запусков,
+    чтобы документ, который раз за разом не конвертируется, не
+    перезапускался бесконечно.
+    """
+
+    @staticmethod
+    def _dir() -> str:
+        path = os.path.join(settings.UPLOAD_DIR, ".conversions")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @staticmethod
+    def _path(file_hash: str) -> str:
+        return os.path.join(ConversionJournal._dir(), f"{file_hash}.json")
+
+    @staticmethod
+    def _write(entry: dict):
+        path = ConversionJournal._path(entry["file_hash"])
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def record(
+        file_hash: str,
+        file_path: str,
+        file_type: str,
+        output_dir: str,
+        name: str,
+        watermark_config: Optional[dict]
+    ):
+        """Запись о конвертации, поставленной в очередь"""
+        ConversionJournal._write({
+            "file_hash": file_hash,
+            "file_path": file_path,
+            "file_type": file_type,
+            "output_dir": output_dir,
+            "name": name,
+            "watermark_config": watermark_config,
+            "attempts": 0,
+            "created_at": time.time(),
+        })
+
+    @staticmethod
+    def start_attempt(file_hash: str):
+        """Отметка о начале очередного запуска конвертации"""
+        entry = ConversionJournal.get(file_hash)
+        if entry:
+            entry["attempts"] = entry.get("attempts", 0) + 1
+            ConversionJournal._write(entry)
+
+    @staticmethod
+    def get(file_hash: str) -> Optional[dict]:
+        try:
+            with open(ConversionJournal._path(file_hash), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def remove(file_hash: str):
+        try:
+            os.remove(ConversionJournal._path(file_hash))
+        except OSError:
+            pass
+
+    @staticmethod
+    def pending() -> List[dict]:
+        """Все незавершенные конвертации (в порядке постановки в очередь)"""
+        entries = []
+        journal_dir = ConversionJournal._dir()
+        for filename in os.listdir(journal_dir):
+            if filename.endswith(".json"):
+                entry = ConversionJournal.get(filename[:-len(".json")])
+                if entry:
+                    entries.append(entry)
+        return sorted(entries, key=lambda entry: entry.get("created_at", 0))
@@ -2,77 +2,644 @@
 Сервис конвертации документов в изображения
 """
 import os
+import re
+import math
+import time
+import hashlib
 import subprocess
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import List
-from pdf2image import convert_from_path
+from typing import Callable, Dict, List, Optional, Tuple
+from pdf2image import pdfinfo_from_path
 from pptx import Presentation
 from PIL import Image
 from app.core.config import settings
+from app.services.image_formats import PageImageFormat
+from app.services.office_pool import OfficeNotInstalledError, office_pool
+from app.services.page_manifest import PageManifest
+from app.services.page_variants import PageVariants
+from app.services.rasterizers import Rasterizers
+from app.services.response_cache import page_response_cache
+from app.utils.helpers import get_keyed_lock, remove_cache_locks
 
 
 class DocumentConverter:
     """Конвертер документов в изображения"""
     
+    # Увеличивается при изменениях конвертера, после которых старые растры нужно перерендерить
+    CONVERTER_VERSION = 1
+    
+    @staticmethod
+    def get_pdf_page_count(pdf_path: str) -> int:
+        """Количество страниц PDF из метаданных (без растеризации)"""
+        info = pdfinfo_from_path(pdf_path)
+        return int(info["Pages"])
+    
+    @staticmethod
+    def get_pdf_page_sizes(pdf_path: str, first_page: int, last_page: int) -> Dict[int, Tuple[float, float]]:
+        """Размеры страниц PDF в пунктах (1/72 дюйма) из pdfinfo, без растеризации
+        
+        Для страниц, размер которых узнать не удалось, записи нет.
+        """
+        try:
+            result = subprocess.run(
+                ["pdfinfo", "-f", str(first_page), "-l", str(last_page), pdf_path],
+                capture_output=True,
+                text=True,
+                errors="ignore",
+                timeout=60
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            print(f"[CONVERTER] Failed to read page sizes: {e}")
+            return {}
+        
+        sizes = {}
+        common_size = None
+        for match in _PAGE_SIZE_LINE.finditer(result.stdout):
+            size = (float(match.group(2)), float(match.group(3)))
+            if match.group(1):
+                sizes[int(match.group(1))] = size
+            elif common_size is None:
+                common_size = size
+        if not sizes and common_size:
+            # pdfinfo без постраничного вывода печатает только "Page size:" - размер первой страницы
+            sizes = {page_number: common_size for page_number in range(first_page, last_page + 1)}
+        return sizes
+    
+    @staticmethod
+    def render_dpi(file_type: str) -> int:
+        """DPI растеризации для типа документа"""
+        return settings.PPT_DPI if file_type.lower() in ['ppt', 'pptx'] else settings.PDF_DPI
+    
     @staticmethod
-    def convert_pdf_to_images(pdf_path: str, output_dir: str, dpi: int = None) -> List[str]:
-        """Конвертация PDF в изображения"""
+    def page_dpi(page_size: Optional[Tuple[float, float]], base_dpi: int) -> int:
+        """DPI страницы с учетом бюджета пикселей
+        
+        base_dpi уменьшается так, чтобы растр страницы не превышал
+        PAGE_MAX_PIXELS пикселей и PAGE_MAX_EDGE по длинной стороне: плакаты
+        и длинные страницы растеризуются в растр предсказуемого размера.
+        Страницы обычного размера (A4, слайды) рендерятся с base_dpi.
+        """
+        if not page_size or page_size[0] <= 0 or page_size[1] <= 0:
+            return base_dpi
+        width_in, height_in = page_size[0] / 72, page_size[1] / 72
+        dpi = base_dpi
+        if settings.PAGE_MAX_PIXELS > 0:
+            dpi = min(dpi, int(math.sqrt(settings.PAGE_MAX_PIXELS / (width_in * height_in))))
+        if settings.PAGE_MAX_EDGE > 0:
+            dpi = min(dpi, int(settings.PAGE_MAX_EDGE / max(width_in, height_in)))
+        return max(1, dpi)
+    
+    @staticmethod
+    def render_key(dpi: int, image_format: str) -> str:
+        """Ключ параметров рендера страницы: страница с другим ключом устарела
+        
+        dpi - фактический DPI страницы (см. page_dpi).
+        """
+        return f"v{DocumentConverter.CONVERTER_VERSION}:{dpi}:{image_format}"
+    
+    @staticmethod
+    def expected_render_key(entry: dict, base_dpi: int, image_format: str) -> str:
+        """Ключ, с которым страница из манифеста должна быть растеризована сейчас
+        
+        Размер страницы берется из манифеста, а у записей без него
+        вычисляется по размеру растра и DPI.
+        """
+        page_size = entry.get("page_size_pts")
+        if not page_size and entry.get("dpi") and entry.get("width") and entry.get("height"):
+            page_size = (entry["width"] * 72 / entry["dpi"], entry["height"] * 72 / entry["dpi"])
+        return DocumentConverter.render_key(DocumentConverter.page_dpi(page_size, base_dpi), image_format)
+    
+    @staticmethod
+    def _save_page(
+        image: Image.Image,
+        output_dir: str,
+        page_number: int,
+        image_format: str,
+        dpi: int,
+        page_size: Optional[Tuple[float, float]] = None,
+        rasterizer: Optional[str] = None,
+        pending: Optional[List[Tuple[int, dict, Optional[dict]]]] = None
+    ) -> str:
+        """Сохранение растра страницы и его уменьшенных вариантов в формате хранения
+        
+        Для формата "auto" режим и кодировщик выбираются по содержимому страницы.
+        Параметры рендера (DPI страницы, размер страницы в пунктах, бэкенд
+        растеризации), размеры и контрольная сумма записываются в манифест
+        страниц; при перерендере удаляются производные кеши этой страницы.
+        Если передан pending, запись в манифест откладывается до
+        _commit_pages - одной перезаписи манифеста на пачку страниц.
+        """
+        if image_format == PageImageFormat.AUTO:
+            image, page_format, data, info = PageImageFormat.choose(image)
+        else:
+            page_format, info = image_format, {}
+            data = PageImageFormat.encode(image, image_format)
+        
+        previous = PageManifest.get_page(output_dir, page_number)
+        output_path = PageVariants.variant_path(
+            output_dir, page_number, PageVariants.RETINA, page_format
+        )
+        # Пишем во временный файл и атомарно переименовываем,
+        # чтобы читатели никогда не увидели недописанный файл
+        PageImageFormat.write_atomic(data, output_path)
+        variants = PageVariants.save_variants(image, output_dir, page_number, page_format)
+        
+        # Манифест обновляется после записи файлов: до этого страница считается нерастеризованной
+        entry = {
+            **info,
+            "key": DocumentConverter.render_key(dpi, image_format),
+            "converter": DocumentConverter.CONVERTER_VERSION,
+            "dpi": dpi,
+            "page_size_pts": list(page_size) if page_size else None,
+            "rasterizer": rasterizer,
+            "requested_format": image_format,
+            "format": page_format,
+            "width": image.width,
+            "height": image.height,
+            "bytes": len(data),
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "variants": variants,
+            "rendered_at": time.time(),
+        }
+        if pending is None:
+            DocumentConverter._commit_pages(output_dir, [(page_number, entry, previous)])
+        else:
+            pending.append((page_number, entry, previous))
+        return output_path
+    
+    @staticmethod
+    def _commit_pages(output_dir: str, pending: List[Tuple[int, dict, Optional[dict]]]):
+        """Запись сохраненных страниц в манифест и удаление кешей их прежних растров
+        
+        pending - (номер страницы, запись манифеста, прежняя запись) из _save_page;
+        после записи список очищается.
+        """
+        PageManifest.update_pages(output_dir, {page_number: entry for page_number, entry, _ in pending})
+        for page_number, entry, previous in pending:
+            if previous:
+                DocumentConverter._invalidate_page_caches(
+                    output_dir, page_number, previous.get("format"), entry["format"]
+                )
+        pending.clear()
+    
+    @staticmethod
+    def _invalidate_page_caches(
+        output_dir: str,
+        page_number: int,
+        old_format: Optional[str],
+        new_format: str
+    ):
+        """Удаление кешей, построенных из прежнего растра страницы
+        
+        Страницы с водяными знаками (на диске и в памяти), тайлы и файлы
+        прежнего расширения (если формат страницы сменился).
+        """
+        import glob
+        import shutil
+        
+        stale_files = glob.glob(os.path.join(output_dir, f"watermarked_*_page_{page_number}.*"))
+        stale_files += glob.glob(os.path.join(output_dir, f"watermarked_*_page_{page_number}_*.*"))
+        if old_format and PageImageFormat.extension(old_format) != PageImageFormat.extension(new_format):
+            old_ext = PageImageFormat.extension(old_format)
+            stale_files += glob.glob(os.path.join(output_dir, f"page_{page_number}.{old_ext}"))
+            stale_files += glob.glob(os.path.join(output_dir, f"page_{page_number}_*.{old_ext}"))
+        for path in stale_files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        
+        for tiles_dir in glob.glob(os.path.join(output_dir, "tiles", "*", f"page_{page_number}")):
+            shutil.rmtree(tiles_dir, ignore_errors=True)
+        
+        # Кеш ответов в памяти этого процесса. В процессе пула растеризации это
+        # его собственная копия - кеш процесса API сбрасывает _rasterize_ranges
+        DocumentConverter._forget_cached_responses(output_dir, page_number, page_number)
+    
+    @staticmethod
+    def _forget_cached_responses(output_dir: str, first_page: int, last_page: int):
+        """Сброс страниц first_page..last_page в кеше ответов в памяти этого процесса
+        
+        Остальные воркеры uvicorn узнают о перерендере по истечении TTL записи.
+        """
+        file_hash = os.path.basename(os.path.normpath(output_dir))
+        page_response_cache.invalidate(
+            lambda key: key[0] == file_hash and first_page <= key[1] <= last_page
+        )
+    
+    @staticmethod
+    def raster_workers() -> int:
+        """Количество процессов растеризации: из настроек или по доступным ядрам"""
+        if settings.RASTER_WORKERS > 0:
+            return settings.RASTER_WORKERS
+        try:
+            return max(1, len(os.sched_getaffinity(0)))
+        except AttributeError:
+            return max(1, os.cpu_count() or 1)
+    
+    @staticmethod
+    def convert_pdf_to_images(
+        pdf_path: str,
+        output_dir: str,
+        dpi: int = None,
+        chunk_size: int = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        image_format: str = None,
+        workers: int = None,
+        rasterizer: str = None
+    ) -> List[str]:
+        """Конвертация PDF в изображения
+        
+        Документ делится на диапазоны по chunk_size страниц, диапазоны
+        растеризуются и кодируются параллельно в пуле процессов (workers,
+        по умолчанию raster_workers()). Пиковое потребление памяти не зависит
+        от количества страниц: в работе одновременно не больше workers диапазонов.
+        Страницы, уже растеризованные с текущими параметрами (например, до
+        перезапуска сервиса), пропускаются. Пути возвращаются в порядке
+        страниц; страниц, которые не удалось растеризовать, среди них нет.
+        rasterizer - имя бэкенда растеризации (по умолчанию - для обычного PDF).
+        """
         if dpi is None:
             dpi = settings.PDF_DPI
+        if rasterizer is None:
+            rasterizer = Rasterizers.for_file_type("pdf")
+        if chunk_size is None:
+            chunk_size = settings.PDF_CHUNK_SIZE
+        if image_format is None:
+            image_format = settings.PAGE_IMAGE_FORMAT
+        chunk_size = max(1, chunk_size)
         
-        images = convert_from_path(
-            pdf_path,
-            dpi=dpi,
-            fmt='png',
-            thread_count=4
-        )
+        total_pages = DocumentConverter.get_pdf_page_count(pdf_path)
         
-        output_paths = []
         os.makedirs(output_dir, exist_ok=True)
+        missing = [
+            page_number for page_number in range(1, total_pages + 1)
+            if not DocumentConverter.rendered_page_path(output_dir, page_number, image_format, dpi)
+        ]
+        pages_done = total_pages - len(missing)
+        if pages_done:
+            print(f"[CONVERTER] Resuming: {pages_done} of {total_pages} pages already rendered")
+        if progress_callback:
+            progress_callback(pages_done, total_pages)
         
-        for i, img in enumerate(images):
-            output_path = os.path.join(output_dir, f"page_{i+1}.png")
-            img.save(output_path, 'PNG', quality=95)
-            output_paths.append(output_path)
+        if missing:
+            def report_progress(pages_converted: int, _: int):
+                progress_callback(pages_done + pages_converted, total_pages)
+            
+            DocumentConverter._rasterize_ranges(
+                pdf_path,
+                output_dir,
+                DocumentConverter._page_ranges(missing, chunk_size),
+                dpi,
+                image_format,
+                report_progress if progress_callback else None,
+                workers,
+                rasterizer
+            )
+        
+        output_paths = []
+        for page_number in range(1, total_pages + 1):
+            output_path = DocumentConverter.rendered_page_path(output_dir, page_number, image_format)
+            if output_path:
+                output_paths.append(output_path)
+        if total_pages and not output_paths:
+            raise Exception(f"No pages could be rendered from {pdf_path}")
+        return output_paths
+    
+    @staticmethod
+    def _page_ranges(page_numbers: List[int], chunk_size: int) -> List[Tuple[int, int]]:
+        """Соседние страницы - в диапазоны не длиннее chunk_size (один запуск pdftoppm на диапазон)"""
+        ranges = []
+        for page_number in page_numbers:
+            if ranges and ranges[-1][1] == page_number - 1 and page_number - ranges[-1][0] < chunk_size:
+                ranges[-1] = (ranges[-1][0], page_number)
+            else:
+                ranges.append((page_number, page_number))
+        return ranges
+    
+    @staticmethod
+    def _rasterize_ranges(
+        pdf_path: str,
+        output_dir: str,
+        ranges: List[Tuple[int, int]],
+        dpi: int,
+        image_format: str,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        workers: int = None,
+        rasterizer: str = None
+    ) -> List[str]:
+        """Растеризация диапазонов страниц (first, last) в пуле процессов
+        
+        progress_callback получает количество обработанных страниц в этих
+        диапазонах (включая страницы, которые не удалось растеризовать).
+        """
+        total_pages = sum(last_page - first_page + 1 for first_page, last_page in ranges)
+        shared_pool = workers is None
+        if workers is None:
+            workers = DocumentConverter.raster_workers()
         
+        started = time.time()
+        paths_by_range = {}
+        pages_done = 0
+        
+        if workers <= 1 or len(ranges) == 1:
+            # Один процесс - без накладных расходов пула
+            for first_page, last_page in ranges:
+                paths_by_range[first_page] = _rasterize_pdf_range(
+                    pdf_path, output_dir, first_page, last_page, dpi, image_format, rasterizer
+                )
+                pages_done += last_page - first_page + 1
+                if progress_callback:
+                    progress_callback(pages_done, total_pages)
+        else:
+            pool = _get_raster_pool() if shared_pool else _create_raster_pool(workers)
+            try:
+                futures = {
+                    pool.submit(
+                        _rasterize_pdf_range,
+                        pdf_path, output_dir, first_page, last_page, dpi, image_format, rasterizer
+                    ): (first_page, last_page)
+                    for first_page, last_page in ranges
+                }
+                for future in as_completed(futures):
+                    first_page, last_page = futures[future]
+                    paths_by_range[first_page] = future.result()
+                    # Страницы записал процесс пула: его кеш в памяти - не наш
+                    DocumentConverter._forget_cached_responses(output_dir, first_page, last_page)
+                    pages_done += last_page - first_page + 1
+                    if progress_callback:
+                        progress_callback(pages_done, total_pages)
+            except BrokenProcessPool:
+                # Процесс пула упал (например, OOM) - следующая конвертация создаст новый пул
+                if shared_pool:
+                    _reset_raster_pool(pool)
+                raise
+            finally:
+                if not shared_pool:
+                    pool.shutdown()
+        
+        elapsed = time.time() - started
+        print(
+            f"[CONVERTER] Rasterized {total_pages} pages in {elapsed:.1f}s "
+            f"({total_pages / elapsed if elapsed > 0 else 0:.2f} pages/sec, {workers} workers, "
+            f"{rasterizer or Rasterizers.DEFAULT})"
+        )
+        
+        # Склеиваем результаты диапазонов в порядке страниц
+        output_paths = []
+        for first_page in sorted(paths_by_range):
+            output_paths.extend(paths_by_range[first_page])
         return output_paths
     
     @staticmethod
-    def convert_ppt_to_images(ppt_path: str, output_dir: str, dpi: int = None) -> List[str]:
+    def stale_pages(output_dir: str, total_pages: int, base_dpi: int, image_format: str) -> List[int]:
+        """Страницы, растеризованные с другими параметрами (DPI, формат, версия конвертера)
+        
+        Страницы без записи в манифесте (еще не растеризованные в ленивом режиме
+        или из кеша до появления манифеста) устаревшими не считаются.
+        """
+        pages = PageManifest.load(output_dir)["pages"]
+        return [
+            page_number for page_number in range(1, total_pages + 1)
+            if str(page_number) in pages
+            and pages[str(page_number)].get("key") != DocumentConverter.expected_render_key(
+                pages[str(page_number)], base_dpi, image_format
+            )
+        ]
+    
+    @staticmethod
+    def refresh_stale_pages(
+        file_path: str,
+        file_type: str,
+        output_dir: str,
+        total_pages: int,
+        image_format: str,
+        progress_callback: Optional[Callable[[int, int], None]] = None
+    ) -> List[int]:
+        """Перерендер только устаревших страниц с текущими параметрами
+        
+        Остальные страницы и их кеши не трогаются. Возвращает номера
+        перерендеренных страниц.
+        """
+        dpi = DocumentConverter.render_dpi(file_type)
+        stale = DocumentConverter.stale_pages(output_dir, total_pages, dpi, image_format)
+        if progress_callback:
+            progress_callback(0, len(stale))
+        if not stale:
+            return []
+        
+        pdf_path = DocumentConverter.get_source_pdf_path(file_path, file_type)
+        if not os.path.exists(pdf_path):
+            raise Exception(f"Source PDF not found: {pdf_path}")
+        
+        ranges = DocumentConverter._page_ranges(stale, max(1, settings.PDF_CHUNK_SIZE))
+        DocumentConverter._rasterize_ranges(
+            pdf_path, output_dir, ranges, dpi, image_format, progress_callback,
+            rasterizer=Rasterizers.for_file_type(file_type)
+        )
+        return stale
+    
+    @staticmethod
+    def convert_ppt_to_images(
+        ppt_path: str,
+        output_dir: str,
+        dpi: int = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        image_format: str = None
+    ) -> List[str]:
         """Конвертация PPT/PPTX в изображения через LibreOffice"""
         if dpi is None:
             dpi = settings.PPT_DPI
         
-        # Сначала конвертируем в PDF через LibreOffice
-        pdf_path = ppt_path.replace('.pptx', '.pdf').replace('.ppt', '.pdf')
-        
         try:
-            # Конвертация через LibreOffice headless
-            cmd = [
-                'libreoffice',
-                '--headless',
-                '--convert-to', 'pdf',
-                '--outdir', os.path.dirname(pdf_path),
-                ppt_path
-            ]
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-            
-            if result.returncode != 0:
-                raise Exception(f"LibreOffice conversion failed: {result.stderr}")
-            
-            # Теперь конвертируем PDF в изображения
-            return DocumentConverter.convert_pdf_to_images(pdf_path, output_dir, dpi)
+            # Сначала конвертируем в PDF через LibreOffice
+            pdf_path = DocumentConverter.convert_ppt_to_pdf(ppt_path)
+        except OfficeNotInstalledError:
+            # Fallback: используем python-pptx для извлечения слайдов.
+            # Остальные ошибки офиса (переполнение очереди, таймаут, падение)
+            # уходят наверх: пустые слайды хуже повторной попытки
+            return DocumentConverter._convert_pptx_direct(
+                ppt_path, output_dir, dpi, progress_callback, image_format
+            )
+        
+        # Теперь конвертируем PDF в изображения
+        return DocumentConverter.convert_pdf_to_images(
+            pdf_path,
+            output_dir,
+            dpi,
+            progress_callback=progress_callback,
+            image_format=image_format,
+            rasterizer=Rasterizers.for_file_type("ppt")
+        )
+    
+    @staticmethod
+    def convert_ppt_to_pdf(ppt_path: str) -> str:
+        """Конвертация PPT/PPTX в PDF через пул LibreOffice (PDF кладется рядом с исходником)
+        
+        PDF, оставшийся от прерванной конвертации, используется повторно,
+        если он новее исходника и читается целиком.
+        """
+        pdf_path = DocumentConverter._ppt_pdf_path(ppt_path)
+        if os.path.exists(pdf_path) and os.path.getmtime(pdf_path) >= os.path.getmtime(ppt_path):
+            try:
+                DocumentConverter.get_pdf_page_count(pdf_path)
+                return pdf_path
+            except Exception:
+                pass  # Недописанный PDF - конвертируем заново
+        office_pdf_path = office_pool.convert_to_pdf(ppt_path, os.path.dirname(pdf_path) or ".")
+        if os.path.abspath(office_pdf_path) != os.path.abspath(pdf_path):
+            os.replace(office_pdf_path, pdf_path)
+        return pdf_path
+    
+    @staticmethod
+    def _ppt_pdf_path(ppt_path: str) -> str:
+        return ppt_path.replace('.pptx', '.pdf').replace('.ppt', '.pdf')
+    
+    @staticmethod
+    def get_source_pdf_path(file_path: str, file_type: str) -> str:
+        """Путь к PDF, из которого растеризуются страницы документа"""
+        if file_type.lower() in ['ppt', 'pptx']:
+            return DocumentConverter._ppt_pdf_path(file_path)
+        return file_path
+    
+    @staticmethod
+    def prepare_lazy(
+        file_path: str,
+        file_type: str,
+        output_dir: str,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        image_format: str = None
+    ) -> int:
+        """Ленивый режим: при загрузке только узнаем количество страниц
+        
+        Страницы растеризуются позже, при первом запросе (см. ensure_page).
+        Для PPT/PPTX здесь выполняется только конвертация в PDF.
+        Возвращает количество страниц.
+        """
+        if file_type.lower() in ['ppt', 'pptx']:
+            try:
+                pdf_path = DocumentConverter.convert_ppt_to_pdf(file_path)
+            except OfficeNotInstalledError:
+                # Без LibreOffice лениво рендерить нечего - используем прямую конвертацию
+                return len(DocumentConverter._convert_pptx_direct(
+                    file_path, output_dir, settings.PPT_DPI, progress_callback, image_format
+                ))
+        elif file_type.lower() == 'pdf':
+            pdf_path = file_path
+        else:
+            raise ValueError(f"Unsupported file type: {file_type}")
+        
+        os.makedirs(output_dir, exist_ok=True)
+        total_pages = DocumentConverter.get_pdf_page_count(pdf_path)
+        if progress_callback:
+            progress_callback(0, total_pages)
+        return total_pages
+    
+    @staticmethod
+    def ensure_page(
+        file_path: str,
+        file_type: str,
+        output_dir: str,
+        page_number: int,
+        image_format: str = None
+    ) -> Optional[str]:
+        """Растеризация одной страницы при первом запросе
+        
+        Страница, растеризованная с другими параметрами (см. render_key),
+        перерендеривается. Параллельные запросы одной и той же страницы ждут
+        на общей блокировке, поэтому страница рендерится один раз. Страницу,
+        на которой растеризация раз за разом падает (см. render_given_up),
+        повторно не рендерим. Возвращает путь к растру страницы; если исходный
+        PDF недоступен или страница не растеризуется - устаревший растр или None.
+        """
+        if image_format is None:
+            image_format = settings.PAGE_IMAGE_FORMAT
+        dpi = DocumentConverter.render_dpi(file_type)
+        output_path = DocumentConverter.rendered_page_path(output_dir, page_number, image_format, dpi)
+        if output_path:
+            return output_path
+        
+        pdf_path = DocumentConverter.get_source_pdf_path(file_path, file_type)
+        if not os.path.exists(pdf_path) or DocumentConverter.render_given_up(output_dir, page_number):
+            # Устаревший растр лучше, чем никакого
+            return DocumentConverter.rendered_page_path(output_dir, page_number, image_format)
+        
+        # Ключ не зависит от формата: в режиме "auto" расширение известно только после рендера
+        with get_keyed_lock(os.path.join(output_dir, f"page_{page_number}")):
+            # Пока ждали блокировку, страницу мог отрендерить другой запрос
+            output_path = DocumentConverter.rendered_page_path(output_dir, page_number, image_format, dpi)
+            if output_path:
+                return output_path
+            # ...или исчерпать попытки на той же странице
+            if DocumentConverter.render_given_up(output_dir, page_number):
+                return DocumentConverter.rendered_page_path(output_dir, page_number, image_format)
             
-        except Exception as e:
-            # Fallback: используем python-pptx для извлечения слайдов
-            return DocumentConverter._convert_pptx_direct(ppt_path, output_dir, dpi)
+            os.makedirs(output_dir, exist_ok=True)
+            output_paths = _rasterize_pdf_range(
+                pdf_path, output_dir, page_number, page_number, dpi, image_format,
+                Rasterizers.for_file_type(file_type)
+            )
+            if not output_paths:
+                # Страница не растеризовалась (отмечена в манифесте) - отдаем прежний растр, если есть
+                return DocumentConverter.rendered_page_path(output_dir, page_number, image_format)
+        
+        return output_paths[0]
+    
+    @staticmethod
+    def render_given_up(output_dir: str, page_number: int) -> bool:
+        """Страница падала при растеризации PAGE_RENDER_MAX_ATTEMPTS раз подряд
+        и с последней неудачи не прошло PAGE_RENDER_RETRY_HOURS часов
+        """
+        failure = PageManifest.get_failure(output_dir, page_number)
+        if failure is None or failure.get("attempts", 1) < settings.PAGE_RENDER_MAX_ATTEMPTS:
+            return False
+        return time.time() - failure.get("failed_at", 0) < settings.PAGE_RENDER_RETRY_HOURS * 3600
+    
+    @staticmethod
+    def rendered_page_path(
+        output_dir: str,
+        page_number: int,
+        image_format: str,
+        base_dpi: Optional[int] = None
+    ) -> Optional[str]:
+        """Путь к уже растеризованной странице или None
+        
+        С base_dpi страница, растеризованная с другими параметрами
+        (см. expected_render_key), считается отсутствующей.
+        """
+        entry = PageManifest.get_page(output_dir, page_number)
+        if entry is None and image_format == PageImageFormat.AUTO:
+            return None
+        if entry is not None and base_dpi and entry.get("key") != DocumentConverter.expected_render_key(
+            entry, base_dpi, image_format
+        ):
+            return None
+        output_path = PageVariants.variant_path(
+            output_dir,
+            page_number,
+            PageVariants.RETINA,
+            PageManifest.page_format(output_dir, page_number, image_format)
+        )
+        return output_path if os.path.exists(output_path) else None
     
     @staticmethod
-    def _convert_pptx_direct(pptx_path: str, output_dir: str, dpi: int) -> List[str]:
+    def _convert_pptx_direct(
+        pptx_path: str,
+        output_dir: str,
+        dpi: int,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        image_format: str = None
+    ) -> List[str]:
         """Прямая конвертация PPTX через python-pptx (менее качественно)"""
+        if image_format is None:
+            image_format = settings.PAGE_IMAGE_FORMAT
         prs = Presentation(pptx_path)
         output_paths = []
+        pending = []
         os.makedirs(output_dir, exist_ok=True)
         
         for i, slide in enumerate(prs.slides):
@@ -83,18 +650,214 @@ class DocumentConverter:
             
             # Временное решение: создаем пустое изображение с информацией о слайде
             img = Image.new('RGB', (1920, 1080), color='white')
-            output_path = os.path.join(output_dir, f"page_{i+1}.png")
-            img.save(output_path, 'PNG')
+            output_path = DocumentConverter._save_page(img, output_dir, i + 1, image_format, dpi, pending=pending)
             output_paths.append(output_path)
+            if len(pending) >= settings.PDF_CHUNK_SIZE:
+                DocumentConverter._commit_pages(output_dir, pending)
+            if progress_callback:
+                progress_callback(len(output_paths), len(prs.slides))
+        DocumentConverter._commit_pages(output_dir, pending)
         
         return output_paths
     
     @staticmethod
-    def convert_to_images(file_path: str, file_type: str, output_dir: str) -> List[str]:
-        """Универсальный метод конвертации"""
+    def reencode_cache(
+        output_dir: str,
+        total_pages: int,
+        from_format: str,
+        to_format: str,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        dpi: int = None
+    ) -> int:
+        """Перекодирование уже растеризованных страниц в другой формат хранения
+        
+        DPI страницы сохраняется из манифеста (dpi - для страниц без записи).
+        Файлы прежнего формата страниц без записи в манифесте удаляет
+        remove_stale_format_files. Возвращает количество перекодированных страниц.
+        """
+        if dpi is None:
+            dpi = settings.PDF_DPI
+        reencoded = 0
+        pending = []
+        for page_number in range(1, total_pages + 1):
+            source_path = DocumentConverter.rendered_page_path(output_dir, page_number, from_format)
+            if source_path:
+                entry = PageManifest.get_page(output_dir, page_number) or {}
+                with Image.open(source_path) as img:
+                    img.load()
+                    DocumentConverter._save_page(
+                        img, output_dir, page_number, to_format, entry.get("dpi", dpi),
+                        entry.get("page_size_pts"), entry.get("rasterizer"), pending
+                    )
+                reencoded += 1
+            # Манифест перезаписывается пачками страниц, а не на каждую страницу
+            if len(pending) >= settings.PDF_CHUNK_SIZE:
+                DocumentConverter._commit_pages(output_dir, pending)
+            if progress_callback:
+                progress_callback(page_number, total_pages)
+        DocumentConverter._commit_pages(output_dir, pending)
+        return reencoded
+    
+    @staticmethod
+    def remove_stale_format_files(output_dir: str, new_format: str):
+        """Удаление файлов прежнего формата и производных кешей (водяные знаки, тайлы)
+        
+        Файл страницы остается, только если его расширение совпадает с текущим
+        форматом этой страницы (из манифеста, для страниц без записи - new_format).
+        """
+        import re
+        import shutil
+        
+        if not os.path.isdir(output_dir):
+            return
+        
+        page_file = re.compile(r"^page_(\d+)(?:_[a-z]+)?\.(\w+)$")
+        for filename in os.listdir(output_dir):
+            match = page_file.match(filename)
+            if match:
+                page_format = PageManifest.page_format(output_dir, int(match.group(1)), new_format)
+                # Страницы с тем же расширением уже перезаписаны новым форматом
+                stale = match.group(2) != PageImageFormat.extension(page_format)
+            else:
+                stale = filename.startswith("watermarked_")
+            if stale:
+                try:
+                    os.remove(os.path.join(output_dir, filename))
+                except OSError:
+                    pass
+        
+        shutil.rmtree(os.path.join(output_dir, "tiles"), ignore_errors=True)
+        remove_cache_locks(output_dir)
+    
+    @staticmethod
+    def convert_to_images(
+        file_path: str,
+        file_type: str,
+        output_dir: str,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        image_format: str = None
+    ) -> List[str]:
+        """Универсальный метод конвертации
+        
+        progress_callback(pages_converted, total_pages) вызывается после каждой страницы.
+        """
         if file_type.lower() == 'pdf':
-            return DocumentConverter.convert_pdf_to_images(file_path, output_dir)
+            return DocumentConverter.convert_pdf_to_images(
+                file_path, output_dir, progress_callback=progress_callback, image_format=image_format
+            )
         elif file_type.lower() in ['ppt', 'pptx']:
-            return DocumentConverter.convert_ppt_to_images(file_path, output_dir)
+            return DocumentConverter.convert_ppt_to_images(
+                file_path, output_dir, progress_callback=progress_callback, image_format=image_format
+            )
         else:
             raise ValueError(f"Unsupported file type: {file_type}")
+
+
+def _rasterize_pdf_range(
+    pdf_path: str,
+    output_dir: str,
+    first_page: int,
+    last_page: int,
+    dpi: int,
+    image_format: str,
+    rasterizer: str = None
+) -> List[str]:
+    """Растеризация диапазона страниц PDF (выполняется в процессе пула)
+    
+    dpi - базовый DPI; DPI каждой страницы выбирается по ее размеру
+    (DocumentConverter.page_dpi), соседние страницы с одинаковым DPI
+    растеризуются одним вызовом бэкенда. Страница, которую не удалось
+    растеризовать, отмечается в манифесте и пропускается.
+    """
+    backend = Rasterizers.get(rasterizer)
+    page_sizes = DocumentConverter.get_pdf_page_sizes(pdf_path, first_page, last_page)
+    groups = []
+    for page_number in range(first_page, last_page + 1):
+        page_dpi = DocumentConverter.page_dpi(page_sizes.get(page_number), dpi)
+        if groups and groups[-1][2] == page_dpi:
+            groups[-1][1] = page_number
+        else:
+            groups.append([page_number, page_number, page_dpi])
+    
+    output_paths = []
+    while groups:
+        group_first, group_last, page_dpi = groups.pop(0)
+        try:
+            images = backend.render(
+                pdf_path,
+                group_first,
+                group_last,
+                page_dpi,
+                timeout=settings.PAGE_RENDER_TIMEOUT * (group_last - group_first + 1)
+            )
+        except Exception as e:
+            if group_first < group_last:
+                # Одна плохая страница не должна ронять весь диапазон - повторяем постранично
+                print(f"[CONVERTER] Pages {group_first}-{group_last} failed ({e}), retrying page by page")
+                groups[:0] = [[page_number, page_number, page_dpi] for page_number in range(group_first, group_last + 1)]
+            else:
+                print(f"[CONVERTER] Page {group_first} failed: {e}")
+                PageManifest.mark_failed(output_dir, group_first, str(e))
+            continue
+        
+        # Страницы одного вызова бэкенда записываются в манифест одной перезаписью
+        pending = []
+        for offset, img in enumerate(images):
+            page_number = group_first + offset
+            try:
+                output_paths.append(DocumentConverter._save_page(
+                    img, output_dir, page_number, image_format, page_dpi, page_sizes.get(page_number),
+                    backend.name, pending
+                ))
+            except Exception as e:
+                print(f"[CONVERTER] Page {page_number} failed: {e}")
+                PageManifest.mark_failed(output_dir, page_number, str(e))
+            finally:
+                img.close()
+        DocumentConverter._commit_pages(output_dir, pending)
+        
+        # Бэкенд остановился на плохой странице: остаток диапазона - постранично
+        next_page = group_first + len(images)
+        if next_page <= group_last:
+            if group_first < group_last:
+                groups[:0] = [[page_number, page_number, page_dpi] for page_number in range(next_page, group_last + 1)]
+            else:
+                print(f"[CONVERTER] Page {group_first} failed: no image")
+                PageManifest.mark_failed(output_dir, group_first, f"{backend.name} returned no image")
+    return output_paths
+
+
+# Строка размера страницы в выводе pdfinfo: "Page    3 size: 595 x 842 pts (A4)" или "Page size: ..."
+_PAGE_SIZE_LINE = re.compile(r"^Page\s+(?:(\d+)\s+)?size:\s+([\d.]+)\s+x\s+([\d.]+)\s+pts", re.MULTILINE)
+
+_raster_pool: Optional[ProcessPoolExecutor] = None
+_raster_pool_lock = threading.Lock()
+
+
+def _create_raster_pool(workers: int) -> ProcessPoolExecutor:
+    # spawn: процесс приложения многопоточный, fork в нем небезопасен
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def _get_raster_pool() -> ProcessPoolExecutor:
+    """Общий пул процессов растеризации (создается при первой конвертации)
+
+    Общий для всех задач конвертации, поэтому суммарно загружено
+    не больше raster_workers() ядер.
+    """
+    global _raster_pool
+    with _raster_pool_lock:
+        if _raster_pool is None:
+            _raster_pool = _create_raster_pool(DocumentConverter.raster_workers())
+        return _raster_pool
+
+
+def _reset_raster_pool(broken_pool: ProcessPoolExecutor):
+    global _raster_pool
+    with _raster_pool_lock:
+        if _raster_pool is broken_pool:
+            _raster_pool = None
+    broken_pool.shutdown(wait=False)
@@ -0,0 +1,203 @@
+"""
+Форматы хранения растров страниц
+"""
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, List, Optional, Sequence, Tuple, Union
+from PIL import Image, ImageChops
+from app.core.config import settings
+from app.services.rasterizers import Rasterizers
+
+
+class PageImageFormat:
+    """Кодирование растров страниц в выбранный формат хранения
+
+    png        - RGB PNG без потерь (как раньше)
+    png8       - PNG с палитрой до 256 цветов (квантование)
+    webp       - WebP без потерь
+    webp_lossy - WebP с потерями (PAGE_IMAGE_QUALITY)
+    jpeg       - JPEG (PAGE_IMAGE_QUALITY)
+    auto       - выбор для каждой страницы по содержимому (см. choose),
+                 выбранный формат записывается в манифест страниц
+    """
+
+    FORMATS = {
+        "png": ("png", "image/png"),
+        "png8": ("png", "image/png"),
+        "webp": ("webp", "image/webp"),
+        "webp_lossy": ("webp", "image/webp"),
+        "jpeg": ("jpg", "image/jpeg"),
+    }
+
+    DEFAULT = "png"
+    AUTO = "auto"
+
+    # Каналы RGB, отличающиеся не больше чем на столько, считаются серым
+    GRAYSCALE_TOLERANCE = 4
+    # Энтропия яркости (бит), выше которой страница считается фотографией
+    PHOTO_ENTROPY = 5.0
+    # Размер уменьшенной копии для оценки энтропии
+    ANALYSIS_SIZE = 512
+
+    @staticmethod
+    def normalize(image_format: str) -> str:
+        return image_format if image_format in PageImageFormat.FORMATS else PageImageFormat.DEFAULT
+
+    @staticmethod
+    def extension(image_format: str) -> str:
+        return PageImageFormat.FORMATS[PageImageFormat.normalize(image_format)][0]
+
+    @staticmethod
+    def media_type(image_format: str) -> str:
+        return PageImageFormat.FORMATS[PageImageFormat.normalize(image_format)][1]
+
+    @staticmethod
+    def save(image: Image.Image, target: Union[str, BinaryIO], image_format: str):
+        """Сохранение изображения в файл или поток в формате хранения"""
+        image_format = PageImageFormat.normalize(image_format)
+        quality = settings.PAGE_IMAGE_QUALITY
+
+        if image_format == "png":
+            image.save(target, 'PNG')
+        elif image_format == "png8":
+            if image.mode != 'P':
+                source = image if image.mode in ('RGB', 'L') else image.convert('RGB')
+                image = source.quantize(colors=256, method=Image.Quantize.MEDIANCUT)
+            image.save(target, 'PNG', optimize=True)
+        elif image_format in ("webp", "webp_lossy"):
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGB')
+            if image_format == "webp":
+                image.save(target, 'WEBP', lossless=True, quality=100, method=4)
+            else:
+                image.save(target, 'WEBP', quality=quality, method=4)
+        elif image_format == "jpeg":
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.save(target, 'JPEG', quality=quality, optimize=True, progressive=True)
+
+    @staticmethod
+    def save_atomic(image: Image.Image, path: str, image_format: str):
+        """Сохранение через временный файл, чтобы читатели не видели недописанный файл"""
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            PageImageFormat.save(image, f, image_format)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def write_atomic(data: bytes, path: str):
+        """Запись уже закодированного изображения через временный файл"""
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def encode(image: Image.Image, image_format: str) -> bytes:
+        buffer = io.BytesIO()
+        PageImageFormat.save(image, buffer, image_format)
+        return buffer.getvalue()
+
+    @staticmethod
+    def encode_many(items: Sequence[Tuple[Image.Image, str]], workers: Optional[int] = None) -> List[bytes]:
+        """Параллельное кодирование пар (изображение, формат) в том же порядке
+
+        Кодировщики Pillow отпускают GIL, поэтому хватает потоков.
+        """
+        workers = min(len(items), workers or os.cpu_count() or 1)
+        if workers <= 1:
+            return [PageImageFormat.encode(image, image_format) for image, image_format in items]
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="encode") as executor:
+            return list(executor.map(lambda item: PageImageFormat.encode(*item), items))
+
+    @staticmethod
+    def choose(image: Image.Image) -> Tuple[Image.Image, str, bytes, dict]:
+        """Выбор режима и кодировщика для страницы по ее содержимому
+
+        bilevel   - только черный и белый: 1-битный PNG
+        text      - оттенки серого, низкая энтропия: PNG в режиме L
+        grayscale - серая фотография: меньший из PNG L и JPEG L
+        palette   - не больше 256 цветов: PNG с точной палитрой
+        graphics  - цветная графика, низкая энтропия: меньший из png8 и WebP без потерь;
+                    png8 здесь квантует цвета, поэтому допускается, только если
+                    PSNR квантованной страницы не ниже PAGE_PNG8_MIN_PSNR
+        photo     - цветная фотография: меньший из WebP с потерями и JPEG
+
+        Возвращает (изображение в выбранном режиме, формат, закодированные байты,
+        сведения для манифеста).
+        """
+        source = image if image.mode in ('RGB', 'L') else image.convert('RGB')
+
+        is_gray = source.mode == 'L' or PageImageFormat._is_grayscale(source)
+        if is_gray and source.mode != 'L':
+            source = source.convert('L')
+
+        sample = source.copy()
+        sample.thumbnail((PageImageFormat.ANALYSIS_SIZE, PageImageFormat.ANALYSIS_SIZE))
+        entropy = (sample if sample.mode == 'L' else sample.convert('L')).entropy()
+        sample.close()
+
+        colors = source.getcolors(256)
+        color_count = len(colors) if colors else None
+
+        candidates: List[Tuple[Image.Image, str]]
+        png8_psnr = None
+        if is_gray:
+            if colors and {value for _, value in colors} <= {0, 255}:
+                kind = "bilevel"
+                candidates = [(source.convert('1'), "png")]
+            elif entropy < PageImageFormat.PHOTO_ENTROPY:
+                kind = "text"
+                candidates = [(source, "png")]
+            else:
+                kind = "grayscale"
+                candidates = [(source, "png"), (source, "jpeg")]
+        elif color_count:
+            kind = "palette"
+            candidates = [(source, "png8")]
+        elif entropy < PageImageFormat.PHOTO_ENTROPY:
+            kind = "graphics"
+            candidates = [(source, "webp")]
+            # Цветов больше 256: палитра теряет детали (градиенты, сглаживание)
+            quantized = source.quantize(colors=256, method=Image.Quantize.MEDIANCUT)
+            png8_psnr = Rasterizers.psnr(source, quantized)
+            if png8_psnr >= settings.PAGE_PNG8_MIN_PSNR:
+                candidates.insert(0, (quantized, "png8"))
+            else:
+                quantized.close()
+        else:
+            kind = "photo"
+            candidates = [(source, "webp_lossy"), (source, "jpeg")]
+
+        best = None
+        for candidate_image, candidate_format in candidates:
+            data = PageImageFormat.encode(candidate_image, candidate_format)
+            if best is None or len(data) < len(best[2]):
+                best = (candidate_image, candidate_format, data)
+
+        chosen_image, chosen_format, data = best
+        if chosen_image.mode == 'P' and kind == "graphics":
+            # Варианты страницы масштабируются из полноцветного растра и квантуются заново
+            chosen_image = source
+        info = {
+            "format": chosen_format,
+            "mode": chosen_image.mode,
+            "class": kind,
+            "colors": color_count,
+            "entropy": round(entropy, 3),
+            "png8_psnr": round(png8_psnr, 2) if png8_psnr is not None else None,
+            "width": chosen_image.width,
+            "height": chosen_image.height,
+            "bytes": len(data),
+        }
+        return chosen_image, chosen_format, data, info
+
+    @staticmethod
+    def _is_grayscale(image: Image.Image) -> bool:
+        red, green, blue = image.split()
+        for first, second in ((red, green), (green, blue)):
+            if ImageChops.difference(first, second).getextrema()[1] > PageImageFormat.GRAYSCALE_TOLERANCE:
+                return False
+        return True
@@ -0,0 +1,179 @@
+"""
+Очереди фоновых задач: конвертация документов и обслуживание кеша
+"""
+import time
+import uuid
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionJob:
+    """Фоновая задача над одним документом: конвертация или обслуживание кеша"""
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    # Типы задач
+    CONVERSION = "conversion"
+    PREWARM = "prewarm"  # Прогрев кеша страниц с водяными знаками
+    REENCODE = "reencode"  # Перекодирование растров в другой формат
+    REFRESH = "refresh"  # Перерендер устаревших страниц
+
+    def __init__(self, file_hash: str, job_type: str = CONVERSION):
+        self.id = uuid.uuid4().hex
+        self.file_hash = file_hash
+        self.job_type = job_type
+        self.status = ConversionJob.PENDING
+        self.pages_converted = 0
+        self.total_pages: Optional[int] = None
+        self.document_id: Optional[int] = None
+        self.failed_pages: List[int] = []  # Страницы, которые не удалось растеризовать
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in (ConversionJob.PENDING, ConversionJob.RUNNING)
+
+    @property
+    def pages_per_second(self) -> Optional[float]:
+        """Скорость конвертации (для подбора RASTER_WORKERS)"""
+        if not self.started_at or not self.pages_converted:
+            return None
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return round(self.pages_converted / elapsed, 2) if elapsed > 0 else None
+
+    def report_progress(self, pages_converted: int, total_pages: Optional[int] = None):
+        """Callback для конвертера: обновление прогресса"""
+        self.pages_converted = pages_converted
+        if total_pages is not None:
+            self.total_pages = total_pages
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "job_type": self.job_type,
+            "file_hash": self.file_hash,
+            "status": self.status,
+            "pages_converted": self.pages_converted,
+            "total_pages": self.total_pages,
+            "pages_per_second": self.pages_per_second,
+            "document_id": self.document_id,
+            "failed_pages": self.failed_pages,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class ConversionJobManager:
+    """Пул воркеров фоновых задач с собственным лимитом параллельности
+
+    Задачи выполняются вне event loop. Повторная постановка задачи того же
+    типа для того же file_hash (и task_key), пока предыдущая не завершена,
+    присоединяется к ней.
+    """
+
+    def __init__(self, max_workers: int, retention_seconds: int = 3600, thread_name_prefix: str = "conversion"):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, max_workers),
+            thread_name_prefix=thread_name_prefix
+        )
+        self._retention_seconds = retention_seconds
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, ConversionJob] = {}
+        self._active_by_key: Dict[Tuple[str, str, str], str] = {}
+
+    def get(self, job_id: str) -> Optional[ConversionJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def find_active(
+        self,
+        file_hash: str,
+        job_type: str = ConversionJob.CONVERSION,
+        task_key: str = ""
+    ) -> Optional[ConversionJob]:
+        """Активная (ожидающая или выполняющаяся) задача для файла"""
+        with self._lock:
+            job_id = self._active_by_key.get((job_type, file_hash, task_key))
+            return self._jobs.get(job_id) if job_id else None
+
+    def submit(
+        self,
+        file_hash: str,
+        target: Callable[..., Optional[int]],
+        *args,
+        job_type: str = ConversionJob.CONVERSION,
+        task_key: str = "",
+        **kwargs
+    ) -> Tuple[ConversionJob, bool]:
+        """Постановка задачи в очередь
+
+        target вызывается как target(job, *args, **kwargs) в потоке пула и
+        возвращает id документа. task_key различает задачи одного типа над
+        одним файлом (например, прогрев разных вариантов страниц).
+        Возвращает (задача, создана_ли_новая).
+        """
+        key = (job_type, file_hash, task_key)
+        with self._lock:
+            self._prune_locked()
+            job_id = self._active_by_key.get(key)
+            if job_id and self._jobs[job_id].is_active:
+                return self._jobs[job_id], False
+
+            job = ConversionJob(file_hash, job_type)
+            self._jobs[job.id] = job
+            self._active_by_key[key] = job.id
+
+        self._executor.submit(self._run, key, job, target, args, kwargs)
+        return job, True
+
+    def _run(self, key: Tuple[str, str, str], job: ConversionJob, target: Callable, args: tuple, kwargs: dict):
+        job.status = ConversionJob.RUNNING
+        job.started_at = time.time()
+        try:
+            job.document_id = target(job, *args, **kwargs)
+            job.status = ConversionJob.DONE
+        except Exception as e:
+            error_trace = traceback.format_exc()
+            logger.error(f"Job {job.id} ({job.job_type}) failed: {error_trace}")
+            print(f"[ERROR] Job {job.id} ({job.job_type}) failed: {error_trace}")
+            job.error = str(e)
+            job.status = ConversionJob.FAILED
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                if self._active_by_key.get(key) == job.id:
+                    del self._active_by_key[key]
+
+    def _prune_locked(self):
+        """Удаление давно завершенных задач из памяти"""
+        deadline = time.time() - self._retention_seconds
+        stale = [
+            job_id for job_id, job in self._jobs.items()
+            if not job.is_active and job.finished_at and job.finished_at < deadline
+        ]
+        for job_id in stale:
+            del self._jobs[job_id]
+
+
+conversion_jobs = ConversionJobManager(settings.CONVERSION_WORKERS)
+# Прогрев и обслуживание кеша не занимают воркеры конвертации новых документов
+maintenance_jobs = ConversionJobManager(settings.MAINTENANCE_WORKERS, thread_name_prefix="maintenance")
+
+
+def find_job(job_id: str) -> Optional[ConversionJob]:
+    """Задача любого типа по id"""
+    return conversion_jobs.get(job_id) or maintenance_jobs.get(job_id)
@@ -0,0 +1,200 @@
+"""
+Пул воркеров LibreOffice для конвертации PPT/PPTX в PDF
+"""
+import os
+import time
+import queue
+import shutil
+import signal
+import logging
+import threading
+import subprocess
+from typing import List, Optional
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class OfficePoolFullError(Exception):
+    """Очередь конвертаций LibreOffice переполнена"""
+
+
+class OfficeNotInstalledError(Exception):
+    """LibreOffice не установлен - конвертировать через пул нечем"""
+
+
+class OfficeWorker:
+    """Слот конвертации со своим профилем LibreOffice
+
+    Каждая конвертация - отдельный запуск `libreoffice --headless
+    --convert-to pdf`, который завершается вместе с ней. Профиль
+    (UserInstallation) у каждого воркера свой и переживает запуски:
+    его создание - заметная часть холодного старта офиса, а раздельные
+    профили не дают параллельным запускам передать работу чужому
+    экземпляру или упереться в блокировку профиля. Пока идет
+    конвертация, процесс офиса проверяется по таймауту и по памяти.
+    """
+
+    def __init__(self, index: int):
+        self.index = index
+        self.profile_dir = os.path.abspath(
+            os.path.join(settings.OFFICE_PROFILE_DIR, f"worker_{index}")
+        )
+        self.conversions = 0
+
+    @property
+    def _profile_arg(self) -> str:
+        return f"-env:UserInstallation=file://{self.profile_dir}"
+
+    def reset_profile(self):
+        """Новый профиль вместо накопившего состояние за много конвертаций"""
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+        self.conversions = 0
+
+    def convert_to_pdf(self, source_path: str, output_dir: str, timeout: int, max_memory_mb: int) -> str:
+        os.makedirs(self.profile_dir, exist_ok=True)
+        source_path = os.path.abspath(source_path)
+        output_dir = os.path.abspath(output_dir)
+        pdf_path = os.path.join(
+            output_dir, os.path.splitext(os.path.basename(source_path))[0] + ".pdf"
+        )
+
+        cmd = [
+            'libreoffice',
+            self._profile_arg,
+            '--headless',
+            '--invisible',
+            '--nologo',
+            '--nodefault',
+            '--norestore',
+            '--nolockcheck',
+            '--convert-to', 'pdf',
+            '--outdir', output_dir,
+            source_path
+        ]
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            start_new_session=True
+        )
+        self.conversions += 1
+        deadline = time.time() + timeout
+        try:
+            while True:
+                try:
+                    _, stderr = process.communicate(timeout=0.5)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                if time.time() > deadline:
+                    raise Exception(f"LibreOffice conversion timed out after {timeout}s")
+                if max_memory_mb:
+                    memory_mb = _process_tree_rss_kb(process.pid) / 1024
+                    if memory_mb > max_memory_mb:
+                        raise Exception(f"LibreOffice conversion exceeded {max_memory_mb} MB ({memory_mb:.0f} MB RSS)")
+        except BaseException:
+            # Завис или раздулся сам офис - убиваем весь запуск вместе с дочерними
+            # процессами; профиль после такого завершения мог остаться недописанным
+            _kill_process_group(process)
+            self.reset_profile()
+            raise
+
+        if process.returncode != 0 or not os.path.exists(pdf_path):
+            raise Exception(f"LibreOffice conversion failed: {stderr}")
+        return pdf_path
+
+
+class OfficePool:
+    """Пул воркеров LibreOffice с ограниченной очередью
+
+    Одновременно выполняется не больше size конвертаций, ждать своей очереди
+    могут не больше queue_size заданий - остальные сразу получают
+    OfficePoolFullError. Конвертация, превысившая timeout или max_memory_mb,
+    прерывается; профиль воркера создается заново после прерванной
+    конвертации и после каждых max_conversions конвертаций.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        queue_size: int,
+        timeout: int,
+        max_conversions: int,
+        max_memory_mb: int
+    ):
+        self._size = max(1, size)
+        self._timeout = timeout
+        self._max_conversions = max_conversions
+        self._max_memory_mb = max_memory_mb
+        self._slots = threading.BoundedSemaphore(self._size + max(0, queue_size))
+        self._idle: "queue.Queue[OfficeWorker]" = queue.Queue()
+        self._workers: List[OfficeWorker] = []
+        for index in range(self._size):
+            worker = OfficeWorker(index)
+            self._workers.append(worker)
+            self._idle.put(worker)
+
+    def convert_to_pdf(self, source_path: str, output_dir: str) -> str:
+        """Конвертация документа в PDF на свободном воркере"""
+        if shutil.which('libreoffice') is None:
+            raise OfficeNotInstalledError("LibreOffice is not installed")
+        if not self._slots.acquire(blocking=False):
+            raise OfficePoolFullError("LibreOffice conversion queue is full")
+        try:
+            worker = self._idle.get()
+            try:
+                return worker.convert_to_pdf(source_path, output_dir, self._timeout, self._max_memory_mb)
+            finally:
+                self._maybe_recycle(worker)
+                self._idle.put(worker)
+        finally:
+            self._slots.release()
+
+    def _maybe_recycle(self, worker: OfficeWorker):
+        if not self._max_conversions or worker.conversions < self._max_conversions:
+            return
+        print(f"[OFFICE POOL] Resetting profile of worker {worker.index}: {worker.conversions} conversions")
+        try:
+            worker.reset_profile()
+        except Exception as e:
+            logger.error(f"Failed to reset office worker {worker.index} profile: {e}")
+
+
+def _kill_process_group(process: subprocess.Popen):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        pass
+
+
+def _process_tree_rss_kb(pid: int) -> int:
+    """Сумма VmRSS процесса и всех его потомков (Linux /proc)"""
+    total = 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1])
+                    break
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except (OSError, ValueError):
+        return total
+    for child in children:
+        total += _process_tree_rss_kb(child)
+    return total
+
+
+office_pool = OfficePool(
+    size=settings.OFFICE_POOL_SIZE,
+    queue_size=settings.OFFICE_POOL_QUEUE_SIZE,
+    timeout=settings.OFFICE_CONVERSION_TIMEOUT,
+    max_conversions=settings.OFFICE_WORKER_MAX_CONVERSIONS,
+    max_memory_mb=settings.OFFICE_WORKER_MAX_MEMORY_MB
+)
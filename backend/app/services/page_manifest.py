@@ -0,0 +1,148 @@
+"""
+Манифест растров страниц документа (CACHE_DIR/<hash>/manifest.json)
+"""
+import os
+import json
+import time
+import fcntl
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+from app.services.image_formats import PageImageFormat
+from app.utils.helpers import get_keyed_lock
+
+
+class PageManifest:
+    """Сведения о каждой растеризованной странице
+
+    Для каждой страницы записываются параметры рендера (ключ render_key:
+    версия конвертера, DPI страницы, формат), размер страницы в пунктах,
+    фактический формат файла, размеры, объем и sha256 базового растра,
+    размеры вариантов; для формата "auto" - еще режим и класс содержимого.
+    По ключу устаревшая страница находится без чтения самого растра
+    и перерендеривается отдельно от остальных. Записанная страница служит
+    контрольной точкой конвертации; страницы, которые не удалось
+    растеризовать, перечислены в разделе "failed".
+    Чтение кешируется в памяти по inode и mtime файла. Запись защищена
+    файловой блокировкой: страницы одного документа пишут несколько
+    процессов растеризации. Манифест перезаписывается целиком, поэтому
+    растеризация записывает страницы пачками (update_pages), а не по одной.
+    """
+
+    FILENAME = "manifest.json"
+    VERSION = 1  # Версия структуры файла манифеста
+
+    _cache: Dict[str, Tuple[tuple, dict]] = {}
+    _cache_lock = threading.Lock()
+
+    @staticmethod
+    def path(output_dir: str) -> str:
+        return os.path.join(output_dir, PageManifest.FILENAME)
+
+    @staticmethod
+    def load(output_dir: str) -> dict:
+        manifest_path = PageManifest.path(output_dir)
+        try:
+            stat = os.stat(manifest_path)
+        except OSError:
+            return {"pages": {}}
+        # Файл всегда заменяется целиком (os.replace), поэтому новый inode = новая версия
+        version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        with PageManifest._cache_lock:
+            cached = PageManifest._cache.get(manifest_path)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        manifest = PageManifest._read(manifest_path)
+        with PageManifest._cache_lock:
+            PageManifest._cache[manifest_path] = (version, manifest)
+        return manifest
+
+    @staticmethod
+    def _read(manifest_path: str) -> dict:
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {"pages": {}}
+        manifest.setdefault("pages", {})
+        return manifest
+
+    @staticmethod
+    def get_page(output_dir: str, page_number: int) -> Optional[dict]:
+        return PageManifest.load(output_dir)["pages"].get(str(page_number))
+
+    @staticmethod
+    def rendered_pages(output_dir: str) -> List[int]:
+        """Номера страниц, для которых уже записан растр (по возрастанию)"""
+        return sorted(int(page_number) for page_number in PageManifest.load(output_dir)["pages"])
+
+    @staticmethod
+    def failed_pages(output_dir: str) -> List[int]:
+        """Номера страниц, которые не удалось растеризовать"""
+        return sorted(int(page_number) for page_number in PageManifest.load(output_dir).get("failed", {}))
+
+    @staticmethod
+    def get_failure(output_dir: str, page_number: int) -> Optional[dict]:
+        """Последняя неудача растеризации страницы: {error, failed_at, attempts} или None"""
+        return PageManifest.load(output_dir).get("failed", {}).get(str(page_number))
+
+    @staticmethod
+    def update_page(output_dir: str, page_number: int, entry: dict):
+        """Запись сведений о странице (атомарно, под блокировкой манифеста)"""
+        PageManifest.update_pages(output_dir, {page_number: entry})
+
+    @staticmethod
+    def update_pages(output_dir: str, entries: Dict[int, dict]):
+        """Запись сведений о нескольких страницах одной перезаписью манифеста"""
+        if not entries:
+            return
+
+        def apply(manifest: dict):
+            failed = manifest.get("failed", {})
+            for page_number, entry in entries.items():
+                manifest["pages"][str(page_number)] = entry
+                failed.pop(str(page_number), None)
+
+        PageManifest._modify(output_dir, apply)
+
+    @staticmethod
+    def mark_failed(output_dir: str, page_number: int, error: str):
+        """Отметка о неудачной растеризации страницы (прежний растр, если был, остается)"""
+        def apply(manifest: dict):
+            failed = manifest.setdefault("failed", {})
+            attempts = failed.get(str(page_number), {}).get("attempts", 0)
+            failed[str(page_number)] = {
+                "error": error[:500],
+                "failed_at": time.time(),
+                "attempts": attempts + 1,
+            }
+
+        PageManifest._modify(output_dir, apply)
+
+    @staticmethod
+    def _modify(output_dir: str, apply: Callable[[dict], None]):
+        manifest_path = PageManifest.path(output_dir)
+        with get_keyed_lock(manifest_path), open(f"{manifest_path}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Читаем мимо кеша: другой процесс мог записать манифест только что
+            manifest = PageManifest._read(manifest_path)
+            manifest["version"] = PageManifest.VERSION
+            apply(manifest)
+
+            tmp_path = f"{manifest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            os.replace(tmp_path, manifest_path)
+
+    @staticmethod
+    def page_format(output_dir: str, page_number: int, image_format: str) -> str:
+        """Конкретный формат хранения страницы
+
+        Берется из манифеста; у страницы без записи - формат документа
+        (для "auto" - формат по умолчанию).
+        """
+        entry = PageManifest.get_page(output_dir, page_number)
+        if entry and entry.get("format") in PageImageFormat.FORMATS:
+            return entry["format"]
+        return PageImageFormat.normalize(image_format)
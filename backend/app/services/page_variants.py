@@ -0,0 +1,125 @@
+"""
+Варианты разрешения страниц (thumbnail/mobile/desktop/retina)
+"""
+import os
+from typing import Dict, List, Optional
+from PIL import Image
+from app.core.config import settings
+from app.services.image_formats import PageImageFormat
+
+
+class PageVariants:
+    """Уменьшенные копии базового растра страницы
+
+    "retina" - исходный растр page_N.<ext>, остальные варианты лежат рядом
+    как page_N_<variant>.<ext> и имеют ширину из PAGE_VARIANT_WIDTHS.
+    Расширение зависит от формата хранения документа (Document.image_format).
+    Варианты не увеличивают изображение: если базовый растр уже уже
+    варианта, отдается он сам.
+    """
+
+    RETINA = "retina"
+
+    @staticmethod
+    def names() -> List[str]:
+        """Все варианты по возрастанию ширины"""
+        ordered = sorted(settings.PAGE_VARIANT_WIDTHS.items(), key=lambda item: item[1])
+        return [name for name, _ in ordered] + [PageVariants.RETINA]
+
+    @staticmethod
+    def select(
+        target_width: Optional[float] = None,
+        dpr: Optional[float] = None,
+        is_mobile: bool = False
+    ) -> str:
+        """Ближайший вариант не уже target_width * dpr физических пикселей"""
+        if not target_width or target_width <= 0:
+            # Без подсказок клиента: телефону - мобильный вариант, остальным - исходник
+            if is_mobile and "mobile" in settings.PAGE_VARIANT_WIDTHS:
+                return "mobile"
+            return PageVariants.RETINA
+
+        required_width = target_width * (dpr if dpr and dpr > 0 else 1)
+        for name in PageVariants.names()[:-1]:
+            if settings.PAGE_VARIANT_WIDTHS[name] >= required_width:
+                return name
+        return PageVariants.RETINA
+
+    @staticmethod
+    def variant_path(
+        output_dir: str,
+        page_number: int,
+        variant: str,
+        image_format: str = PageImageFormat.DEFAULT
+    ) -> str:
+        ext = PageImageFormat.extension(image_format)
+        if variant == PageVariants.RETINA:
+            return os.path.join(output_dir, f"page_{page_number}.{ext}")
+        return os.path.join(output_dir, f"page_{page_number}_{variant}.{ext}")
+
+    @staticmethod
+    def save_variants(
+        image: Image.Image,
+        output_dir: str,
+        page_number: int,
+        image_format: str = PageImageFormat.DEFAULT
+    ) -> Dict[str, dict]:
+        """Генерация всех уменьшенных вариантов из уже загруженного растра
+
+        Вариант не шире растра не создается, а оставшийся от прежнего
+        (более крупного) рендера удаляется. Возвращает размеры созданных
+        вариантов для манифеста страниц.
+        """
+        variants = {}
+        for name, width in settings.PAGE_VARIANT_WIDTHS.items():
+            path = PageVariants.variant_path(output_dir, page_number, name, image_format)
+            if image.width <= width:
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            height = PageVariants._save_resized(image, width, path, image_format)
+            variants[name] = {"width": width, "height": height, "bytes": os.path.getsize(path)}
+        return variants
+
+    @staticmethod
+    def ensure_variant(
+        output_dir: str,
+        page_number: int,
+        variant: str,
+        image_format: str = PageImageFormat.DEFAULT
+    ) -> Optional[str]:
+        """Путь к варианту страницы; недостающий вариант создается из базового растра
+
+        Возвращает None, если нет базового растра.
+        """
+        base_path = PageVariants.variant_path(output_dir, page_number, PageVariants.RETINA, image_format)
+        if variant == PageVariants.RETINA:
+            return base_path if os.path.exists(base_path) else None
+
+        path = PageVariants.variant_path(output_dir, page_number, variant, image_format)
+        if os.path.exists(path):
+            return path
+        if not os.path.exists(base_path):
+            return None
+
+        width = settings.PAGE_VARIANT_WIDTHS[variant]
+        with Image.open(base_path) as base_image:
+            if base_image.width <= width:
+                return base_path
+            PageVariants._save_resized(base_image, width, path, image_format)
+        return path
+
+    @staticmethod
+    def _save_resized(image: Image.Image, width: int, path: str, image_format: str) -> int:
+        height = max(1, round(image.height * width / image.width))
+        if image.mode == 'P':
+            source = image.convert('RGB')
+        elif image.mode == '1':
+            # 1-битный растр уменьшаем в оттенках серого, иначе текст рассыпается
+            source = image.convert('L')
+        else:
+            source = image
+        resized = source.resize((width, height), Image.Resampling.LANCZOS)
+        PageImageFormat.save_atomic(resized, path, image_format)
+        resized.close()
+        return height
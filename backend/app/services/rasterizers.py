@@ -0,0 +1,260 @@
+"""
+Бэкенды растеризации страниц PDF
+"""
+import os
+import json
+import math
+import time
+import shutil
+import subprocess
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+from pdf2image import convert_from_path
+from pdf2image.parsers import parse_buffer_to_ppm
+from PIL import Image, ImageChops, ImageStat
+from app.core.config import settings
+
+
+class Rasterizer(ABC):
+    """Бэкенд растеризации: диапазон страниц PDF -> список изображений RGB
+
+    Экземпляры без состояния; в процессы пула передается только имя
+    бэкенда (см. Rasterizers.get).
+    """
+
+    name = ""
+    command = ""
+
+    def available(self) -> bool:
+        return shutil.which(self.command) is not None
+
+    @abstractmethod
+    def render(
+        self,
+        pdf_path: str,
+        first_page: int,
+        last_page: int,
+        dpi: int,
+        timeout: Optional[int] = None
+    ) -> List[Image.Image]:
+        """Растеризация страниц first_page..last_page (включительно) в RGB"""
+
+
+class PdftoppmRasterizer(Rasterizer):
+    """pdftoppm через pdf2image с PNG на выходе (как раньше)"""
+
+    name = "pdftoppm"
+    command = "pdftoppm"
+
+    def render(self, pdf_path, first_page, last_page, dpi, timeout=None):
+        return convert_from_path(
+            pdf_path, dpi=dpi, fmt='png', first_page=first_page, last_page=last_page, timeout=timeout
+        )
+
+
+class PdftoppmRawRasterizer(Rasterizer):
+    """pdftoppm с несжатым PPM: те же пиксели без сжатия и распаковки PNG"""
+
+    name = "pdftoppm_raw"
+    command = "pdftoppm"
+
+    def render(self, pdf_path, first_page, last_page, dpi, timeout=None):
+        return convert_from_path(
+            pdf_path, dpi=dpi, fmt='ppm', first_page=first_page, last_page=last_page, timeout=timeout
+        )
+
+
+class PdftoppmNoAntialiasRasterizer(Rasterizer):
+    """pdftoppm без сглаживания текста и векторной графики (быстрее, грубее края)"""
+
+    name = "pdftoppm_noaa"
+    command = "pdftoppm"
+
+    def render(self, pdf_path, first_page, last_page, dpi, timeout=None):
+        result = subprocess.run(
+            [
+                self.command, "-r", str(dpi), "-f", str(first_page), "-l", str(last_page),
+                "-aa", "no", "-aaVector", "no", pdf_path
+            ],
+            capture_output=True,
+            timeout=timeout
+        )
+        images = parse_buffer_to_ppm(result.stdout) if result.stdout else []
+        if result.returncode != 0 and not images:
+            raise Exception(f"pdftoppm failed: {result.stderr.decode('utf-8', 'ignore').strip()}")
+        return images
+
+
+class PdftocairoRasterizer(Rasterizer):
+    """pdftocairo (cairo): другое сглаживание, на части документов быстрее"""
+
+    name = "pdftocairo"
+    command = "pdftocairo"
+
+    def render(self, pdf_path, first_page, last_page, dpi, timeout=None):
+        return convert_from_path(
+            pdf_path, dpi=dpi, fmt='png', first_page=first_page, last_page=last_page,
+            use_pdftocairo=True, timeout=timeout
+        )
+
+
+class PyMuPDFRasterizer(Rasterizer):
+    """MuPDF в процессе (без запуска внешней программы), нужен пакет pymupdf"""
+
+    name = "pymupdf"
+
+    def available(self) -> bool:
+        try:
+            import fitz  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def render(self, pdf_path, first_page, last_page, dpi, timeout=None):
+        import fitz
+
+        images = []
+        with fitz.open(pdf_path) as document:
+            for page_number in range(first_page, min(last_page, document.page_count) + 1):
+                pixmap = document[page_number - 1].get_pixmap(dpi=dpi, alpha=False)
+                images.append(Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples))
+        return images
+
+
+class Rasterizers:
+    """Реестр бэкендов растеризации и выбор бэкенда для документа
+
+    RASTERIZER_BACKEND задает бэкенд для всех документов; "auto" - бэкенд,
+    выбранный бенчмарком (benchmark_rasterizers.py --save) для типа
+    документа, а без результатов бенчмарка - DEFAULT.
+    """
+
+    DEFAULT = "pdftoppm"
+    AUTO = "auto"
+
+    BACKENDS: Dict[str, Rasterizer] = {
+        backend.name: backend
+        for backend in (
+            PdftoppmRasterizer(),
+            PdftoppmRawRasterizer(),
+            PdftoppmNoAntialiasRasterizer(),
+            PdftocairoRasterizer(),
+            PyMuPDFRasterizer(),
+        )
+    }
+
+    @staticmethod
+    def get(name: Optional[str]) -> Rasterizer:
+        return Rasterizers.BACKENDS.get(name) or Rasterizers.BACKENDS[Rasterizers.DEFAULT]
+
+    @staticmethod
+    def available() -> List[str]:
+        return [name for name, backend in Rasterizers.BACKENDS.items() if backend.available()]
+
+    @staticmethod
+    def document_kind(file_type: str) -> str:
+        """Тип документа для выбора бэкенда: PDF из презентаций рендерятся иначе, чем обычные"""
+        return "ppt" if file_type.lower() in ['ppt', 'pptx'] else "pdf"
+
+    @staticmethod
+    def selection_path() -> str:
+        return os.path.join(settings.CACHE_DIR, "rasterizers.json")
+
+    @staticmethod
+    def load_selection() -> Dict[str, str]:
+        try:
+            with open(Rasterizers.selection_path(), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def save_selection(file_type: str, name: str):
+        selection = Rasterizers.load_selection()
+        selection[Rasterizers.document_kind(file_type)] = name
+        os.makedirs(settings.CACHE_DIR, exist_ok=True)
+        tmp_path = f"{Rasterizers.selection_path()}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(selection, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, Rasterizers.selection_path())
+
+    @staticmethod
+    def for_file_type(file_type: str) -> str:
+        """Имя бэкенда для документа данного типа"""
+        name = settings.RASTERIZER_BACKEND
+        if name == Rasterizers.AUTO:
+            name = Rasterizers.load_selection().get(Rasterizers.document_kind(file_type), Rasterizers.DEFAULT)
+        if name not in Rasterizers.BACKENDS or not Rasterizers.BACKENDS[name].available():
+            return Rasterizers.DEFAULT
+        return name
+
+    @staticmethod
+    def benchmark(
+        pdf_path: str,
+        page_numbers: List[int],
+        dpi: int,
+        image_format: str,
+        names: Optional[List[str]] = None
+    ) -> List[dict]:
+        """Замер бэкендов на выборке страниц
+
+        Для каждого бэкенда: секунд на страницу, байт на страницу в формате
+        хранения и PSNR относительно DEFAULT (качество; inf - те же пиксели).
+        """
+        from app.services.image_formats import PageImageFormat
+
+        reference = {
+            page_number: Rasterizers.get(Rasterizers.DEFAULT).render(pdf_path, page_number, page_number, dpi)[0]
+            for page_number in page_numbers
+        }
+
+        results = []
+        for name in names or Rasterizers.available():
+            backend = Rasterizers.get(name)
+            elapsed = 0.0
+            total_bytes = 0
+            psnr_values = []
+            try:
+                for page_number in page_numbers:
+                    started = time.perf_counter()
+                    image = backend.render(pdf_path, page_number, page_number, dpi)[0]
+                    elapsed += time.perf_counter() - started
+                    total_bytes += len(PageImageFormat.encode(image, PageImageFormat.normalize(image_format)))
+                    psnr_values.append(Rasterizers.psnr(reference[page_number], image))
+                    image.close()
+            except Exception as e:
+                results.append({"backend": name, "error": str(e)})
+                continue
+            results.append({
+                "backend": name,
+                "seconds_per_page": elapsed / len(page_numbers),
+                "bytes_per_page": total_bytes // len(page_numbers),
+                "psnr": min(psnr_values),
+            })
+
+        for image in reference.values():
+            image.close()
+        return results
+
+    @staticmethod
+    def choose(results: List[dict], min_psnr: float) -> Optional[str]:
+        """Самый быстрый бэкенд, не хуже min_psnr по худшей странице выборки"""
+        passed = [result for result in results if "error" not in result and result["psnr"] >= min_psnr]
+        if not passed:
+            return None
+        return min(passed, key=lambda result: result["seconds_per_page"])["backend"]
+
+    @staticmethod
+    def psnr(reference: Image.Image, image: Image.Image) -> float:
+        """PSNR (дБ) изображения относительно эталона; другой размер - 0"""
+        if reference.size != image.size:
+            return 0.0
+        if reference.mode != 'RGB':
+            reference = reference.convert('RGB')
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        difference = ImageChops.difference(reference, image)
+        mse = sum(value * value for value in ImageStat.Stat(difference).rms) / 3
+        if mse == 0:
+            return math.inf
+        return 10 * math.log10(255 * 255 / mse)
@@ -0,0 +1,166 @@
+"""
+Пул рендера страниц вне event loop с ограниченной очередью
+"""
+import os
+import math
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Awaitable, Callable, Deque, Dict, Hashable, Optional, TypeVar
+from app.core.config import settings
+
+T = TypeVar("T")
+
+
+class RenderQueueFullError(Exception):
+    """Очередь рендера переполнена; retry_after - через сколько секунд повторить запрос"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Render queue is full")
+        self.retry_after = retry_after
+
+
+class RenderPool:
+    """Потоки для тяжелой работы над страницами с ограниченной очередью
+
+    Декодирование, наложение водяных знаков, кодирование, нарезка тайлов
+    и растеризация по требованию выполняются в size потоках, а не в event
+    loop: Pillow и NumPy на этих операциях отпускают GIL, а кеши планов
+    и шрифтов остаются общими. Пока рендеры загружают процессоры, дешевые
+    запросы (кеш в памяти, /health) обслуживаются без ожидания. Ждать
+    свободный поток могут не больше queue_size заданий - остальные сразу
+    получают RenderQueueFullError с оценкой, когда очередь освободится.
+    Глубина очереди и время ожидания в ней - в stats().
+    """
+
+    SAMPLES = 1000  # Сколько последних заданий учитывать в статистике времени
+
+    def __init__(self, size: int, queue_size: int):
+        self._size = max(1, size)
+        self._queue_size = max(0, queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=self._size, thread_name_prefix="render")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self.completed = 0
+        self.rejected = 0
+        self._waits: Deque[float] = deque(maxlen=self.SAMPLES)
+        self._durations: Deque[float] = deque(maxlen=self.SAMPLES)
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        """Выполнение func(*args) в пуле; RenderQueueFullError, если очередь заполнена"""
+        with self._lock:
+            if self._pending >= self._size + self._queue_size:
+                self.rejected += 1
+                raise RenderQueueFullError(self._retry_after_locked())
+            self._pending += 1
+
+        try:
+            future = self._executor.submit(self._run, func, args, time.monotonic())
+        except Exception:
+            self._release()
+            raise
+        # Освобождаем место и по завершении, и по отмене еще не начатого задания
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def _run(self, func: Callable[..., T], args: tuple, submitted_at: float) -> T:
+        started_at = time.monotonic()
+        with self._lock:
+            self._running += 1
+            self._waits.append(started_at - submitted_at)
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self.completed += 1
+                self._durations.append(time.monotonic() - started_at)
+
+    def _release(self, future: Optional[Future] = None):
+        with self._lock:
+            self._pending -= 1
+
+    def _retry_after_locked(self) -> int:
+        """Оценка в секундах, за сколько пул разберет текущую очередь"""
+        average = sum(self._durations) / len(self._durations) if self._durations else 1.0
+        return max(1, math.ceil(self._pending * average / self._size))
+
+    def stats(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            durations = list(self._durations)
+            running = self._running
+            queued = self._pending - self._running
+            completed = self.completed
+            rejected = self.rejected
+
+        def percentile(values: list, fraction: float) -> Optional[float]:
+            if not values:
+                return None
+            return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 1)
+
+        return {
+            "workers": self._size,
+            "queue_size": self._queue_size,
+            "running": running,
+            "queued": queued,
+            "completed": completed,
+            "rejected": rejected,
+            "wait_ms_p50": percentile(waits, 0.5),
+            "wait_ms_p95": percentile(waits, 0.95),
+            "wait_ms_max": round(waits[-1] * 1000, 1) if waits else None,
+            "render_ms_avg": round(sum(durations) / len(durations) * 1000, 1) if durations else None,
+        }
+
+
+class SingleFlight:
+    """Объединение одновременных одинаковых вычислений в процессе
+
+    Первый запрос с ключом запускает вычисление, остальные, пришедшие до его
+    окончания, ждут тот же результат (или ту же ошибку). Вычисление идет
+    отдельной задачей: если клиент первого запроса отключился, остальные
+    все равно получат результат. Работает в event loop процесса; между
+    процессами работу делит блокировка на файле (см. file_lock).
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, asyncio.Future] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def run(self, key: Hashable, compute: Callable[[], Awaitable[T]]) -> T:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(compute())
+            self._flights[key] = flight
+            flight.add_done_callback(lambda done: self._finish(key, done))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        return await asyncio.shield(flight)
+
+    def _finish(self, key: Hashable, flight: asyncio.Future):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        # Ошибку некому забрать, если все ожидавшие отключились - не пишем ее в лог asyncio
+        if not flight.cancelled():
+            flight.exception()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
+
+
+# Рендер страниц, тайлов и миниатюр для запросов viewer'а
+page_render_pool = RenderPool(
+    settings.RENDER_WORKERS or os.cpu_count() or 1,
+    settings.RENDER_QUEUE_SIZE
+)
+# Рендеры страниц с водяными знаками, идущие прямо сейчас (ключ - ключ кеша страницы)
+page_render_flights = SingleFlight()
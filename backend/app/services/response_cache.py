@@ -0,0 +1,93 @@
+"""
+Кеш закодированных ответов в памяти процесса
+"""
+import time
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Tuple
+from app.core.config import settings
+
+
+class ResponseCache:
+    """LRU закодированных изображений с лимитом по суммарному объему
+
+    Стоит перед дисковым кешем: попадание отдается без обращения к файлам.
+    Записи живут не дольше ttl секунд - страницу могли перерендерить в другом
+    процессе (скрипты обслуживания, другие воркеры uvicorn), а о таком
+    изменении этот процесс не узнает. Записи больше восьмой части бюджета
+    не кешируются, чтобы одна огромная страница не вытесняла все остальные.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[bytes, dict, float]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Tuple[bytes, dict]]:
+        """(данные, метаданные) или None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[2] > self.ttl:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, key: Hashable, data: bytes, meta: Optional[dict] = None):
+        size = len(data)
+        if self.max_bytes <= 0 or size > self.max_bytes // 8:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (data, meta or {}, time.monotonic())
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def invalidate(self, match: Callable[[Hashable], bool]) -> int:
+        """Удаление записей, ключи которых подходят под условие"""
+        with self._lock:
+            keys = [key for key in self._entries if match(key)]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / requests, 4) if requests else None,
+            }
+
+    def _remove(self, key: Hashable):
+        data, _, _ = self._entries.pop(key)
+        self._bytes -= len(data)
+
+
+# Страницы с водяными знаками: ключ (хеш документа, страница, вариант, область кеша)
+page_response_cache = ResponseCache(
+    settings.PAGE_RESPONSE_CACHE_MB * 1024 * 1024,
+    settings.PAGE_RESPONSE_CACHE_TTL
+)
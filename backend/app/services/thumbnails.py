@@ -0,0 +1,345 @@
+"""
+Спрайты миниатюр страниц для навигации по документу
+"""
+import os
+import glob
+import json
+import hashlib
+from typing import Callable, Dict, List, Optional, Tuple
+from PIL import Image
+from app.core.config import settings
+from app.services.image_formats import PageImageFormat
+from app.services.page_manifest import PageManifest
+from app.services.page_variants import PageVariants
+from app.utils.helpers import get_keyed_lock
+
+
+class ThumbnailSprites:
+    """Миниатюры всех страниц документа, упакованные в несколько спрайтов
+
+    Миниатюры шириной THUMBNAIL_WIDTH (длинные страницы - не выше двух
+    ширин) раскладываются рядами по THUMBNAIL_SPRITE_COLUMNS. Спрайт номер k
+    содержит страницы k*THUMBNAIL_SPRITE_PAGES+1 .. (k+1)*THUMBNAIL_SPRITE_PAGES.
+    На миниатюры, как и на страницы, накладываются водяные знаки, поэтому
+    спрайты и index.json с координатами страниц лежат отдельно для каждой
+    области кеша страниц: CACHE_DIR/<hash>/thumbnails/<область>.
+    Версия спрайта - хеш контрольных сумм растров его страниц, версии
+    водяных знаков и настроек миниатюр; она входит в имя файла, поэтому
+    спрайт одной версии никогда не меняется и кешируется клиентом надолго.
+    Перерендер или растеризация страницы пересобирает только спрайт ее
+    диапазона; каждый спрайт собирается отдельно (build_sheet), поэтому
+    один запрос не занимает пул рендера на весь документ. Страницы, которые еще не растеризованы, в спрайты не попадают.
+    """
+
+    VERSION = 2  # Версия раскладки спрайтов
+    INDEX_FILENAME = "index.json"
+
+    @staticmethod
+    def thumbnails_dir(output_dir: str, cache_scope: str) -> str:
+        return os.path.join(output_dir, "thumbnails", cache_scope)
+
+    @staticmethod
+    def sheet_path(output_dir: str, cache_scope: str, version: str, sheet: int) -> str:
+        ext = PageImageFormat.extension(settings.THUMBNAIL_SPRITE_FORMAT)
+        return os.path.join(
+            ThumbnailSprites.thumbnails_dir(output_dir, cache_scope), f"sprite_{version}_{sheet}.{ext}"
+        )
+
+    @staticmethod
+    def _index_path(output_dir: str, cache_scope: str) -> str:
+        return os.path.join(ThumbnailSprites.thumbnails_dir(output_dir, cache_scope), ThumbnailSprites.INDEX_FILENAME)
+
+    @staticmethod
+    def _page_sources(output_dir: str, total_pages: int, image_format: str) -> List[Tuple[int, str, str]]:
+        """(номер, формат страницы, отпечаток растра) для растеризованных страниц"""
+        manifest_pages = PageManifest.load(output_dir)["pages"]
+        sources = []
+        for page_number in range(1, total_pages + 1):
+            page_format = PageManifest.page_format(output_dir, page_number, image_format)
+            base_path = PageVariants.variant_path(output_dir, page_number, PageVariants.RETINA, page_format)
+            entry = manifest_pages.get(str(page_number))
+            if entry and entry.get("sha256"):
+                sources.append((page_number, page_format, entry["sha256"]))
+                continue
+            # Страница без записи в манифесте (кеш до появления манифеста) - по файлу
+            try:
+                stat = os.stat(base_path)
+            except OSError:
+                continue
+            sources.append((page_number, page_format, f"{stat.st_mtime_ns}:{stat.st_size}"))
+        return sources
+
+    @staticmethod
+    def _sheet_version(sources: List[Tuple[int, str, str]], watermark_version: str) -> str:
+        digest = hashlib.md5()
+        digest.update(json.dumps([
+            ThumbnailSprites.VERSION,
+            settings.THUMBNAIL_WIDTH,
+            settings.THUMBNAIL_SPRITE_COLUMNS,
+            settings.THUMBNAIL_SPRITE_PAGES,
+            settings.THUMBNAIL_SPRITE_FORMAT,
+            watermark_version,
+        ]).encode())
+        for page_number, _, fingerprint in sources:
+            digest.update(f"{page_number}={fingerprint};".encode())
+        return digest.hexdigest()[:16]
+
+    @staticmethod
+    def _load_index(output_dir: str, cache_scope: str) -> Optional[dict]:
+        try:
+            with open(ThumbnailSprites._index_path(output_dir, cache_scope), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def plan(
+        output_dir: str,
+        total_pages: int,
+        image_format: str,
+        cache_scope: str,
+        watermark_version: str
+    ) -> Tuple[Optional[dict], Dict[int, List[Tuple[int, str, str]]], Dict[int, str], str]:
+        """(актуальный индекс или None, страницы по спрайтам, версии спрайтов, версия индекса)"""
+        per_sheet = max(1, settings.THUMBNAIL_SPRITE_PAGES)
+        groups: Dict[int, List[Tuple[int, str, str]]] = {}
+        for page_source in ThumbnailSprites._page_sources(output_dir, total_pages, image_format):
+            groups.setdefault((page_source[0] - 1) // per_sheet, []).append(page_source)
+        versions = {
+            sheet_number: ThumbnailSprites._sheet_version(group, watermark_version)
+            for sheet_number, group in groups.items()
+        }
+        source = hashlib.md5(json.dumps(sorted(versions.items())).encode()).hexdigest()[:16]
+
+        index = ThumbnailSprites._load_index(output_dir, cache_scope)
+        if not index or index.get("source") != source:
+            index = None
+        return index, groups, versions, source
+
+    @staticmethod
+    def ensure(
+        output_dir: str,
+        total_pages: int,
+        image_format: str,
+        cache_scope: str,
+        watermark_version: str,
+        watermark: Callable[[Image.Image, int, float], Image.Image]
+    ) -> dict:
+        """Индекс спрайтов документа; устаревшие или недостающие спрайты собираются заново
+
+        cache_scope - область кеша страниц с водяными знаками,
+        watermark_version - версия их настроек, watermark(миниатюра, номер
+        страницы, масштаб к исходному растру) - наложение водяных знаков на
+        миниатюру. Индекс: {"source", "thumbnail_width", "format", "sheets":
+        {"<номер>": {"version", "width", "height", "bytes"}}, "pages":
+        {"<номер>": {"sheet", "x", "y", "width", "height"}}}.
+        Все спрайты собираются подряд; API собирает каждый спрайт отдельной
+        задачей пула рендера через plan, build_sheet и write_index.
+        """
+        index, groups, versions, source = ThumbnailSprites.plan(
+            output_dir, total_pages, image_format, cache_scope, watermark_version
+        )
+        if index:
+            return index
+        sheets = {
+            sheet_number: ThumbnailSprites.build_sheet(
+                output_dir, cache_scope, sheet_number, versions[sheet_number], group, watermark
+            )
+            for sheet_number, group in groups.items()
+        }
+        return ThumbnailSprites.write_index(output_dir, cache_scope, source, sheets)
+
+    @staticmethod
+    def build_sheet(
+        output_dir: str,
+        cache_scope: str,
+        sheet_number: int,
+        version: str,
+        group: List[Tuple[int, str, str]],
+        watermark: Callable[[Image.Image, int, float], Image.Image]
+    ) -> Optional[dict]:
+        """Спрайт одного диапазона страниц: {"version", "width", "height", "bytes", "pages"}
+
+        Спрайт версии version не меняется; рядом с ним лежит описание
+        с координатами страниц, поэтому готовый спрайт не собирается заново.
+        None - ни одной миниатюры диапазона построить не удалось.
+        """
+        sheet_path = ThumbnailSprites.sheet_path(output_dir, cache_scope, version, sheet_number)
+        info_path = ThumbnailSprites._sheet_info_path(sheet_path)
+        sheet_info = ThumbnailSprites._load_sheet_info(info_path, sheet_path)
+        if sheet_info:
+            return sheet_info
+
+        with get_keyed_lock(sheet_path):
+            # Пока ждали блокировку, спрайт мог собрать другой запрос
+            sheet_info = ThumbnailSprites._load_sheet_info(info_path, sheet_path)
+            if sheet_info:
+                return sheet_info
+
+            thumbnails = []
+            for page_number, page_format, _ in group:
+                try:
+                    thumbnails.append((
+                        page_number,
+                        ThumbnailSprites._thumbnail(output_dir, page_number, page_format, watermark)
+                    ))
+                except (OSError, ValueError) as e:
+                    # Растр пропал или перезаписывается - страница появится в следующей версии
+                    print(f"[WARN] Thumbnail for page {page_number} failed: {e}")
+            if not thumbnails:
+                return None
+
+            os.makedirs(os.path.dirname(sheet_path), exist_ok=True)
+            pages: Dict[str, dict] = {}
+            sheet_info = {
+                "version": version,
+                **ThumbnailSprites._pack(thumbnails, sheet_path, sheet_number, pages),
+                "pages": pages,
+            }
+            tmp_path = f"{info_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(sheet_info, f, ensure_ascii=False)
+            os.replace(tmp_path, info_path)
+            print(f"[THUMBNAILS] Sprite {sheet_number}: {len(pages)} pages ({cache_scope})")
+            return sheet_info
+
+    @staticmethod
+    def _sheet_info_path(sheet_path: str) -> str:
+        return f"{os.path.splitext(sheet_path)[0]}.json"
+
+    @staticmethod
+    def _load_sheet_info(info_path: str, sheet_path: str) -> Optional[dict]:
+        if not os.path.exists(sheet_path):
+            return None
+        try:
+            with open(info_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def write_index(
+        output_dir: str,
+        cache_scope: str,
+        source: str,
+        sheets: Dict[int, Optional[dict]]
+    ) -> dict:
+        """Индекс из собранных спрайтов; спрайты прежних версий удаляются"""
+        thumbnails_dir = ThumbnailSprites.thumbnails_dir(output_dir, cache_scope)
+        os.makedirs(thumbnails_dir, exist_ok=True)
+        index_sheets: Dict[str, dict] = {}
+        pages: Dict[str, dict] = {}
+        for sheet_number, sheet_info in sorted(sheets.items()):
+            if not sheet_info:
+                continue
+            index_sheets[str(sheet_number)] = {
+                key: value for key, value in sheet_info.items() if key != "pages"
+            }
+            pages.update(sheet_info["pages"])
+
+        index = {
+            "version": ThumbnailSprites.VERSION,
+            "source": source,
+            "thumbnail_width": settings.THUMBNAIL_WIDTH,
+            "format": PageImageFormat.normalize(settings.THUMBNAIL_SPRITE_FORMAT),
+            "sheets": index_sheets,
+            "pages": pages,
+        }
+        index_path = ThumbnailSprites._index_path(output_dir, cache_scope)
+        with get_keyed_lock(index_path):
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(index, f, ensure_ascii=False)
+            os.replace(tmp_path, index_path)
+
+            # Спрайты прежних версий больше не нужны
+            current = set()
+            for sheet_number, sheet in index_sheets.items():
+                sheet_path = ThumbnailSprites.sheet_path(output_dir, cache_scope, sheet["version"], int(sheet_number))
+                current.add(os.path.basename(sheet_path))
+                current.add(os.path.basename(ThumbnailSprites._sheet_info_path(sheet_path)))
+            stale = [
+                path for path in glob.glob(os.path.join(thumbnails_dir, "sprite_*"))
+                if os.path.basename(path) not in current and not path.endswith(".tmp")
+            ]
+            # Спрайты без водяных знаков из прежней раскладки (общие для всех зрителей)
+            legacy_dir = os.path.dirname(thumbnails_dir)
+            stale += glob.glob(os.path.join(legacy_dir, "sprite_*"))
+            stale += glob.glob(os.path.join(legacy_dir, ThumbnailSprites.INDEX_FILENAME))
+            for path in stale:
+                if os.path.isfile(path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+        print(f"[THUMBNAILS] {len(pages)} pages in {len(index_sheets)} sprite(s) ({cache_scope})")
+        return index
+
+    @staticmethod
+    def _thumbnail(
+        output_dir: str,
+        page_number: int,
+        page_format: str,
+        watermark: Callable[[Image.Image, int, float], Image.Image]
+    ) -> Image.Image:
+        """Миниатюра страницы с водяными знаками из самого маленького подходящего варианта растра"""
+        width = settings.THUMBNAIL_WIDTH
+        base_path = PageVariants.variant_path(output_dir, page_number, PageVariants.RETINA, page_format)
+        source_path = base_path
+        for name in PageVariants.names()[:-1]:
+            if settings.PAGE_VARIANT_WIDTHS[name] < width:
+                continue
+            variant_path = PageVariants.variant_path(output_dir, page_number, name, page_format)
+            if os.path.exists(variant_path):
+                source_path = variant_path
+                break
+
+        with Image.open(base_path) as full_image:
+            full_width = full_image.width
+        with Image.open(source_path) as image:
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            thumbnail = image.copy()
+        thumbnail.thumbnail((width, width * 2), Image.Resampling.LANCZOS)
+        # Знаки накладываются уже на миниатюру: размер шрифта - в ее масштабе
+        watermarked = watermark(thumbnail, page_number, thumbnail.width / full_width)
+        if watermarked is not thumbnail:
+            thumbnail.close()
+        return watermarked
+
+    @staticmethod
+    def _pack(
+        thumbnails: List[Tuple[int, Image.Image]],
+        sheet_path: str,
+        sheet_number: int,
+        pages: Dict[str, dict]
+    ) -> dict:
+        """Раскладка миниатюр рядами в один спрайт; координаты дописываются в pages"""
+        width = settings.THUMBNAIL_WIDTH
+        columns = max(1, min(settings.THUMBNAIL_SPRITE_COLUMNS, len(thumbnails)))
+
+        placements = []
+        y = 0
+        for row_start in range(0, len(thumbnails), columns):
+            row = thumbnails[row_start:row_start + columns]
+            for column, (page_number, thumbnail) in enumerate(row):
+                placements.append((page_number, thumbnail, column * width, y))
+            y += max(thumbnail.height for _, thumbnail in row)
+
+        sheet = Image.new('RGB', (columns * width, max(1, y)), 'white')
+        for page_number, thumbnail, x, top in placements:
+            sheet.paste(thumbnail, (x, top))
+            pages[str(page_number)] = {
+                "sheet": sheet_number,
+                "x": x,
+                "y": top,
+                "width": thumbnail.width,
+                "height": thumbnail.height,
+            }
+            thumbnail.close()
+
+        PageImageFormat.save_atomic(sheet, sheet_path, settings.THUMBNAIL_SPRITE_FORMAT)
+        sheet_info = {"width": sheet.width, "height": sheet.height, "bytes": os.path.getsize(sheet_path)}
+        sheet.close()
+        return sheet_info
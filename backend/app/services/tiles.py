@@ -0,0 +1,186 @@
+"""
+Пирамида тайлов страницы для четкого масштабирования (Deep Zoom)
+"""
+import io
+import math
+import os
+from typing import Callable, Tuple
+from PIL import Image
+from app.core.config import settings
+from app.services.image_formats import PageImageFormat
+from app.utils.helpers import get_keyed_lock
+
+
+class TilePyramid:
+    """Пирамида тайлов в раскладке DZI
+
+    Уровень max_level - полный размер страницы, каждый следующий уровень вниз
+    вдвое меньше, уровень 0 - изображение 1x1. Тайлы квадратные (TILE_SIZE)
+    без перекрытия. Уровни до размера базового растра нарезаются из страницы
+    с водяными знаками; над ними - deep_levels уровней крупнее растра
+    (каждый вдвое), которые растеризуются из PDF с большим DPI по
+    требованию (ensure_deep_level), чтобы при увеличении страница
+    оставалась четкой.
+    """
+
+    @staticmethod
+    def max_level(width: int, height: int) -> int:
+        return max(0, math.ceil(math.log2(max(width, height, 1))))
+
+    @staticmethod
+    def deep_levels(width: int, height: int) -> int:
+        """Сколько уровней крупнее базового растра width x height укладывается
+        в TILE_MAX_ZOOM и бюджет пикселей TILE_MAX_PIXELS"""
+        levels = 0
+        while (
+            2 ** (levels + 1) <= settings.TILE_MAX_ZOOM
+            and width * height * 4 ** (levels + 1) <= settings.TILE_MAX_PIXELS
+        ):
+            levels += 1
+        return levels
+
+    @staticmethod
+    def level_size(width: int, height: int, level: int) -> Tuple[int, int]:
+        scale = 2 ** (level - TilePyramid.max_level(width, height))
+        return max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale))
+
+    @staticmethod
+    def descriptor(
+        width: int,
+        height: int,
+        image_format: str = PageImageFormat.DEFAULT,
+        zoomable: bool = True
+    ) -> dict:
+        """Описание пирамиды в JSON-варианте формата DZI
+
+        width, height - размер базового растра; в описании - размер самого
+        крупного уровня с учетом deep_levels (zoomable=False - исходного PDF
+        нет, пирамида заканчивается растром).
+        """
+        zoom = 2 ** TilePyramid.deep_levels(width, height) if zoomable else 1
+        width, height = width * zoom, height * zoom
+        return {
+            "Image": {
+                "xmlns": "http://schemas.microsoft.com/deepzoom/2008",
+                "Format": PageImageFormat.extension(image_format),
+                "Overlap": "0",
+                "TileSize": str(settings.TILE_SIZE),
+                "Size": {"Width": str(width), "Height": str(height)}
+            },
+            "MaxLevel": TilePyramid.max_level(width, height)
+        }
+
+    @staticmethod
+    def tiles_dir(output_dir: str, cache_scope: str, page_number: int) -> str:
+        """Тайлы страницы с водяными знаками сессии (или общими для всех сессий)"""
+        return os.path.join(output_dir, "tiles", cache_scope, f"page_{page_number}")
+
+    @staticmethod
+    def tile_path(
+        tiles_dir: str,
+        level: int,
+        x: int,
+        y: int,
+        image_format: str = PageImageFormat.DEFAULT
+    ) -> str:
+        ext = PageImageFormat.extension(image_format)
+        return os.path.join(tiles_dir, str(level), f"{x}_{y}.{ext}")
+
+    @staticmethod
+    def ensure_level(
+        page_bytes: bytes,
+        tiles_dir: str,
+        level: int,
+        image_format: str = PageImageFormat.DEFAULT
+    ) -> bool:
+        """Нарезка всех тайлов уровня из закодированной страницы
+
+        Уровень режется целиком за один проход (одно масштабирование страницы).
+        Возвращает False, если такого уровня у страницы нет (в том числе для
+        уровней крупнее растра - их строит ensure_deep_level).
+        """
+        level_dir = os.path.join(tiles_dir, str(level))
+        done_marker = os.path.join(level_dir, ".done")
+        if os.path.exists(done_marker):
+            return True
+
+        with get_keyed_lock(level_dir):
+            if os.path.exists(done_marker):
+                return True
+
+            with Image.open(io.BytesIO(page_bytes)) as page_image:
+                width, height = page_image.size
+                if level < 0 or level > TilePyramid.max_level(width, height):
+                    return False
+
+                level_width, level_height = TilePyramid.level_size(width, height, level)
+                if (level_width, level_height) == (width, height):
+                    level_image = page_image.copy()
+                else:
+                    level_image = page_image.resize(
+                        (level_width, level_height), Image.Resampling.LANCZOS, reducing_gap=2.0
+                    )
+
+            TilePyramid._cut_level(level_image, tiles_dir, level, image_format)
+        return True
+
+    @staticmethod
+    def ensure_deep_level(
+        tiles_dir: str,
+        level: int,
+        width: int,
+        height: int,
+        render: Callable[[int, int], Image.Image],
+        image_format: str = PageImageFormat.DEFAULT
+    ) -> bool:
+        """Нарезка уровня крупнее базового растра width x height
+
+        render(ширина, высота) растеризует страницу из PDF в этом размере
+        и накладывает на нее водяные знаки. Возвращает False, если уровень
+        вне пирамиды или не укладывается в бюджет пикселей.
+        """
+        base_level = TilePyramid.max_level(width, height)
+        zoom_levels = level - base_level
+        if zoom_levels <= 0 or zoom_levels > TilePyramid.deep_levels(width, height):
+            return False
+
+        level_dir = os.path.join(tiles_dir, str(level))
+        done_marker = os.path.join(level_dir, ".done")
+        if os.path.exists(done_marker):
+            return True
+
+        with get_keyed_lock(level_dir):
+            if os.path.exists(done_marker):
+                return True
+
+            level_width, level_height = width * 2 ** zoom_levels, height * 2 ** zoom_levels
+            level_image = render(level_width, level_height)
+            if level_image.size != (level_width, level_height):
+                # DPI целый - растр может отличаться от точного размера на пиксель
+                resized = level_image.resize((level_width, level_height), Image.Resampling.LANCZOS)
+                level_image.close()
+                level_image = resized
+            TilePyramid._cut_level(level_image, tiles_dir, level, image_format)
+        return True
+
+    @staticmethod
+    def _cut_level(level_image: Image.Image, tiles_dir: str, level: int, image_format: str):
+        """Нарезка изображения уровня на тайлы и отметка о готовности уровня"""
+        level_dir = os.path.join(tiles_dir, str(level))
+        level_width, level_height = level_image.size
+        os.makedirs(level_dir, exist_ok=True)
+        tile_size = settings.TILE_SIZE
+        for y in range(math.ceil(level_height / tile_size)):
+            for x in range(math.ceil(level_width / tile_size)):
+                box = (
+                    x * tile_size,
+                    y * tile_size,
+                    min((x + 1) * tile_size, level_width),
+                    min((y + 1) * tile_size, level_height)
+                )
+                tile_path = TilePyramid.tile_path(tiles_dir, level, x, y, image_format)
+                PageImageFormat.save_atomic(level_image.crop(box), tile_path, image_format)
+        level_image.close()
+
+        with open(os.path.join(level_dir, ".done"), 'w') as f:
+            f.write("")
@@ -0,0 +1,330 @@
+"""
+Потоковая и докачиваемая загрузка файлов
+"""
+import os
+import json
+import time
+import uuid
+import zipfile
+import hashlib
+import threading
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional, Tuple
+from fastapi import UploadFile
+from app.core.config import settings
+
+
+class UploadTooLargeError(Exception):
+    """Загружаемый файл превышает MAX_FILE_SIZE"""
+
+
+class UploadOffsetError(Exception):
+    """Порция пришла не с того смещения, на котором остановилась загрузка"""
+
+    def __init__(self, offset: int):
+        super().__init__(f"Expected offset {offset}")
+        self.offset = offset
+
+
+class UploadStore:
+    """Временные файлы загрузок в UPLOAD_DIR/.partial
+
+    Файл пишется на диск порциями по UPLOAD_CHUNK_SIZE, MD5 считается по мере
+    поступления данных. Докачиваемая загрузка - это файл <id>.part и описание
+    <id>.json: клиент создает загрузку, отправляет порции с заголовком
+    Upload-Offset и после обрыва узнает, с какого смещения продолжить.
+    Состояние MD5 хранится в памяти; после перезапуска сервиса хеш
+    пересчитывается по уже принятой части файла при первой же порции
+    (restore_hash), а не только при завершении. Описание удаляется только
+    после того, как принятый файл зарегистрирован (forget), - до этого
+    завершение можно повторить.
+    """
+
+    _hashers: Dict[str, Tuple[int, "hashlib._Hash"]] = {}
+    _busy: set = set()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def partial_dir() -> str:
+        path = os.path.join(settings.UPLOAD_DIR, ".partial")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @staticmethod
+    async def save_upload_file(file: UploadFile, max_size: Optional[int] = None) -> Tuple[str, str, int]:
+        """Потоковое копирование загруженного файла во временный файл
+
+        max_size - лимит размера (по умолчанию MAX_FILE_SIZE).
+        Возвращает (путь к временному файлу, md5, размер).
+        """
+        max_size = max_size or settings.MAX_FILE_SIZE
+        tmp_path = os.path.join(UploadStore.partial_dir(), f"{uuid.uuid4().hex}.part")
+        file_hash = hashlib.md5()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                while True:
+                    chunk = await file.read(settings.UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_size:
+                        raise UploadTooLargeError()
+                    file_hash.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            UploadStore.discard_file(tmp_path)
+            raise
+        return tmp_path, file_hash.hexdigest(), size
+
+    @staticmethod
+    def save_stream(source: BinaryIO) -> Tuple[str, str, int]:
+        """То же для синхронного потока (например, файла внутри ZIP)"""
+        tmp_path = os.path.join(UploadStore.partial_dir(), f"{uuid.uuid4().hex}.part")
+        file_hash = hashlib.md5()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in iter(lambda: source.read(settings.UPLOAD_CHUNK_SIZE), b""):
+                    size += len(chunk)
+                    if size > settings.MAX_FILE_SIZE:
+                        raise UploadTooLargeError()
+                    file_hash.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            UploadStore.discard_file(tmp_path)
+            raise
+        return tmp_path, file_hash.hexdigest(), size
+
+    @staticmethod
+    def extract_archive(archive_path: str, extensions: List[str]) -> List[dict]:
+        """Распаковка документов из ZIP во временные файлы
+
+        Берутся только файлы с нужными расширениями (без служебных папок macOS),
+        имя файла - без пути внутри архива. До распаковки по заголовкам
+        архива проверяются число файлов, их суммарный размер и размер каждого
+        файла; при распаковке размер еще раз проверяется по фактическим
+        байтам - заголовку архива нельзя доверять.
+        Возвращает список {"filename", "tmp_path", "file_hash"} или
+        {"filename", "error"} для отклоненных файлов.
+        """
+        results = []
+        with zipfile.ZipFile(archive_path) as archive:
+            entries = [
+                entry for entry in archive.infolist()
+                if not entry.is_dir()
+                and not entry.filename.startswith("__MACOSX/")
+                and not os.path.basename(entry.filename).startswith(".")
+            ]
+            if len(entries) > settings.IMPORT_MAX_FILES:
+                raise UploadTooLargeError()
+            unpacked_size = sum(
+                entry.file_size for entry in entries
+                if os.path.splitext(entry.filename)[1].lower() in extensions
+            )
+            if unpacked_size > settings.IMPORT_MAX_UNPACKED_SIZE:
+                raise UploadTooLargeError()
+
+            for entry in entries:
+                filename = os.path.basename(entry.filename)
+                if os.path.splitext(filename)[1].lower() not in extensions:
+                    results.append({"filename": filename, "error": "unsupported file type"})
+                    continue
+                if entry.file_size > settings.MAX_FILE_SIZE:
+                    results.append({"filename": filename, "error": "file too large"})
+                    continue
+                try:
+                    with archive.open(entry) as source:
+                        tmp_path, file_hash, _ = UploadStore.save_stream(source)
+                except UploadTooLargeError:
+                    results.append({"filename": filename, "error": "file too large"})
+                    continue
+                results.append({"filename": filename, "tmp_path": tmp_path, "file_hash": file_hash})
+        return results
+
+    @staticmethod
+    def commit(tmp_path: str, file_path: str):
+        """Перенос принятого файла на постоянное место"""
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        os.replace(tmp_path, file_path)
+
+    @staticmethod
+    def discard_file(tmp_path: str):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+    # ---------- Докачиваемые загрузки ----------
+
+    @staticmethod
+    def _part_path(upload_id: str) -> str:
+        return os.path.join(UploadStore.partial_dir(), f"{upload_id}.part")
+
+    @staticmethod
+    def _meta_path(upload_id: str) -> str:
+        return os.path.join(UploadStore.partial_dir(), f"{upload_id}.json")
+
+    @staticmethod
+    def create(filename: str, total_size: int, name: Optional[str], watermark_settings: Optional[str]) -> dict:
+        """Новая докачиваемая загрузка"""
+        if total_size > settings.MAX_FILE_SIZE:
+            raise UploadTooLargeError()
+        UploadStore.prune_expired()
+
+        upload_id = uuid.uuid4().hex
+        meta = {
+            "upload_id": upload_id,
+            "filename": filename,
+            "total_size": total_size,
+            "name": name,
+            "watermark_settings": watermark_settings,
+            "created_at": time.time(),
+        }
+        open(UploadStore._part_path(upload_id), 'wb').close()
+        with open(UploadStore._meta_path(upload_id), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        with UploadStore._lock:
+            UploadStore._hashers[upload_id] = (0, hashlib.md5())
+        return {**meta, "offset": 0}
+
+    @staticmethod
+    def get(upload_id: str) -> Optional[dict]:
+        """Описание загрузки с текущим смещением (None, если загрузки нет)"""
+        if not upload_id.isalnum():
+            return None
+        try:
+            with open(UploadStore._meta_path(upload_id), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            offset = os.path.getsize(UploadStore._part_path(upload_id))
+        except (OSError, ValueError):
+            return None
+        return {**meta, "offset": offset}
+
+    @staticmethod
+    def _hash_file(path: str) -> "hashlib._Hash":
+        file_hash = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(settings.UPLOAD_CHUNK_SIZE), b""):
+                file_hash.update(chunk)
+        return file_hash
+
+    @staticmethod
+    def restore_hash(upload_id: str):
+        """Пересчет MD5 уже принятой части, если в памяти его нет (после перезапуска)
+
+        Вызывается вне event loop перед дописыванием порции: дальше хеш
+        снова считается по мере поступления данных.
+        """
+        meta = UploadStore.get(upload_id)
+        if meta is None:
+            return
+        with UploadStore._lock:
+            hashed_offset, _ = UploadStore._hashers.get(upload_id, (-1, None))
+            if hashed_offset == meta["offset"] or upload_id in UploadStore._busy:
+                return
+            UploadStore._busy.add(upload_id)
+        try:
+            part_path = UploadStore._part_path(upload_id)
+            offset = os.path.getsize(part_path)
+            file_hash = UploadStore._hash_file(part_path)
+            with UploadStore._lock:
+                UploadStore._hashers[upload_id] = (offset, file_hash)
+        except OSError:
+            pass
+        finally:
+            with UploadStore._lock:
+                UploadStore._busy.discard(upload_id)
+
+    @staticmethod
+    async def append(upload_id: str, offset: int, stream: AsyncIterator[bytes]) -> int:
+        """Дописывание порции с указанного смещения, возвращает новое смещение
+
+        Порция принимается потоково; если соединение оборвется, на диске
+        останется все, что успело прийти, и клиент продолжит с этого места.
+        """
+        meta = UploadStore.get(upload_id)
+        if meta is None:
+            raise KeyError(upload_id)
+        if offset != meta["offset"]:
+            raise UploadOffsetError(meta["offset"])
+
+        with UploadStore._lock:
+            if upload_id in UploadStore._busy:
+                raise UploadOffsetError(meta["offset"])
+            UploadStore._busy.add(upload_id)
+            hashed_offset, file_hash = UploadStore._hashers.get(upload_id, (-1, None))
+        # Хеш в памяти годится, только если он посчитан ровно до текущего смещения
+        if hashed_offset != offset:
+            file_hash = None
+
+        try:
+            with open(UploadStore._part_path(upload_id), 'ab') as f:
+                async for chunk in stream:
+                    if not chunk:
+                        continue
+                    if offset + len(chunk) > meta["total_size"]:
+                        raise UploadTooLargeError()
+                    f.write(chunk)
+                    offset += len(chunk)
+                    if file_hash is not None:
+                        file_hash.update(chunk)
+        finally:
+            with UploadStore._lock:
+                UploadStore._busy.discard(upload_id)
+                if file_hash is not None:
+                    UploadStore._hashers[upload_id] = (offset, file_hash)
+                else:
+                    UploadStore._hashers.pop(upload_id, None)
+        return offset
+
+    @staticmethod
+    def finish(upload_id: str) -> Tuple[str, str, dict]:
+        """Завершение загрузки: (путь к принятому файлу, md5, описание)
+
+        Вызывается вне event loop: при отсутствии хеша в памяти файл перечитывается.
+        Описание остается, пока вызывающий не зарегистрирует файл и не вызовет forget.
+        """
+        meta = UploadStore.get(upload_id)
+        if meta is None:
+            raise KeyError(upload_id)
+        if meta["offset"] != meta["total_size"]:
+            raise UploadOffsetError(meta["offset"])
+
+        part_path = UploadStore._part_path(upload_id)
+        with UploadStore._lock:
+            hashed_offset, file_hash = UploadStore._hashers.get(upload_id, (-1, None))
+        if hashed_offset != meta["offset"]:
+            file_hash = UploadStore._hash_file(part_path)
+            with UploadStore._lock:
+                UploadStore._hashers[upload_id] = (meta["offset"], file_hash)
+        return part_path, file_hash.hexdigest(), meta
+
+    @staticmethod
+    def forget(upload_id: str):
+        """Удаление описания загрузки, чей файл уже зарегистрирован"""
+        with UploadStore._lock:
+            UploadStore._hashers.pop(upload_id, None)
+        UploadStore.discard_file(UploadStore._meta_path(upload_id))
+
+    @staticmethod
+    def abort(upload_id: str):
+        with UploadStore._lock:
+            UploadStore._hashers.pop(upload_id, None)
+        UploadStore.discard_file(UploadStore._part_path(upload_id))
+        UploadStore.discard_file(UploadStore._meta_path(upload_id))
+
+    @staticmethod
+    def prune_expired():
+        """Удаление загрузок, в которые ничего не писали дольше UPLOAD_SESSION_TTL_HOURS"""
+        deadline = time.time() - settings.UPLOAD_SESSION_TTL_HOURS * 3600
+        partial_dir = UploadStore.partial_dir()
+        for filename in os.listdir(partial_dir):
+            # Время последней записи - у .part (в том числе у брошенных обычных загрузок)
+            if not filename.endswith(".part"):
+                continue
+            try:
+                if os.path.getmtime(os.path.join(partial_dir, filename)) >= deadline:
+                    continue
+            except OSError:
+                continue
+            UploadStore.abort(filename[:-len(".part")])
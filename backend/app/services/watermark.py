@@ -2,16 +2,140 @@
 Сервис наложения водяных знаков
 """
 import os
+import threading
+from collections import OrderedDict
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from datetime import datetime
-from typing import Optional
+from typing import Dict, List, Optional, Sequence, Tuple
 from app.models.schemas import WatermarkSettings
 from app.core.config import settings
 
 
+class WatermarkPlan:
+    """Подготовленное наложение водяных знаков для версии настроек и размера страницы
+    
+    Хранит загруженный шрифт, уже масштабированный логотип с прозрачностью
+    в альфа-канале и его позицию, цвет текста и размеры уже измеренных
+    строк. Строится один раз (WatermarkService.get_plan) и используется
+    всеми рендерами страниц такого размера, так что на странице остается
+    только наложение.
+    """
+    
+    # Сколько разных строк запоминать на план (строки с email/IP у каждого зрителя свои)
+    MAX_TEXT_SIZES = 1024
+    
+    def __init__(
+        self,
+        settings: WatermarkSettings,
+        image_size: Tuple[int, int],
+        static_watermark_path: Optional[str]
+    ):
+        self.image_size = image_size
+        self.static_logo: Optional[Image.Image] = None
+        self.static_position: Optional[Tuple[int, int]] = None
+        if settings.static_watermark_enabled and static_watermark_path:
+            self.static_logo = WatermarkService._prepare_static_watermark(
+                static_watermark_path, image_size, settings
+            )
+            if self.static_logo is not None:
+                self.static_position = WatermarkService._calculate_position(
+                    image_size, self.static_logo.size, settings.position
+                )
+        
+        self.font = WatermarkService._get_font(settings.font_size) if settings.dynamic_watermark_enabled else None
+        self.fill_color = (
+            settings.color_r,
+            settings.color_g,
+            settings.color_b,
+            int(255 * settings.opacity)
+        )
+        self._text_sizes: Dict[str, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+    
+    def text_size(self, text: str) -> Tuple[int, int]:
+        """Ширина и высота строки этим шрифтом"""
+        with self._lock:
+            size = self._text_sizes.get(text)
+        if size is None:
+            bbox = self.font.getbbox(text)
+            size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
+            with self._lock:
+                if len(self._text_sizes) >= WatermarkPlan.MAX_TEXT_SIZES:
+                    self._text_sizes.clear()
+                self._text_sizes[text] = size
+        return size
+
+
 class WatermarkService:
     """Сервис для наложения водяных знаков"""
     
+    # Планы наложения: (настройки, влияющие на план, размер страницы) -> WatermarkPlan
+    MAX_PLANS = 64
+    _plans: "OrderedDict[tuple, WatermarkPlan]" = OrderedDict()
+    _plans_lock = threading.Lock()
+    
+    # Растры строк водяного знака: (текст, размер шрифта, альфа) -> (маска, смещение)
+    MAX_TEXT_SPRITES = 256
+    _text_sprites: "OrderedDict[tuple, Tuple[Image.Image, Tuple[int, int]]]" = OrderedDict()
+    _text_sprites_lock = threading.Lock()
+    
+    # Шрифты по размеру; путь к файлу шрифта ищется один раз
+    _fonts: Dict[int, ImageFont.ImageFont] = {}
+    _font_path: Optional[str] = None
+    _font_path_resolved = False
+    _fonts_lock = threading.Lock()
+    
+    @staticmethod
+    def get_plan(
+        settings: WatermarkSettings,
+        image_size: Tuple[int, int],
+        static_watermark_path: Optional[str] = None
+    ) -> WatermarkPlan:
+        """План наложения из кеша или новый (ключ - влияющие на план настройки, размер страницы, логотип)"""
+        key = (WatermarkService._plan_settings_key(settings, static_watermark_path), tuple(image_size))
+        with WatermarkService._plans_lock:
+            plan = WatermarkService._plans.get(key)
+            if plan is not None:
+                WatermarkService._plans.move_to_end(key)
+                return plan
+        
+        plan = WatermarkPlan(settings, tuple(image_size), static_watermark_path)
+        with WatermarkService._plans_lock:
+            WatermarkService._plans[key] = plan
+            while len(WatermarkService._plans) > WatermarkService.MAX_PLANS:
+                WatermarkService._plans.popitem(last=False)
+        return plan
+    
+    @staticmethod
+    def _plan_settings_key(settings: WatermarkSettings, static_watermark_path: Optional[str]) -> tuple:
+        """Только то, из чего строится WatermarkPlan
+        
+        random_seed и состав текста у каждого зрителя свои, но план не меняют -
+        по ним план не различаем, иначе каждая сессия строила бы свой.
+        """
+        static_logo_key = None
+        if settings.static_watermark_enabled and static_watermark_path:
+            try:
+                static_mtime = os.stat(static_watermark_path).st_mtime_ns
+            except OSError:
+                static_mtime = None
+            static_logo_key = (
+                static_watermark_path,
+                static_mtime,
+                settings.static_watermark_scale,
+                settings.position
+            )
+        font_size = settings.font_size if settings.dynamic_watermark_enabled else None
+        return (
+            static_logo_key,
+            font_size,
+            settings.color_r,
+            settings.color_g,
+            settings.color_b,
+            settings.opacity
+        )
+    
     @staticmethod
     def apply_watermarks(
         image: Image.Image,
@@ -23,21 +147,19 @@ class WatermarkService:
         static_watermark_path: Optional[str] = None
     ) -> Image.Image:
         """Применение водяных знаков к изображению"""
+        plan = WatermarkService.get_plan(settings, image.size, static_watermark_path)
         result_image = image.copy()
         
         # Применяем статический водяной знак
-        if settings.static_watermark_enabled and static_watermark_path:
-            result_image = WatermarkService._apply_static_watermark(
-                result_image,
-                static_watermark_path,
-                settings
-            )
+        if plan.static_logo is not None:
+            result_image = WatermarkService._apply_static_watermark(result_image, plan)
         
         # Применяем динамический водяной знак
         if settings.dynamic_watermark_enabled:
             result_image = WatermarkService._apply_dynamic_watermark(
                 result_image,
                 settings,
+                plan,
                 user_email,
                 user_id,
                 ip_address,
@@ -47,71 +169,239 @@ class WatermarkService:
         return result_image
     
     @staticmethod
-    def _apply_static_watermark(
-        image: Image.Image,
+    def keeps_grayscale(settings: WatermarkSettings, plan: WatermarkPlan) -> bool:
+        """Остается ли серая страница серой после наложения (нет логотипа, текст серый)"""
+        if plan.static_logo is not None:
+            return False
+        return (
+            not settings.dynamic_watermark_enabled
+            or settings.color_r == settings.color_g == settings.color_b
+        )
+    
+    @staticmethod
+    def apply_watermarks_batch(
+        pages: np.ndarray,
+        settings: WatermarkSettings,
+        page_numbers: Sequence[Optional[int]],
+        user_email: Optional[str] = None,
+        user_id: Optional[str] = None,
+        ip_address: Optional[str] = None,
+        static_watermark_path: Optional[str] = None
+    ) -> np.ndarray:
+        """Наложение водяных знаков сразу на стопку страниц одного размера
+        
+        pages - массив uint8 формы (N, H, W, 3) со страницами RGB или (N, H, W)
+        с серыми страницами (только если keeps_grayscale); изменяется на месте
+        и возвращается. page_numbers - номера страниц стопки по порядку.
+        Результат попиксельно совпадает с apply_watermarks для каждой страницы,
+        но логотип и каждая строка смешиваются одной векторной операцией
+        для всех страниц сразу и только в своем прямоугольнике, так что
+        время определяется пропускной способностью памяти, а не Python.
+        """
+        if pages.dtype != np.uint8 or pages.ndim not in (3, 4) or (pages.ndim == 4 and pages.shape[3] != 3):
+            raise ValueError("Ожидается стопка страниц uint8 формы (N, H, W, 3) или (N, H, W)")
+        if len(page_numbers) != pages.shape[0]:
+            raise ValueError("Число номеров страниц не совпадает с размером стопки")
+        
+        height, width = pages.shape[1:3]
+        plan = WatermarkService.get_plan(settings, (width, height), static_watermark_path)
+        is_gray = pages.ndim == 3
+        if is_gray and not WatermarkService.keeps_grayscale(settings, plan):
+            raise ValueError("Серая стопка возможна только без логотипа и с серым текстом")
+        
+        if plan.static_logo is not None:
+            logo = np.asarray(plan.static_logo)
+            WatermarkService._blend_batch(pages, logo[..., 3], logo[..., :3], plan.static_position)
+        
+        if not settings.dynamic_watermark_enabled:
+            return pages
+        
+        # Текст отличается только номером страницы - группируем страницы по тексту
+        groups: Dict[str, List[int]] = {}
+        for index, page_number in enumerate(page_numbers):
+            watermark_text = WatermarkService._watermark_text(
+                settings, user_email, user_id, ip_address, page_number
+            )
+            if watermark_text:
+                groups.setdefault(watermark_text, []).append(index)
+        
+        fill = np.array(settings.color_r if is_gray else plan.fill_color[:3], dtype=np.uint16)
+        for watermark_text, indices in groups.items():
+            text_mask, (offset_x, offset_y) = WatermarkService._get_text_sprite(
+                watermark_text, plan.font, settings.font_size, plan.fill_color[3]
+            )
+            mask = np.asarray(text_mask)
+            positions = WatermarkService._text_positions(
+                (width, height), plan.text_size(watermark_text), settings, user_email, user_id
+            )
+            rows = None if len(indices) == len(page_numbers) else np.array(indices)
+            for x, y in positions:
+                WatermarkService._blend_batch(pages, mask, fill, (x + offset_x, y + offset_y), rows)
+        
+        return pages
+    
+    @staticmethod
+    def _blend_batch(
+        pages: np.ndarray,
+        alpha: np.ndarray,
+        color: np.ndarray,
+        position: Tuple[int, int],
+        rows: Optional[np.ndarray] = None
+    ):
+        """Смешивание цвета по альфа-маске в прямоугольнике страниц стопки
+        
+        Та же арифметика, что у Image.paste с маской: (a*(255-m) + c*m)/255
+        с округлением PIL, поэтому результат совпадает до бита.
+        rows - индексы страниц стопки (None - все страницы).
+        """
+        x, y = position
+        mask_height, mask_width = alpha.shape
+        # Обрезка по границам страницы
+        left, top = max(0, x), max(0, y)
+        right = min(pages.shape[2], x + mask_width)
+        bottom = min(pages.shape[1], y + mask_height)
+        if left >= right or top >= bottom:
+            return
+        
+        crop = (slice(top - y, bottom - y), slice(left - x, right - x))
+        alpha = alpha[crop].astype(np.uint16)
+        color = color.astype(np.uint16)
+        if color.ndim >= 2:
+            color = color[crop]
+        if pages.ndim == 4:
+            alpha = alpha[..., np.newaxis]
+        
+        area = (slice(None) if rows is None else rows, slice(top, bottom), slice(left, right))
+        blended = pages[area].astype(np.uint16) * (255 - alpha) + color * alpha + 128
+        pages[area] = (blended + (blended >> 8)) >> 8
+    
+    @staticmethod
+    def is_viewer_specific(settings: WatermarkSettings) -> bool:
+        """Зависит ли результат apply_watermarks от зрителя
+        
+        Статический знак и текст без данных пользователя (свой текст, номер
+        страницы) у всех зрителей одинаковы; email, ID, IP и время - нет.
+        """
+        if not settings.dynamic_watermark_enabled:
+            return False
+        return (
+            settings.show_user_email
+            or settings.show_user_id
+            or settings.show_ip_address
+            or settings.show_timestamp
+        )
+    
+    @staticmethod
+    def settings_version(settings: WatermarkSettings, static_watermark_path: Optional[str]) -> str:
+        """Короткий хеш настроек и файла статического знака (для ключей кеша)"""
+        import json
+        import hashlib
+        
+        static_mtime = None
+        if static_watermark_path:
+            try:
+                static_mtime = os.stat(static_watermark_path).st_mtime_ns
+            except OSError:
+                pass
+        payload = json.dumps(
+            [settings.dict(), static_watermark_path, static_mtime],
+            sort_keys=True,
+            default=str
+        )
+        return hashlib.md5(payload.encode()).hexdigest()[:12]
+    
+    @staticmethod
+    def _prepare_static_watermark(
         watermark_path: str,
+        image_size: Tuple[int, int],
         settings: WatermarkSettings
-    ) -> Image.Image:
-        """Применение статического водяного знака (логотип)"""
+    ) -> Optional[Image.Image]:
+        """Логотип, масштабированный под страницу, с прозрачностью в альфа-канале"""
         if not os.path.exists(watermark_path):
-            return image
+            return None
         
         try:
-            watermark_img = Image.open(watermark_path)
-            
-            # Конвертируем в RGBA если нужно
-            if watermark_img.mode != 'RGBA':
-                watermark_img = watermark_img.convert('RGBA')
+            with Image.open(watermark_path) as source:
+                # Конвертируем в RGBA если нужно
+                watermark_img = source.convert('RGBA') if source.mode != 'RGBA' else source.copy()
             
             # Масштабируем водяной знак
-            img_width, img_height = image.size
+            img_width, img_height = image_size
             scale = settings.static_watermark_scale if hasattr(settings, 'static_watermark_scale') else 0.2
             
-            new_width = int(img_width * scale)
-            new_height = int(watermark_img.height * (new_width / watermark_img.width))
+            new_width = max(1, int(img_width * scale))
+            new_height = max(1, int(watermark_img.height * (new_width / watermark_img.width)))
             watermark_img = watermark_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
             
-            # Применяем прозрачность
+            # Применяем прозрачность (таблица вместо lambda на каждый пиксель)
             opacity = int(255 * settings.opacity)
-            alpha = watermark_img.split()[3]
-            alpha = alpha.point(lambda p: int(p * opacity / 255))
+            alpha = watermark_img.getchannel('A').point([p * opacity // 255 for p in range(256)])
             watermark_img.putalpha(alpha)
-            
-            # Позиционируем водяной знак
-            position = WatermarkService._calculate_position(
-                image.size,
-                watermark_img.size,
-                settings.position
-            )
-            
-            # Накладываем водяной знак
-            if image.mode != 'RGBA':
-                image = image.convert('RGBA')
-            
-            image.paste(watermark_img, position, watermark_img)
-            
-            # Конвертируем обратно в RGB если нужно
-            if image.mode == 'RGBA':
-                rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-                rgb_image.paste(image, mask=image.split()[3])
-                image = rgb_image
-            
-            return image
+            return watermark_img
             
         except Exception as e:
             print(f"Ошибка применения статического водяного знака: {e}")
-            return image
+            return None
+    
+    @staticmethod
+    def _apply_static_watermark(image: Image.Image, plan: WatermarkPlan) -> Image.Image:
+        """Применение статического водяного знака (логотип) по готовому плану"""
+        # Логотип может быть цветным, поэтому страница переводится в RGB;
+        # наложение по альфе логотипа - без промежуточного RGBA всей страницы
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.paste(plan.static_logo, plan.static_position, plan.static_logo)
+        return image
     
     @staticmethod
     def _apply_dynamic_watermark(
         image: Image.Image,
         settings: WatermarkSettings,
+        plan: WatermarkPlan,
         user_email: Optional[str],
         user_id: Optional[str],
         ip_address: Optional[str],
         page_number: Optional[int]
     ) -> Image.Image:
         """Применение динамического водяного знака"""
+        watermark_text = WatermarkService._watermark_text(settings, user_email, user_id, ip_address, page_number)
+        if not watermark_text:
+            return image
+        
+        # Размер текста - из плана; строка растеризуется один раз в маленькую маску
+        text_mask, (offset_x, offset_y) = WatermarkService._get_text_sprite(
+            watermark_text, plan.font, settings.font_size, plan.fill_color[3]
+        )
+        positions = WatermarkService._text_positions(
+            image.size, plan.text_size(watermark_text), settings, user_email, user_id
+        )
+        
+        # Серые страницы (формат "auto") с серым водяным знаком остаются в режиме L,
+        # остальные переводятся в RGB (текст цветной)
+        if image.mode in ('L', '1') and settings.color_r == settings.color_g == settings.color_b:
+            if image.mode != 'L':
+                image = image.convert('L')
+            fill = settings.color_r
+        else:
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            fill = plan.fill_color[:3]
+        
+        # Штампуем цвет по маске строки только в нужных местах - без слоя во всю страницу
+        for x, y in positions:
+            image.paste(fill, (x + offset_x, y + offset_y), text_mask)
+        
+        return image
+    
+    @staticmethod
+    def _watermark_text(
+        settings: WatermarkSettings,
+        user_email: Optional[str],
+        user_id: Optional[str],
+        ip_address: Optional[str],
+        page_number: Optional[int]
+    ) -> Optional[str]:
+        """Текст динамического водяного знака (None - выводить нечего)"""
         # Формируем текст водяного знака
         parts = []
         
@@ -132,69 +422,65 @@ class WatermarkService:
         if settings.show_timestamp:
             parts.append(datetime.now().strftime("%Y-%m-%d %H:%M"))
         
-        if not parts:
-            return image
-        
-        watermark_text = " | ".join(parts)
-        
-        # Создаем полупрозрачный слой
-        overlay = Image.new('RGBA', image.size, (255, 255, 255, 0))
-        overlay_draw = ImageDraw.Draw(overlay)
-        
-        # Загружаем шрифт
-        font = WatermarkService._get_font(settings.font_size)
-        
-        # Цвет водяного знака
-        fill_color = (
-            settings.color_r,
-            settings.color_g,
-            settings.color_b,
-            int(255 * settings.opacity)
-        )
-        
-        # Получаем размер текста
-        bbox = overlay_draw.textbbox((0, 0), watermark_text, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-        
+        return " | ".join(parts) if parts else None
+    
+    @staticmethod
+    def _text_positions(
+        image_size: Tuple[int, int],
+        text_size: Tuple[int, int],
+        settings: WatermarkSettings,
+        user_email: Optional[str],
+        user_id: Optional[str]
+    ) -> list:
+        """Точки вывода строки на странице"""
         # Определяем, использовать ли случайное размещение
         use_random = getattr(settings, 'random_positions_enabled', True)
         positions_count = getattr(settings, 'positions_count', 5)
         
         if use_random and positions_count > 1:
             # Генерируем случайные позиции
-            positions = WatermarkService._generate_random_positions(
-                image.size,
-                (text_width, text_height),
+            return WatermarkService._generate_random_positions(
+                image_size,
+                text_size,
                 positions_count,
                 getattr(settings, 'random_seed', None) or user_id or user_email or "default"
             )
-            
-            # Рисуем водяной знак в каждой позиции
-            for pos in positions:
-                overlay_draw.text(pos, watermark_text, font=font, fill=fill_color)
-        else:
-            # Используем старый способ - одна позиция
-            position = WatermarkService._calculate_text_position(
-                image.size,
-                (text_width, text_height),
-                settings.position
-            )
-            overlay_draw.text(position, watermark_text, font=font, fill=fill_color)
-        
-        # Накладываем водяной знак
-        if image.mode != 'RGBA':
-            image = image.convert('RGBA')
-        
-        image = Image.alpha_composite(image, overlay)
-        
-        # Конвертируем обратно в RGB если нужно
-        if image.mode == 'RGBA':
-            rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-            rgb_image.paste(image, mask=image.split()[3])
-            image = rgb_image
-        
-        return image
+        # Используем старый способ - одна позиция
+        return [WatermarkService._calculate_text_position(
+            image_size,
+            text_size,
+            settings.position
+        )]
+    
+    @staticmethod
+    def _get_text_sprite(
+        text: str,
+        font: ImageFont.ImageFont,
+        font_size: int,
+        alpha: int
+    ) -> Tuple[Image.Image, Tuple[int, int]]:
+        """Маска строки (альфа = прозрачность * покрытие глифов) и ее смещение от точки вывода текста
+        
+        Маска обрезана по габаритам текста и кешируется: строка одного
+        зрителя одинакова на всех страницах.
+        """
+        key = (text, font_size, alpha)
+        with WatermarkService._text_sprites_lock:
+            sprite = WatermarkService._text_sprites.get(key)
+            if sprite is not None:
+                WatermarkService._text_sprites.move_to_end(key)
+                return sprite
+        
+        left, top, right, bottom = font.getbbox(text)
+        mask = Image.new('L', (max(1, right - left), max(1, bottom - top)), 0)
+        ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=alpha)
+        sprite = (mask, (left, top))
+        
+        with WatermarkService._text_sprites_lock:
+            WatermarkService._text_sprites[key] = sprite
+            while len(WatermarkService._text_sprites) > WatermarkService.MAX_TEXT_SPRITES:
+                WatermarkService._text_sprites.popitem(last=False)
+        return sprite
     
     @staticmethod
     def _generate_random_positions(
@@ -310,22 +596,35 @@ class WatermarkService:
     
     @staticmethod
     def _get_font(size: int) -> ImageFont.FreeTypeFont:
-        """Получение шрифта"""
-        font_paths = [
-            "arial.ttf",
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-            "/System/Library/Fonts/Helvetica.ttc",
-            "C:/Windows/Fonts/arial.ttf",
-        ]
-        
-        for font_path in font_paths:
-            try:
-                if os.path.exists(font_path):
-                    return ImageFont.truetype(font_path, size)
-            except:
-                continue
-        
-        return ImageFont.load_default()
+        """Получение шрифта (загруженные шрифты кешируются по размеру)"""
+        with WatermarkService._fonts_lock:
+            font = WatermarkService._fonts.get(size)
+            if font is not None:
+                return font
+            
+            if not WatermarkService._font_path_resolved:
+                font_paths = [
+                    "arial.ttf",
+                    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+                    "/System/Library/Fonts/Helvetica.ttc",
+                    "C:/Windows/Fonts/arial.ttf",
+                ]
+                for font_path in font_paths:
+                    try:
+                        if os.path.exists(font_path):
+                            ImageFont.truetype(font_path, size)
+                            WatermarkService._font_path = font_path
+                            break
+                    except:
+                        continue
+                WatermarkService._font_path_resolved = True
+            
+            if WatermarkService._font_path:
+                font = ImageFont.truetype(WatermarkService._font_path, size)
+            else:
+                font = ImageFont.load_default()
+            WatermarkService._fonts[size] = font
+            return font
     
     @staticmethod
     def _calculate_position(
@@ -2,9 +2,19 @@
 Вспомогательные функции
 """
 import hashlib
+import os
 import re
+import fcntl
+import glob
+import threading
+import weakref
+from contextlib import contextmanager
 from pathlib import Path
 
+# Именованные блокировки: живут, пока их кто-то держит или ждет
+_keyed_locks: "weakref.WeakValueDictionary[str, threading.Lock]" = weakref.WeakValueDictionary()
+_keyed_locks_guard = threading.Lock()
+
 
 def secure_filename(filename: str) -> str:
     """Безопасное имя файла"""
@@ -20,3 +30,66 @@ def calculate_file_hash(file_path: str) -> str:
         for chunk in iter(lambda: f.read(4096), b""):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
+
+
+def get_keyed_lock(key: str) -> threading.Lock:
+    """Общая блокировка для всех потоков, работающих с одним ключом (например, файлом)"""
+    with _keyed_locks_guard:
+        lock = _keyed_locks.get(key)
+        if lock is None:
+            lock = threading.Lock()
+            _keyed_locks[key] = lock
+        return lock
+
+
+def cache_lock_path(output_dir: str, name: str) -> str:
+    """Файл блокировки для file_lock в каталоге locks/ кеша документа
+
+    Блокировки лежат отдельно от файлов кеша: удаление устаревших файлов
+    по маске не задевает блокировки, которые кто-то держит. Удалять файлы
+    блокировок можно только через remove_cache_locks.
+    """
+    return os.path.join(output_dir, "locks", f"{name}.lock")
+
+
+# Файл в каталоге блокировок: держатели file_lock берут на нем общую
+# блокировку, сборщик remove_cache_locks - исключительную
+_LOCKS_GUARD = ".guard"
+
+
+@contextmanager
+def file_lock(lock_path: str):
+    """Блокировка между процессами (flock на файле lock_path) и потоками этого процесса"""
+    lock_dir = os.path.dirname(lock_path) or "."
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, _LOCKS_GUARD), 'a') as guard_file:
+        # Пока держим общую блокировку каталога, файл lock_path никто не удалит
+        fcntl.flock(guard_file, fcntl.LOCK_SH)
+        with get_keyed_lock(lock_path), open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+
+def remove_cache_locks(output_dir: str, pattern: str = "*") -> bool:
+    """Удаление файлов блокировок кеша документа (имя без .lock - по маске pattern)
+
+    Удаленный файл, который кто-то держит, не защищал бы следующего
+    пришедшего: тот открыл бы новый файл и не стал бы ждать. Поэтому файлы
+    удаляются только под исключительной блокировкой каталога, то есть когда
+    ни одна file_lock в нем не взята. Если каталог занят, ничего не удаляется
+    (уберет следующая очистка); возвращает, удалось ли убрать файлы.
+    """
+    lock_dir = os.path.join(output_dir, "locks")
+    if not os.path.isdir(lock_dir):
+        return True
+    with open(os.path.join(lock_dir, _LOCKS_GUARD), 'a') as guard_file:
+        try:
+            fcntl.flock(guard_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        for lock_path in glob.glob(os.path.join(lock_dir, f"{pattern}.lock")):
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+    return True
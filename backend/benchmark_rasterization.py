@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Скрипт для замера скорости растеризации PDF на разном количестве процессов
+Запуск: docker exec secure-content-backend python benchmark_rasterization.py /app/uploads/<file>.pdf [--max-workers 16]
+"""
+import sys
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+# Добавляем путь к приложению
+sys.path.insert(0, '/app')
+
+from app.core.config import settings
+from app.services.converter import DocumentConverter
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PDF rasterization scaling")
+    parser.add_argument("pdf_path", help="PDF для замера")
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=DocumentConverter.raster_workers(),
+        help="Максимальное количество процессов (по умолчанию RASTER_WORKERS или число ядер)"
+    )
+    parser.add_argument("--dpi", type=int, default=settings.PDF_DPI)
+    parser.add_argument("--format", default=settings.PAGE_IMAGE_FORMAT, help="Формат хранения страниц")
+    args = parser.parse_args()
+    
+    # 1, 2, 4, ... max_workers
+    worker_counts = []
+    workers = 1
+    while workers < args.max_workers:
+        worker_counts.append(workers)
+        workers *= 2
+    worker_counts.append(args.max_workers)
+    
+    total_pages = DocumentConverter.get_pdf_page_count(args.pdf_path)
+    
+    print("=" * 60)
+    print("  Rasterization Benchmark")
+    print("=" * 60)
+    print(f"\n[INFO] {args.pdf_path}: {total_pages} pages, {args.dpi} DPI, format {args.format}")
+    print(f"[INFO] Chunk size: {settings.PDF_CHUNK_SIZE} pages\n")
+    print(f"{'workers':>8} {'seconds':>10} {'pages/sec':>10} {'speedup':>8}")
+    
+    baseline = None
+    for workers in worker_counts:
+        output_dir = tempfile.mkdtemp(prefix="scs-bench-")
+        try:
+            started = time.time()
+            DocumentConverter.convert_pdf_to_images(
+                args.pdf_path,
+                output_dir,
+                dpi=args.dpi,
+                image_format=args.format,
+                workers=workers
+            )
+            elapsed = time.time() - started
+        except Exception as e:
+            print(f"[ERROR] {workers} workers: {e}")
+            return 1
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        
+        if baseline is None:
+            baseline = elapsed
+        print(f"{workers:>8} {elapsed:>10.2f} {total_pages / elapsed:>10.2f} {baseline / elapsed:>7.2f}x")
+    
+    print("\n" + "=" * 60)
+    print("  Benchmark complete!")
+    print("=" * 60)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Скрипт для сравнения бэкендов растеризации на выборке страниц документа
+Запуск: docker exec secure-content-backend python benchmark_rasterizers.py /app/uploads/<file>.pdf [--sample 5] [--save]
+С --save самый быстрый бэкенд, прошедший порог качества, запоминается для типа
+документа и используется при RASTERIZER_BACKEND=auto.
+"""
+import sys
+import os
+import argparse
+
+# Добавляем путь к приложению
+sys.path.insert(0, '/app')
+
+from app.core.config import settings
+from app.services.converter import DocumentConverter
+from app.services.rasterizers import Rasterizers
+
+def sample_pages(total_pages: int, sample: int) -> list:
+    """Равномерная выборка страниц (первая и последняя входят в нее)"""
+    if sample >= total_pages:
+        return list(range(1, total_pages + 1))
+    if sample <= 1:
+        return [1]
+    step = (total_pages - 1) / (sample - 1)
+    return sorted({1 + round(i * step) for i in range(sample)})
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PDF rasterizer backends")
+    parser.add_argument("file_path", help="PDF, PPT или PPTX для замера")
+    parser.add_argument("--sample", type=int, default=5, help="Сколько страниц документа замерять")
+    parser.add_argument("--dpi", type=int, default=None, help="DPI (по умолчанию PDF_DPI или PPT_DPI)")
+    parser.add_argument("--format", default=settings.PAGE_IMAGE_FORMAT, help="Формат хранения страниц")
+    parser.add_argument(
+        "--min-psnr",
+        type=float,
+        default=settings.RASTERIZER_MIN_PSNR,
+        help="Минимальный PSNR (дБ) относительно pdftoppm"
+    )
+    parser.add_argument("--save", action="store_true", help="Запомнить выбранный бэкенд для типа документа")
+    args = parser.parse_args()
+
+    file_type = os.path.splitext(args.file_path)[1].lower().lstrip(".")
+    if file_type in ['ppt', 'pptx']:
+        pdf_path = DocumentConverter.convert_ppt_to_pdf(args.file_path)
+    else:
+        pdf_path = args.file_path
+    dpi = args.dpi or DocumentConverter.render_dpi(file_type)
+    kind = Rasterizers.document_kind(file_type)
+
+    total_pages = DocumentConverter.get_pdf_page_count(pdf_path)
+    pages = sample_pages(total_pages, args.sample)
+
+    print("=" * 60)
+    print("  Rasterizer Benchmark")
+    print("=" * 60)
+    print(f"\n[INFO] {args.file_path}: {total_pages} pages ({kind}), {dpi} DPI, format {args.format}")
+    print(f"[INFO] Sample pages: {', '.join(str(page) for page in pages)}")
+    print(f"[INFO] Available backends: {', '.join(Rasterizers.available())}\n")
+    print(f"{'backend':>14} {'sec/page':>10} {'KB/page':>10} {'PSNR dB':>9}")
+
+    try:
+        results = Rasterizers.benchmark(pdf_path, pages, dpi, args.format)
+    except Exception as e:
+        print(f"[ERROR] Reference render ({Rasterizers.DEFAULT}) failed: {e}")
+        return 1
+
+    for result in results:
+        if "error" in result:
+            print(f"{result['backend']:>14} [ERROR] {result['error']}")
+            continue
+        print(
+            f"{result['backend']:>14} {result['seconds_per_page']:>10.3f} "
+            f"{result['bytes_per_page'] / 1024:>10.1f} {result['psnr']:>9.1f}"
+        )
+
+    chosen = Rasterizers.choose(results, args.min_psnr)
+    print()
+    if chosen is None:
+        print(f"[WARN] No backend reached {args.min_psnr} dB, keeping {Rasterizers.DEFAULT}")
+        return 1
+    print(f"[OK] Fastest backend with PSNR >= {args.min_psnr} dB for {kind}: {chosen}")
+
+    if args.save:
+        Rasterizers.save_selection(file_type, chosen)
+        print(f"[OK] Saved to {Rasterizers.selection_path()}")
+        if settings.RASTERIZER_BACKEND != Rasterizers.AUTO:
+            print(f"[WARN] RASTERIZER_BACKEND={settings.RASTERIZER_BACKEND}: set it to auto to use the selection")
+
+    print("\n" + "=" * 60)
+    print("  Benchmark complete!")
+    print("=" * 60)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Скрипт для перекодирования кеша страниц в другой формат хранения
+Запуск: docker exec secure-content-backend python reencode_page_cache.py [--format webp] [--document-id 5]
+"""
+import sys
+import os
+import argparse
+
+# Добавляем путь к приложению
+sys.path.insert(0, '/app')
+
+from app.core.config import settings
+from app.models.database import SessionLocal, Document
+from app.services.converter import DocumentConverter
+from app.services.image_formats import PageImageFormat
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-encode cached page rasters")
+    parser.add_argument(
+        "--format",
+        default=settings.PAGE_IMAGE_FORMAT,
+        choices=sorted(PageImageFormat.FORMATS) + [PageImageFormat.AUTO],
+        help="Целевой формат (по умолчанию PAGE_IMAGE_FORMAT)"
+    )
+    parser.add_argument("--document-id", type=int, default=None, help="Только один документ")
+    args = parser.parse_args()
+    target_format = args.format
+    
+    print("=" * 60)
+    print(f"  Page Cache Re-encode -> {target_format}")
+    print("=" * 60)
+    
+    db = SessionLocal()
+    
+    try:
+        query = db.query(Document).filter(Document.status == Document.READY)
+        if args.document_id is not None:
+            query = query.filter(Document.id == args.document_id)
+        documents = query.all()
+        print(f"\n[INFO] Documents to check: {len(documents)}")
+        
+        for doc in documents:
+            old_format = doc.image_format or PageImageFormat.DEFAULT
+            if old_format == target_format:
+                print(f"[INFO] Document {doc.id}: already {target_format}, skipped")
+                continue
+            
+            cache_dir = os.path.join(settings.CACHE_DIR, doc.file_hash)
+            reencoded = DocumentConverter.reencode_cache(
+                cache_dir, doc.total_pages, old_format, target_format,
+                dpi=DocumentConverter.render_dpi(doc.file_type)
+            )
+            # Переключаем документ только после того, как новые файлы записаны
+            doc.image_format = target_format
+            db.commit()
+            DocumentConverter.remove_stale_format_files(cache_dir, target_format)
+            print(f"[INFO] Document {doc.id}: {old_format} -> {target_format}, {reencoded} pages")
+        
+    except Exception as e:
+        print(f"[ERROR] Failed to re-encode: {e}")
+        db.rollback()
+        return 1
+    finally:
+        db.close()
+    
+    print("\n" + "=" * 60)
+    print("  Re-encode complete!")
+    print("=" * 60)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
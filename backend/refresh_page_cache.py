@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Скрипт для перерендера страниц, растеризованных с прежними параметрами (DPI, формат, версия конвертера)
+Запуск: docker exec secure-content-backend python refresh_page_cache.py [--document-id 5] [--dry-run]
+"""
+import sys
+import os
+import argparse
+
+# Добавляем путь к приложению
+sys.path.insert(0, '/app')
+
+from app.core.config import settings
+from app.models.database import SessionLocal, Document
+from app.services.converter import DocumentConverter
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-render stale cached pages")
+    parser.add_argument("--document-id", type=int, default=None, help="Только один документ")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать устаревшие страницы")
+    args = parser.parse_args()
+    
+    print("=" * 60)
+    print("  Page Cache Refresh")
+    print("=" * 60)
+    
+    db = SessionLocal()
+    
+    try:
+        query = db.query(Document).filter(Document.status == Document.READY)
+        if args.document_id is not None:
+            query = query.filter(Document.id == args.document_id)
+        documents = query.all()
+        print(f"\n[INFO] Documents to check: {len(documents)}")
+        
+        for doc in documents:
+            cache_dir = os.path.join(settings.CACHE_DIR, doc.file_hash)
+            dpi = DocumentConverter.render_dpi(doc.file_type)
+            stale = DocumentConverter.stale_pages(cache_dir, doc.total_pages, dpi, doc.image_format)
+            if not stale:
+                print(f"[INFO] Document {doc.id}: up to date ({dpi} dpi, {doc.image_format})")
+                continue
+            
+            print(f"[INFO] Document {doc.id}: {len(stale)} stale pages -> {dpi} dpi, {doc.image_format}")
+            if args.dry_run:
+                continue
+            DocumentConverter.refresh_stale_pages(
+                doc.file_path, doc.file_type, cache_dir, doc.total_pages, doc.image_format
+            )
+        
+    except Exception as e:
+        print(f"[ERROR] Failed to refresh: {e}")
+        return 1
+    finally:
+        db.close()
+    
+    print("\n" + "=" * 60)
+    print("  Refresh complete!")
+    print("=" * 60)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -44,7 +44,7 @@ def check_cache_files(ssh_client):
     """Проверка файлов в кеше"""
     print("\n[INFO] Checking cache directory...")
     stdin, stdout, stderr = ssh_client.exec_command(
-        "docker exec secure-content-backend find /app/data/cache -name '*.png' -type f | head -5"
+        "docker exec secure-content-backend find /app/data/cache -name 'page_*.*' -type f | head -5"
     )
     cache_files = stdout.read().decode().strip()
     if cache_files:
@@ -67,7 +67,7 @@ def clear_cache(ssh_client):
     """Очистка кеша изображений"""
     print("\n[INFO] Clearing image cache...")
     stdin, stdout, stderr = ssh_client.exec_command(
-        "docker exec secure-content-backend find /app/data/cache -name 'watermarked_*.png' -type f -delete"
+        "docker exec secure-content-backend find /app/data/cache -name 'watermarked_*.*' -type f -delete"
     )
     result = stdout.read().decode()
     error = stderr.read().decode()
@@ -79,7 +79,7 @@ def clear_cache(ssh_client):
         
         # Подсчитываем удаленные файлы
         stdin, stdout, stderr = ssh_client.exec_command(
-            "docker exec secure-content-backend find /app/data/cache -name 'watermarked_*.png' -type f | wc -l"
+            "docker exec secure-content-backend find /app/data/cache -name 'watermarked_*.*' -type f | wc -l"
         )
         remaining = stdout.read().decode().strip()
         print(f"[INFO] Remaining watermarked files: {remaining}")
@@ -33,14 +33,14 @@ def clear_cache(ssh_client):
     
     # Подсчитываем файлы до удаления
     stdin, stdout, stderr = ssh_client.exec_command(
-        "docker exec secure-content-backend find /app/data/cache -name 'watermarked_*.png' -type f 2>/dev/null | wc -l"
+        "docker exec secure-content-backend find /app/data/cache -name 'watermarked_*.*' -type f 2>/dev/null | wc -l"
     )
     before_count = stdout.read().decode().strip()
     print(f"[INFO] Files before cleanup: {before_count}")
     
     # Удаляем файлы
     stdin, stdout, stderr = ssh_client.exec_command(
-        "docker exec secure-content-backend find /app/data/cache -name 'watermarked_*.png' -type f -delete 2>&1"
+        "docker exec secure-content-backend find /app/data/cache -name 'watermarked_*.*' -type f -delete 2>&1"
     )
     result = stdout.read().decode()
     error = stderr.read().decode()
@@ -50,7 +50,7 @@ def clear_cache(ssh_client):
     
     # Подсчитываем файлы после удаления
     stdin, stdout, stderr = ssh_client.exec_command(
-        "docker exec secure-content-backend find /app/data/cache -name 'watermarked_*.png' -type f 2>/dev/null | wc -l"
+        "docker exec secure-content-backend find /app/data/cache -name 'watermarked_*.*' -type f 2>/dev/null | wc -l"
     )
     after_count = stdout.read().decode().strip()
     print(f"[INFO] Files after cleanup: {after_count}")